@@ -34,7 +34,8 @@ class AsyncDAQDataHandler(object):
         self.previous_index   = 0
         self.log_filename     = '{}/{}_log.log'.format(self.data_dir, self.role)
 
-        self.shutdown = False
+        # the writer thread sleeps on shutdown instead of polling
+        self.shutdown = threading.Event()
         self.ready    = False
 
         output =  ('\n*** NEW SESSION! {}\n'.format(datetime.now()))
@@ -57,7 +58,7 @@ class AsyncDAQDataHandler(object):
         self.ready = True
 
     def stop(self):
-        self.shutdown = True
+        self.shutdown.set()
 
     def _kill(self):
         sys.exit(0)
@@ -65,22 +66,18 @@ class AsyncDAQDataHandler(object):
     def do_write(self, start_time=None):
         # global shutdown
         # global ready
-        start=time.time()
         try:
-            # while not shutdown:
-            while not self.shutdown:
-                if time.time() - start > (self.file_length_sec + 0.01):
-                    start=time.time()
-                    # if ready:
-                    if self.ready:
-                        self.run()
+            # sleep between writes, waking early on stop()
+            while not self.shutdown.wait(timeout=(self.file_length_sec + 0.01)):
+                if self.ready:
+                    self.run()
         except ValueError:
             pass
         except Exception as e:
             self.write_to_log('\n![{}] Caught exception: {}\n repr({}) \n'.format(datetime.now(), e, repr(e)))
             # self.write_to_log(traceback.format_exc())
         else:
-            self.write_to_log('\n[{}] No exception thrown! sentinel value, shutdown={}\n'.format(datetime.now(), shutdown))
+            self.write_to_log('\n[{}] No exception thrown! sentinel value, shutdown={}\n'.format(datetime.now(), self.shutdown.is_set()))
         finally:
             self.write_to_log('[{}] Broke out of do_write loop. \n'.format(datetime.now()))
             self._kill()
@@ -35,7 +35,8 @@ class AsyncDAQDataHandler(object):
         self.previous_index  = 0
         self.log_filename    = '{}/{}_log.log'.format(self.data_dir, self.role)
 
-        self.shutdown = False
+        # the writer thread sleeps on shutdown instead of polling
+        self.shutdown = threading.Event()
         self.ready    = False
         with open(self.log_filename, 'a') as l: 
             l.write('\n*** NEW SESSION! {}\n'.format(datetime.now()))
@@ -58,21 +59,17 @@ class AsyncDAQDataHandler(object):
         self.ready = True
 
     def stop(self):
-        self.shutdown = True
+        self.shutdown.set()
 
     def _kill(self):
         sys.exit()
 
     def do_write(self):
-        start=time.time()
         try:
-            # while not shutdown:
-            while not self.shutdown:
-                if time.time() - start >= 1:
-                    start=time.time()
-                    # if ready:
-                    if self.ready:
-                        self.run()
+            # sleep between writes, waking early on stop()
+            while not self.shutdown.wait(timeout=1):
+                if self.ready:
+                    self.run()
         except Exception as e:
             import traceback
             with open(self.log_filename, 'a') as l: 
@@ -80,7 +77,7 @@ class AsyncDAQDataHandler(object):
                 l.write('\n![{}] traceback: {}\n'.format(datetime.now(), traceback.format_exc()))
         else:
             with open(self.log_filename, 'a') as l: 
-                l.write('\n[{}] No exception thrown! sentinel value, shutdown={}\n'.format(datetime.now(), shutdown))
+                l.write('\n[{}] No exception thrown! sentinel value, shutdown={}\n'.format(datetime.now(), self.shutdown.is_set()))
         finally:
             with open(self.log_filename, 'a') as l: 
                 l.write('[{}] Broke out of do_write loop. \n'.format(datetime.now()))
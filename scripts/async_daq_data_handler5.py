@@ -3,102 +3,371 @@ import time
 from datetime import datetime
 import os
 import sys
-        
+import queue
+import numpy as np
+from data_file_utils import (get_file_extension,
+                             get_data_filename,
+                             write_data_file,
+                             append_file_index,
+                             check_compression,
+                             write_scaling_file,
+                             BINARY_DTYPE,
+                             RAW_COUNT_DTYPE,
+                             SegmentWriter,
+                             HDF5Writer,
+                             SEGMENT_LENGTH_SEC)
+from session_log import SessionLog
+from scan_clock import ScanClock
+
 shutdown = False
 ready = False
+# never let the writer wake up more often than this (seconds)
+MIN_WRITE_DELAY = 0.01
+# number of preallocated file-length blocks shared by the extractor and disk writer
+BLOCK_POOL_SIZE = 4
 
-class AsyncDAQDataHandler(object):
-    """docstring for AsyncDAQDataHandler"""
-    def __init__(self, float_buffer, 
-                       role, 
-                       ai_device, 
+class AsyncBlockWriter(object):
+    """Block pool, disk writer thread and session log shared by the DAQ writers.
+
+    Subclasses copy rows out of the DAQ buffer(s) into pool blocks with
+    extract_rows() from run(), and tell do_write() how long to sleep with
+    get_write_delay(). Full blocks are written by the disk writer thread in
+    file_mode. Subclasses call start_threads() at the end of __init__.
+    """
+    def __init__(self, role, 
                        channel_count, 
                        data_dir,
                        sample_rate,
-                       scan_options,
-                       v_range,
-                       input_mode,
-                       flags,
-                       file_length):
-        super(AsyncDAQDataHandler, self).__init__()
-        self.float_buffer    = float_buffer
-        self.buffer_length   = len(self.float_buffer)
+                       file_length,
+                       file_mode='text',
+                       block_pool_size=BLOCK_POOL_SIZE,
+                       segment_length=SEGMENT_LENGTH_SEC,
+                       hdf5_compression=None,
+                       compression='gzip',
+                       compression_filter='shuffle',
+                       scaling=None):
+        super(AsyncBlockWriter, self).__init__()
         self.role            = role
-        self.ai_device       = ai_device
         self.channel_count   = channel_count
         self.data_dir        = data_dir
         self.sample_rate     = sample_rate
         self.file_length     = file_length
-        self.file_length_rows = int(self.sample_rate) * int(self.file_length)
+        # round rather than truncate so fractional file lengths (0.5 s) keep their rows
+        self.file_length_rows = int(round(self.sample_rate * self.file_length))
+        self.file_mode       = file_mode
+        # scaling is set when the DAQ returns raw counts (AInScanFlag.NOSCALEDATA)
+        # .. the counts are kept as 16-bit integers and scaled to volts when read
+        self.scaling         = scaling
+        self.dtype           = BINARY_DTYPE if self.scaling is None else RAW_COUNT_DTYPE
         self.rows_written    = 0
-        self.unwritten_rows  = []
-        self.status          = None
-        self.transfer_status = None
+        #
+        #   The extractor (do_write) copies rows from the DAQ buffer into a
+        #   .. block from free_blocks. Full blocks go on filled_blocks for the
+        #   .. disk writer (do_disk_write), which hands them back when written
+        #
+        self.free_blocks     = queue.Queue()
+        self.filled_blocks   = queue.Queue()
+        for _ in range(block_pool_size):
+            self.free_blocks.put(np.empty((self.file_length_rows, self.channel_count), dtype=self.dtype))
+        self.block           = None
+        self.block_fill      = 0
         self.start_time      = None
         self.original_start_time = None
-        self.current_index   = 0
-        self.previous_index  = 0
+        self.rows_lost       = 0
+        self.overruns        = 0
         self.log_filename    = '{}/{}_log.log'.format(self.data_dir, self.role)
+        self.gaps_filename   = '{}/{}_gaps.csv'.format(self.data_dir, self.role)
+        # set in begin(), subclasses feed it from run() with clock.add_point()
+        self.clock           = None
+        self.owns_clock      = False
+        self.clock_filename  = '{}/{}_clock.csv'.format(self.data_dir, self.role)
+
+        # fail early on an unknown file mode rather than in the writer thread
+        get_file_extension(self.file_mode)
+        if self.scaling is not None and self.file_mode == 'text':
+            raise ValueError('Raw counts can not be written in text mode, use a binary file mode')
+        # 'compressed' mode: the disk writer thread compresses each block before it is written
+        self.compression        = compression
+        self.compression_filter = compression_filter
+        if self.file_mode == 'compressed':
+            check_compression(self.compression, self.compression_filter, self.dtype)
+        self.log             = SessionLog(self.log_filename, self.role)
+        if self.scaling is not None:
+            write_scaling_file(self.data_dir, self.scaling)
+        # 'segment' and 'hdf5' modes append every block to a few large files
+        self.archive_writer  = None
+        if self.file_mode == 'segment':
+            self.archive_writer = SegmentWriter(self.data_dir, self.channel_count, self.sample_rate, segment_length,
+                                                dtype=self.dtype)
+        elif self.file_mode == 'hdf5':
+            self.archive_writer = HDF5Writer(self.data_dir, self.role, self.channel_count, self.sample_rate,
+                                             rows_per_block=self.file_length_rows,
+                                             compression=hdf5_compression,
+                                             dtype=self.dtype)
+
+        # the writer thread sleeps on these instead of polling
+        self.shutdown = threading.Event()
+        self.ready    = threading.Event()
 
-        self.shutdown = False
-        self.ready    = False
-        with open(self.log_filename, 'a') as l: 
-            l.write('\n*** NEW SESSION! {}\n'.format(datetime.now()))
-            l.write(' Channels on {} device: {}\n'.format(self.role, self.channel_count))
-            l.write('*** Device Configuration\n')
-            l.write(' Sample Rate (Hz): {}\n'.format(sample_rate))
-            l.write(' Scan Options:     {}\n'.format(scan_options))
-            l.write(' Voltage Range:    {}\n'.format(v_range.name))
-            l.write(' Input Mode:       {}\n'.format(input_mode.name))
-            l.write(' Flags:            {}\n\n'.format(flags.name))
+    def get_writer_config(self):
+        output  = (' File Mode:        {}\n'.format(self.file_mode))
+        output += (' Data Type:        {}\n'.format('volts' if self.scaling is None else 'raw counts'))
+        if self.file_mode == 'compressed':
+            output += (' Compression:      {} ({} filter)\n'.format(self.compression, self.compression_filter))
+        output += (' File Length (s):  {}\n'.format(self.file_length))
+        output += (' Rows Per File:    {}\n'.format(self.file_length_rows))
+        return(output)
 
+    def start_threads(self):
         #
         #   Create thread for logging
         #
         self.t = threading.Thread(target=self.do_write, name=self.role)
         self.t.start()
+        self.disk_t = threading.Thread(target=self.do_disk_write, name='{}_disk'.format(self.role))
+        self.disk_t.start()
 
-    def begin(self, start_time):
+    def begin(self, start_time, clock=None):
+        """Start writing, clock is the ScanClock of writers on the same sample clock (one is made if None)."""
         self.start_time = start_time
         self.original_start_time = start_time
-        self.ready = True
+        if clock is None:
+            clock = ScanClock(self.sample_rate, start_time, self.clock_filename)
+            self.owns_clock = True
+        self.clock = clock
+        self.ready.set()
 
     def stop(self):
-        self.shutdown = True
+        self.shutdown.set()
+        # release the writer if begin() was never called
+        self.ready.set()
 
     def _kill(self):
         sys.exit()
 
+    def write_to_log(self, output, prefix_tstamp=False):
+        self.log.write(output, prefix_tstamp=prefix_tstamp)
+
+    def get_row_time(self, row):
+        """Epoch time row of the scan was sampled (drift corrected once the clock has a fit)."""
+        return(self.clock.row_to_epoch(row))
+
+    def get_file_start_time(self):
+        # rows lost to overruns still count, so the sample clock stays correct after a gap
+        rows_elapsed = self.rows_written + self.rows_lost
+        return(self.get_row_time(rows_elapsed))
+
+    def record_gap(self, gap_start, gap_end, lost_rows):
+        self.log.record('OVERRUN',
+                        gap_start='{:.6f}'.format(gap_start),
+                        gap_end='{:.6f}'.format(gap_end),
+                        lost_rows=lost_rows,
+                        total_lost_rows=self.rows_lost,
+                        overruns=self.overruns)
+        new_file = not os.path.exists(self.gaps_filename)
+        with open(self.gaps_filename, 'a') as f:
+            if new_file:
+                f.write('gap_start_epoch,gap_end_epoch,lost_rows\n')
+            f.write('{:.6f},{:.6f},{}\n'.format(gap_start, gap_end, lost_rows))
+
     def do_write(self):
-        start=time.time()
         try:
-            # while not shutdown:
-            while not self.shutdown:
-                if time.time() - start >= 1:
-                    start=time.time()
-                    # if ready:
-                    if self.ready:
-                        self.run()
+            # sleep until begin() (or stop()) is called
+            self.ready.wait()
+            # then sleep until the next file boundary, waking early on stop()
+            while not self.shutdown.wait(timeout=self.get_write_delay()):
+                self.run()
         except Exception as e:
             import traceback
-            with open(self.log_filename, 'a') as l: 
-                l.write('\n![{}] Caught exception: {}\n repr({}) \n'.format(datetime.now(), e, repr(e)))
-                l.write('\n![{}] traceback: {}\n'.format(datetime.now(), traceback.format_exc()))
+            output  = ('\n![{}] Caught exception: {}\n repr({}) \n'.format(datetime.now(), e, repr(e)))
+            output += ('\n![{}] traceback: {}\n'.format(datetime.now(), traceback.format_exc()))
+            self.write_to_log(output)
         else:
-            with open(self.log_filename, 'a') as l: 
-                l.write('\n[{}] No exception thrown! sentinel value, shutdown={}\n'.format(datetime.now(), shutdown))
+            self.write_to_log('\n[{}] No exception thrown! sentinel value, shutdown={}\n'.format(datetime.now(), self.shutdown.is_set()))
         finally:
-            with open(self.log_filename, 'a') as l: 
-                l.write('[{}] Broke out of do_write loop. \n'.format(datetime.now()))
+            self.write_to_log('[{}] Broke out of do_write loop. \n'.format(datetime.now()))
+            # let the disk writer finish the blocks already extracted
+            self.filled_blocks.put(None)
+            self.disk_t.join()
+            if self.owns_clock:
+                self.clock.close()
+            self.log.close()
             self._kill()
 
+    def do_disk_write(self):
+        try:
+            while True:
+                item = self.filled_blocks.get()
+                if item is None:
+                    # sentinel from do_write, nothing else is coming
+                    break
+                file_start_time, block = item
+                self.write_block(file_start_time, block)
+                self.free_blocks.put(block)
+        except Exception as e:
+            import traceback
+            output  = ('\n![{}] Disk writer caught exception: {}\n repr({}) \n'.format(datetime.now(), e, repr(e)))
+            output += ('\n![{}] traceback: {}\n'.format(datetime.now(), traceback.format_exc()))
+            self.write_to_log(output)
+            # stop extracting, there is nowhere to put the data
+            self.stop()
+        finally:
+            if self.archive_writer is not None:
+                self.archive_writer.close()
+
+    def write_block(self, file_start_time, block):
+        write_start = time.time()
+        if self.file_mode == 'segment':
+            self.archive_writer.write(file_start_time, block)
+            file_name = self.archive_writer.get_segment_path()
+        elif self.file_mode == 'hdf5':
+            self.archive_writer.write(file_start_time, block)
+            file_name = self.archive_writer.filename
+        else:
+            file_name = get_data_filename(self.data_dir, file_start_time, mode=self.file_mode)
+            write_data_file(file_name, block, mode=self.file_mode,
+                            codec=self.compression,
+                            compression_filter=self.compression_filter,
+                            dtype=self.dtype)
+            append_file_index(self.data_dir, file_start_time, mode=self.file_mode)
+        self.log.record('FILE',
+                        name=os.path.basename(file_name),
+                        size_bytes=os.path.getsize(file_name),
+                        epoch=time.time(),
+                        duration_sec=(time.time() - write_start),
+                        queued=self.filled_blocks.qsize())
+
+    def get_free_block(self):
+        # blocks until the disk writer returns one, the DAQ keeps scanning while
+        # .. we wait so callers get their block before deciding what to read
+        while not self.shutdown.is_set():
+            try:
+                return(self.free_blocks.get(timeout=self.file_length))
+            except queue.Empty:
+                self.log.record('POOL_EMPTY', queued=self.filled_blocks.qsize())
+        return(None)
+
+    def extract_rows(self, rows):
+        """Copy rows into pool blocks, queueing each block once it holds a full file."""
+        while len(rows):
+            if self.block is None:
+                self.block = self.get_free_block()
+                if self.block is None:
+                    return
+            n = min(len(rows), self.file_length_rows - self.block_fill)
+            self.block[self.block_fill:self.block_fill + n] = rows[:n]
+            self.block_fill += n
+            rows = rows[n:]
+
+            if self.block_fill == self.file_length_rows:
+                self.finish_block()
+
+    def finish_block(self):
+        """Hand the current (full) block to the disk writer."""
+        self.filled_blocks.put((self.get_file_start_time(), self.block))
+        self.rows_written += self.file_length_rows
+        self.block      = None
+        self.block_fill = 0
+
+class AsyncDAQDataHandler(AsyncBlockWriter):
+    """Writes the continuous scan from one DAQ ring buffer to data files."""
+    def __init__(self, float_buffer, 
+                       role, 
+                       ai_device, 
+                       channel_count, 
+                       data_dir,
+                       sample_rate,
+                       scan_options,
+                       v_range,
+                       input_mode,
+                       flags,
+                       file_length,
+                       **kwargs):
+        # kwargs are the writer options (file_mode, compression, ..) see AsyncBlockWriter
+        super(AsyncDAQDataHandler, self).__init__(role=role,
+                                                  channel_count=channel_count,
+                                                  data_dir=data_dir,
+                                                  sample_rate=sample_rate,
+                                                  file_length=file_length,
+                                                  **kwargs)
+        self.float_buffer    = float_buffer
+        # wrap the ctypes buffer from create_float_buffer once
+        # .. slicing this view does not copy or create python floats
+        self.buffer_view     = np.ctypeslib.as_array(self.float_buffer)
+        self.buffer_length   = len(self.float_buffer)
+        self.ai_device       = ai_device
+        self.status          = None
+        self.transfer_status = None
+        self.current_index   = 0
+        self.previous_index  = 0
+        # current_total_count never wraps, so comparing it with the last read
+        # .. tells us if the DAQ lapped the writer
+        self.previous_total_count = 0
+
+        output  = ('\n*** NEW SESSION! {}\n'.format(datetime.now()))
+        output += (' Channels on {} device: {}\n'.format(self.role, self.channel_count))
+        output += ('*** Device Configuration\n')
+        output += (' Sample Rate (Hz): {}\n'.format(sample_rate))
+        output += (' Scan Options:     {}\n'.format(scan_options))
+        output += (' Voltage Range:    {}\n'.format(v_range.name))
+        output += (' Input Mode:       {}\n'.format(input_mode.name))
+        output += (' Flags:            {}\n'.format(flags.name))
+        output += self.get_writer_config()
+        output += (' Buffer Length:    {}\n\n'.format(self.buffer_length))
+        self.write_to_log(output)
+        self.start_threads()
+
+    def get_write_delay(self):
+        """Seconds until the DAQ buffer holds enough rows to finish the next file."""
+        rows_buffered = self.block_fill
+        status, transfer_status = self.ai_device.get_scan_status()
+        if transfer_status.current_index != -1:
+            # rows the DAQ has added since the last read
+            new_samples = transfer_status.current_total_count - self.previous_total_count
+            rows_buffered += new_samples // self.channel_count
+        rows_needed = max(self.file_length_rows - rows_buffered, 0)
+        return(max(rows_needed / float(self.sample_rate), MIN_WRITE_DELAY))
+
+    def handle_overrun(self, total_count):
+        """Skip ahead after the DAQ lapped the writer and record the gap.
+
+        Reading restarts one file length ahead of the oldest sample left in the
+        buffer so the DAQ can't overwrite values while they are being copied.
+        The partially filled block can't be finished either, so it is counted
+        as lost.
+        """
+        keep_samples = self.buffer_length - (self.file_length_rows * self.channel_count)
+        keep_samples -= keep_samples % self.channel_count
+        resume_total_count = total_count - keep_samples
+
+        lost_rows  = (resume_total_count - self.previous_total_count) // self.channel_count
+        lost_rows += self.block_fill
+        gap_start  = self.get_file_start_time()
+        self.block_fill = 0
+        self.rows_lost += lost_rows
+        self.overruns  += 1
+        gap_end    = self.get_file_start_time()
+
+        self.previous_total_count = resume_total_count
+        self.previous_index       = resume_total_count % self.buffer_length
+        self.record_gap(gap_start, gap_end, lost_rows)
+
     def run(self):
+        # wait for a pool block before looking at the buffer, anything the DAQ
+        # .. overwrites during the wait is then caught by the overrun check below
+        if self.block is None:
+            self.block = self.get_free_block()
+            if self.block is None:
+                return(0.0)
+
         # Get the status of the background operation
+        poll_start = time.monotonic()
         self.status, self.transfer_status = self.ai_device.get_scan_status()
+        poll_stop  = time.monotonic()
         self.current_index = self.transfer_status.current_index
         if self.current_index == -1:
             # nothing has been written to the buffer yet!
-            with open(self.log_filename, 'a') as l: l.write('\nEMPTY BUFFER...\n')
+            self.write_to_log('\nEMPTY BUFFER...\n')
             return(0.0)
         elif self.current_index % self.channel_count != 0:
             raise ValueError("This implementation assumes that the circular buffer always receives values"
@@ -107,59 +376,42 @@ class AsyncDAQDataHandler(object):
 
         write_start = time.time()  # For logging/tuning
 
-        if self.previous_index > self.current_index:
+        total_count = self.transfer_status.current_total_count
+        self.clock.add_point(total_count // self.channel_count, poll_start, poll_stop)
+        if total_count - self.previous_total_count > self.buffer_length:
+            # the DAQ has overwritten samples we never read
+            self.handle_overrun(total_count)
+        # only read what fits in the current block so extract_rows never waits on
+        # .. the pool between the overrun check and the copy, the rest is read by
+        # .. the next run() (get_write_delay() won't sleep while rows are waiting)
+        new_samples = min(total_count - self.previous_total_count,
+                          (self.file_length_rows - self.block_fill) * self.channel_count)
+
+        stop_index = self.previous_index + new_samples
+        if stop_index > self.buffer_length:
             # Buffer has wrapped around.
-            first_part = self.float_buffer[self.previous_index:]
-            second_part = self.float_buffer[:self.current_index]
-            vals = first_part
-            vals.extend(second_part)
+            parts = (self.buffer_view[self.previous_index:],
+                     self.buffer_view[:stop_index - self.buffer_length])
         else:
-            vals = self.float_buffer[self.previous_index:self.current_index]
-
-
-        i = 0
-        while (i + self.channel_count) < len(vals):
-            row_vals = vals[i:i+self.channel_count]
-            self.unwritten_rows.append(row_vals)
-            i += self.channel_count
-
-        while len(self.unwritten_rows) >= self.file_length_rows:
-            if self.rows_written:
-                file_start_time = self.original_start_time + float(self.rows_written / self.sample_rate)
-            else:
-                file_start_time = self.original_start_time
-            file_start_time = float(file_start_time)
-            file_name = os.path.join(self.data_dir, '{:.6f}.txt'.format(file_start_time))
-            rows_to_write = self.unwritten_rows[:self.file_length_rows]
-            remaining_rows = self.unwritten_rows[self.file_length_rows:]
-            with open(file_name, 'w') as f:
-                for row in rows_to_write:
-                    f.write(','.join('{:.12f}'.format(v) for v in row) + '\n')
-            with open(self.log_filename, 'a') as l: 
-                l.write('---------------------\n')
-                l.write('Wrote file name:  {}\n'.format(file_name))
-                l.write('At epoch seconds: {}{}\n'.format(' '*72, time.time()))
-                l.write('Buffer length:    {}\n'.format(self.buffer_length))
-                l.write('current_index:    {}\n'.format(self.current_index))
-                l.write('Rows written:     {}\n'.format(self.rows_written))
-                l.write('Rows per file:    {}\n'.format(self.file_length_rows))
-                l.write('File length sec:  {}\n'.format(self.file_length))
-                l.write('Sample rate Hz:   {}\n'.format(self.sample_rate))
-
-            self.unwritten_rows = remaining_rows
-            self.rows_written += self.file_length_rows
-
-        self.previous_index = self.current_index
+            parts = (self.buffer_view[self.previous_index:stop_index],)
+
+        # float_buffer = [channel0_reading1, channel1_reading1, channel0_reading2, ..]
+        # .. so each row of the reshaped view holds one reading from every channel
+        # .. extract_rows copies the rows out before the DAQ overwrites them
+        for vals in parts:
+            self.extract_rows(vals.reshape(-1, self.channel_count))
+
+        self.previous_index = stop_index % self.buffer_length
+        self.previous_total_count += new_samples
 
         # # increment time
         # self.start_time += float(self.sample_rate / rows_written)
 
         write_stop = time.time()
-        with open(self.log_filename, 'a') as l: 
-            l.write('------------------------------------\n')
-            # l.write('Data dump to:   {}\n'.format(file_name))
-            l.write('Write Duration: {} (seconds)\n'.format((write_stop - write_start)))
-            # l.write('File length:    {} (seconds)\n'.format(self.sample_rate / rows_written))
-            # l.write('Rows written:   {}\n'.format(rows_written))
+        self.log.record('READ',
+                        current_index=self.current_index,
+                        rows_written=self.rows_written,
+                        rows_lost=self.rows_lost,
+                        duration_sec=(write_stop - write_start))
 
         return(write_stop - write_start)
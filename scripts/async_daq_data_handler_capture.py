@@ -0,0 +1,202 @@
+import time
+import os
+import queue
+from datetime import datetime
+import numpy as np
+from async_daq_data_handler5 import AsyncBlockWriter
+from ring_buffer_reader import RingBufferReader
+from stream_detectors import ThresholdDetector
+
+# how often the capture thread looks for new triggers (seconds)
+CAPTURE_POLL_SEC = 0.05
+
+class AsyncTriggeredCaptureHandler(AsyncBlockWriter):
+    """Writes a pre/post-trigger window of a continuous scan for every trigger.
+
+    The scan is never re-armed, so there is no dead time between events and
+    closely spaced triggers each get their own (overlapping) window. A
+    trigger comes from one of the detectors (see stream_detectors.py), a
+    threshold crossing on trigger_channel (wire the hardware trigger into a
+    spare analog input) or a call to trigger(). The handler only reads the
+    DAQ buffer, so it can run on the same buffer as an AsyncDAQDataHandler.
+    Every window is one data file of pre_trigger_sec + post_trigger_sec and
+    every event gets a line in <role>_events.csv.
+    """
+    def __init__(self, float_buffer,
+                       role,
+                       ai_device,
+                       channel_count,
+                       data_dir,
+                       sample_rate,
+                       scan_options,
+                       v_range,
+                       input_mode,
+                       flags,
+                       pre_trigger_sec,
+                       post_trigger_sec,
+                       trigger_channel=None,
+                       trigger_level=None,
+                       trigger_edge='rising',
+                       trigger_holdoff_sec=0.0,
+                       detectors=None,
+                       **kwargs):
+        # detectors see the values in the DAQ buffer, raw counts if flags has NOSCALEDATA
+        detectors = list(detectors or [])
+        if trigger_channel is not None:
+            if trigger_level is None:
+                raise ValueError('A trigger channel needs a trigger level')
+            detectors.append(ThresholdDetector([trigger_channel], trigger_level, edge=trigger_edge))
+        # kwargs are the writer options (file_mode, compression, ..) see AsyncBlockWriter
+        # .. every pool block holds one event window
+        super(AsyncTriggeredCaptureHandler, self).__init__(role=role,
+                                                           channel_count=channel_count,
+                                                           data_dir=data_dir,
+                                                           sample_rate=sample_rate,
+                                                           file_length=pre_trigger_sec + post_trigger_sec,
+                                                           **kwargs)
+        self.reader           = RingBufferReader(float_buffer, ai_device, channel_count)
+        self.pre_trigger_rows = int(round(pre_trigger_sec * sample_rate))
+        self.post_trigger_rows = self.file_length_rows - self.pre_trigger_rows
+        if self.file_length_rows > self.reader.buffer_rows:
+            raise ValueError('The DAQ buffer ({} rows) is too short for a {} row event window'.format(self.reader.buffer_rows, self.file_length_rows))
+        self.detectors        = detectors
+        self.holdoff_rows     = int(round(trigger_holdoff_sec * sample_rate))
+        # (trigger_epoch, source) from trigger(), any thread
+        self.software_triggers = queue.Queue()
+        # (trigger_row, source) waiting for their post-trigger rows
+        self.pending_events   = []
+        # rows already run through the detectors
+        self.scan_row         = 0
+        # {detector name: row of its last trigger} for the holdoff
+        self.last_trigger_row = {}
+        # rows handed to the detectors, grown when a poll brings more
+        self.detect_rows      = np.empty((0, channel_count))
+        self.events           = 0
+        self.events_lost      = 0
+        self.events_filename  = '{}/{}_events.csv'.format(self.data_dir, self.role)
+
+        output  = ('\n*** NEW SESSION! {}\n'.format(datetime.now()))
+        output += (' Channels on {} device: {}\n'.format(self.role, self.channel_count))
+        output += ('*** Device Configuration\n')
+        output += (' Sample Rate (Hz): {}\n'.format(sample_rate))
+        output += (' Scan Options:     {}\n'.format(scan_options))
+        output += (' Voltage Range:    {}\n'.format(v_range.name))
+        output += (' Input Mode:       {}\n'.format(input_mode.name))
+        output += (' Flags:            {}\n'.format(flags.name))
+        output += self.get_writer_config()
+        output += (' Buffer Length:    {}\n'.format(self.reader.buffer_length))
+        output += ('*** Trigger Configuration\n')
+        output += (' Pre Trigger (s):  {}\n'.format(pre_trigger_sec))
+        output += (' Post Trigger (s): {}\n'.format(post_trigger_sec))
+        output += (' Holdoff (s):      {}\n'.format(trigger_holdoff_sec))
+        if not self.detectors:
+            output += (' Detectors:        None (software triggers only)\n')
+        for detector in self.detectors:
+            output += (' Detector:         {} ({})\n'.format(detector.name, detector.describe()))
+        output += '\n'
+        self.write_to_log(output)
+        self.start_threads()
+
+    def trigger(self, trigger_epoch=None, source='software'):
+        """Capture the window around trigger_epoch (now if None). Never blocks."""
+        if trigger_epoch is None:
+            trigger_epoch = time.time()
+        self.software_triggers.put((trigger_epoch, source))
+
+    def get_write_delay(self):
+        return(CAPTURE_POLL_SEC)
+
+    def add_detector_event(self, trigger_row, source):
+        # triggers within the holdoff of the last one are ringing on the same event
+        last_row = self.last_trigger_row.get(source)
+        if last_row is not None and trigger_row - last_row < self.holdoff_rows:
+            return
+        self.last_trigger_row[source] = trigger_row
+        self.pending_events.append((trigger_row, source))
+
+    def find_detector_triggers(self):
+        """Run the rows scanned since the last call through every detector."""
+        first_row = max(self.scan_row, self.reader.get_oldest_row())
+        rows      = self.reader.total_rows - first_row
+        if rows <= 0:
+            return
+        if first_row != self.scan_row:
+            # the DAQ overwrote rows we never checked, start the detectors over
+            for detector in self.detectors:
+                detector.reset()
+            self.log.record('DETECT_SKIPPED', rows=first_row - self.scan_row)
+        if len(self.detect_rows) < rows:
+            self.detect_rows = np.empty((rows, self.channel_count))
+        new_rows = self.detect_rows[:rows]
+        self.reader.copy_rows(first_row, new_rows)
+        for detector in self.detectors:
+            for i in detector.process(new_rows):
+                self.add_detector_event(first_row + int(i), detector.name)
+        self.scan_row = first_row + rows
+
+    def lose_event(self, trigger_row, source, record='EVENT_LOST', **kwargs):
+        self.events_lost += 1
+        self.log.record(record,
+                        trigger_epoch='{:.6f}'.format(self.get_row_time(trigger_row)),
+                        source=source,
+                        events_lost=self.events_lost,
+                        **kwargs)
+
+    def write_event(self, trigger_row, source):
+        # windows that start before the scan did are moved up to the first row
+        first_row  = max(trigger_row - self.pre_trigger_rows, 0)
+        if first_row < self.reader.get_oldest_row():
+            # the DAQ already overwrote the start of this window
+            self.lose_event(trigger_row, source)
+            return
+        block = self.get_free_block()
+        if block is None:
+            return
+        self.reader.copy_rows(first_row, block)
+        # the DAQ kept scanning while we waited for the block (and copied it),
+        # .. rows it overwrote before they were copied are not this event
+        self.reader.update()
+        oldest_row = self.reader.get_oldest_row()
+        if first_row < oldest_row:
+            self.free_blocks.put(block)
+            self.lose_event(trigger_row, source, record='EVENT_TRUNCATED', rows_overwritten=oldest_row - first_row)
+            return
+        self.filled_blocks.put((self.get_row_time(first_row), block))
+        self.rows_written += self.file_length_rows
+        self.events += 1
+        self.log.record('EVENT',
+                        trigger_epoch='{:.6f}'.format(self.get_row_time(trigger_row)),
+                        window_start='{:.6f}'.format(self.get_row_time(first_row)),
+                        source=source,
+                        events=self.events)
+        new_file = not os.path.exists(self.events_filename)
+        with open(self.events_filename, 'a') as f:
+            if new_file:
+                f.write('trigger_epoch,window_start_epoch,source\n')
+            f.write('{:.6f},{:.6f},{}\n'.format(self.get_row_time(trigger_row), self.get_row_time(first_row), source))
+
+    def run(self):
+        if self.reader.update() is None:
+            # nothing has been written to the buffer yet!
+            return(0.0)
+
+        write_start = time.time()  # For logging/tuning
+        self.clock.add_point(self.reader.total_rows, self.reader.poll_start, self.reader.poll_stop)
+
+        while not self.software_triggers.empty():
+            trigger_epoch, source = self.software_triggers.get()
+            trigger_row = self.clock.epoch_to_row(trigger_epoch)
+            self.pending_events.append((max(trigger_row, 0), source))
+        if self.detectors:
+            self.find_detector_triggers()
+
+        # write every event whose post-trigger rows are in the buffer
+        waiting = []
+        for trigger_row, source in sorted(self.pending_events):
+            if max(trigger_row - self.pre_trigger_rows, 0) + self.file_length_rows <= self.reader.total_rows:
+                self.write_event(trigger_row, source)
+            else:
+                waiting.append((trigger_row, source))
+        self.pending_events = waiting
+
+        return(time.time() - write_start)
@@ -3,9 +3,18 @@ import time
 from datetime import datetime
 import os
 import sys
+import queue
+import numpy as np
+from data_file_utils import get_data_filename, write_text_file
+from session_log import SessionLog
         
 shutdown = False
 ready = False
+# number of preallocated trigger blocks, more are allocated if the disk falls behind
+TRIGGER_POOL_SIZE = 4
+# blocks allocated past the pool at most, triggers beyond that are skipped (and
+# .. logged) and the extra blocks are dropped as the writer hands them back
+MAX_EXTRA_TRIGGER_BLOCKS = 12
 
 class AsyncDAQDataHandler(object):
     """docstring for AsyncDAQDataHandler"""
@@ -23,6 +32,7 @@ class AsyncDAQDataHandler(object):
                        trigger_type=None):
         super(AsyncDAQDataHandler, self).__init__()
         self.float_buffer    = float_buffer
+        self.buffer_view     = np.ctypeslib.as_array(self.float_buffer)
         self.buffer_length   = len(self.float_buffer)
         self.role            = role
         self.ai_device       = ai_device
@@ -37,10 +47,21 @@ class AsyncDAQDataHandler(object):
         self.current_index   = 0
         self.rows_written    = 0
         self.log_filename    = '{}/{}_log.log'.format(self.data_dir, self.role)
+        self.log             = SessionLog(self.log_filename, self.role)
         self.is_triggered_mode = trigger_type != None
 
-        self.shutdown = False
-        self.ready    = False
+        self.shutdown = threading.Event()
+        #
+        #   trigger() copies the scan into a block from free_blocks and puts
+        #   .. (start_time, status, current_index, block) on triggers for the
+        #   .. writer thread, so the caller can re-arm the DAQ straight away
+        #
+        self.triggers    = queue.Queue()
+        self.free_blocks = queue.Queue()
+        for _ in range(TRIGGER_POOL_SIZE):
+            self.free_blocks.put(self.new_block())
+        self.extra_blocks = 0
+        self.blocks_lock  = threading.Lock()
 
         output  = ('\n*** NEW SESSION! {}\n'.format(datetime.now()))
         output += (' Channels on {} device: {}\n'.format(self.role, self.channel_count))
@@ -49,7 +70,10 @@ class AsyncDAQDataHandler(object):
         output += (' Scan Options:     {}\n'.format(scan_options))
         output += (' Voltage Range:    {}\n'.format(v_range.name))
         output += (' Input Mode:       {}\n'.format(input_mode.name))
-        output += (' Flags:            {}\n\n'.format(flags.name))
+        output += (' Flags:            {}\n'.format(flags.name))
+        output += (' File Length (s):  {}\n'.format(self.file_length))
+        output += (' Rows Per File:    {}\n'.format(self.file_length_rows))
+        output += (' Buffer Length:    {}\n\n'.format(self.buffer_length))
         if self.is_triggered_mode:
             output += (' Trigger Type:     {}\n\n'.format(trigger_type))
         self.write_to_log(output)
@@ -65,62 +89,84 @@ class AsyncDAQDataHandler(object):
         self.start_time      = None
         self.current_index   = 0
 
+    def new_block(self):
+        return(np.empty((self.file_length_rows, self.channel_count)))
+
     def trigger(self, start_time):
+        """Queue the last scan for writing and return without waiting for the disk.
+
+        The rows are copied out of the buffer here because the next scan
+        overwrites it as soon as the DAQ is re-armed.
+        """
         self.reset()
         self.start_time = start_time
-        self.ready = True
-        while self.ready:
-            pass
+        self.status, self.transfer_status = self.ai_device.get_scan_status()
+        self.current_index = self.transfer_status.current_index
+        try:
+            block = self.free_blocks.get_nowait()
+        except queue.Empty:
+            # never make the caller wait, allocate a block until there are too many in flight
+            with self.blocks_lock:
+                can_allocate = self.extra_blocks < MAX_EXTRA_TRIGGER_BLOCKS
+                if can_allocate:
+                    self.extra_blocks += 1
+            if not can_allocate:
+                self.log.record('TRIGGER_SKIPPED', start_time=start_time, queued=self.triggers.qsize())
+                return(False)
+            self.log.record('POOL_EMPTY', queued=self.triggers.qsize())
+            block = self.new_block()
+        block[:] = self.buffer_view[:self.file_length_rows * self.channel_count].reshape(-1, self.channel_count)
+        self.triggers.put((start_time, self.status, self.current_index, block))
         return(True)
 
+    def release_block(self, block):
+        # the pool only keeps TRIGGER_POOL_SIZE blocks, blocks allocated past it are dropped
+        with self.blocks_lock:
+            if self.extra_blocks > 0:
+                self.extra_blocks -= 1
+                return
+        self.free_blocks.put(block)
+
     def stop(self):
-        self.shutdown = True
+        self.shutdown.set()
+        # sentinel, the writer finishes the triggers queued before it
+        self.triggers.put(None)
 
     def _kill(self):
         sys.exit()
 
     def write_to_log(self, output, prefix_tstamp=False):
-        with open(self.log_filename, 'a') as l:
-            if prefix_tstamp:
-                l.write('[{}]: {}'.format(datetime.now(), output))
-            else:
-                l.write(output)
+        self.log.write(output, prefix_tstamp=prefix_tstamp)
 
     def do_write(self):
-        start=time.time()
         try:
-            # while not shutdown:
-            while not self.shutdown:
-                if time.time() - start >= 1:
-                    start=time.time()
-                    # if ready:
-                    if self.ready:
-                        if self.is_triggered_mode:
-                            self.write_to_log('[{}]: Triggered!\n'.format(datetime.now()))
-                        self.run()
-                        if self.is_triggered_mode:
-                            self.ready = False
+            while True:
+                # sleep until trigger() or stop() queues something
+                item = self.triggers.get()
+                if item is None:
+                    break
+                if self.is_triggered_mode:
+                    self.write_to_log('[{}]: Triggered!\n'.format(datetime.now()))
+                self.run(*item)
+                self.release_block(item[-1])
         except Exception as e:
             import traceback
             output  = ('\n![{}] Caught exception: {}\n repr({}) \n'.format(datetime.now(), e, repr(e)))
             output += ('\n![{}] traceback: {}\n'.format(datetime.now(), traceback.format_exc()))
+            self.write_to_log(output)
         else:
-            self.write_to_log('\n[{}] No exception thrown! sentinel value, shutdown={}\n'.format(datetime.now(), shutdown))
+            self.write_to_log('\n[{}] No exception thrown! sentinel value, shutdown={}\n'.format(datetime.now(), self.shutdown.is_set()))
         finally:
             self.write_to_log('[{}] Broke out of do_write loop. \n'.format(datetime.now()))
+            self.log.close()
             self._kill()
 
-    def run(self):
-        # Get the status of the background operation
-        self.status, self.transfer_status = self.ai_device.get_scan_status()
-        self.current_index = self.transfer_status.current_index
-        self.write_to_log('Status:        {}\n'.format(self.status), prefix_tstamp=True)
-        self.write_to_log('Current Index: {}\n'.format(self.transfer_status.current_index), prefix_tstamp=True)
-        if self.current_index == -1:
+    def run(self, start_time, status, current_index, block):
+        if current_index == -1:
             # nothing has been written to the buffer yet!
             self.write_to_log('\nEMPTY BUFFER...\n')
             return(0.0)
-        elif self.current_index % self.channel_count != 0:
+        elif current_index % self.channel_count != 0:
             self.write_to_log("This implementation assumes that the circular buffer always receives values"
                              " from all channels at once, which means the current index will be divisible"
                              " the channel count.")
@@ -129,44 +175,23 @@ class AsyncDAQDataHandler(object):
                              " the channel count.")
 
         # filename created with timestamp passed during trigger() call
-        file_start_time = float(self.start_time)
-        file_name = os.path.join(self.data_dir, '{:.6f}.txt'.format(file_start_time))
-
-        self.write_to_log('reading from index: [0, {}] in float buffer\n'.format(self.file_length_rows * self.channel_count + 1), prefix_tstamp=True)
-        self.write_to_log('length of float buffer: {}\n'.format(len(self.float_buffer)), prefix_tstamp=True)
-        # grab values from float buffer
-        vals = self.float_buffer[:self.file_length_rows * self.channel_count + 1]
-        self.write_to_log('Length of vals: {}\n'.format(len(vals)), prefix_tstamp=True)
-        # transpose to get row data (float buff writes in 'columns')
-        # float_buffer = [channel0_reading1, channel1_reading1, channel0_reading2, channel1_reading2, ..]
-        rows_to_write = []
-        i = 0
-        while (i + self.channel_count) < len(vals) + 1:
-            rows_to_write.append(vals[i:i + self.channel_count])
-            i += self.channel_count
-
-        self.write_to_log('Length of rows to write: {}\n'.format(len(rows_to_write)), prefix_tstamp=True)
+        file_name = get_data_filename(self.data_dir, start_time, mode='text')
 
         write_start = time.time()  # For logging/tuning
-        with open(file_name, 'w') as f:
-            for row in rows_to_write:
-                f.write(','.join('{:.12f}'.format(v) for v in row) + '\n')
+        write_text_file(file_name, block)
         write_stop = time.time() 
 
-        output  = ('---------------------\n')
-        output += ('Wrote file name:  {}\n'.format(file_name))
-        output += ('At epoch seconds: {}\n'.format(time.time()))
-        output += ('Buffer length:    {}\n'.format(self.buffer_length))
-        output += ('current_index:    {}\n'.format(self.current_index))
-        output += ('Rows written:     {}\n'.format(self.rows_written))
-        output += ('Rows per file:    {}\n'.format(self.file_length_rows))
-        output += ('File length sec:  {}\n'.format(self.file_length))
-        output += ('Sample rate Hz:   {}\n'.format(self.sample_rate))
-        self.write_to_log(output)
+        # one record per trigger instead of a line per step
+        self.log.record('FILE',
+                        name=os.path.basename(file_name),
+                        epoch=time.time(),
+                        status=status,
+                        current_index=current_index,
+                        rows=len(block),
+                        rows_written=self.rows_written,
+                        queued=self.triggers.qsize(),
+                        duration_sec=(write_stop - write_start))
 
         self.rows_written += self.file_length_rows
 
-        self.write_to_log('------------------------------------\n')
-        self.write_to_log('Write Duration: {} (seconds)\n'.format((write_stop - write_start)))
-
         return(write_stop - write_start)
@@ -0,0 +1,82 @@
+import os
+import time
+import traceback
+from prompt_utils import print_line
+from plot_utils import get_files, get_channels_in_window, get_sources_in_window, open_archive
+from common_argparse import get_build_specgram_tiles_args
+from data_file_utils import ARCHIVE_MODES
+from specgram_tiles import build_tiles, TILE_DIRNAME
+
+#
+# This method returns the (start, end) epochs to build tiles for, the whole
+# .. directory unless --start/--end are given
+def get_time_range(args, files):
+    start_t = args.start.timestamp() if args.start else None
+    end_t   = args.end.timestamp() if args.end else None
+    if start_t is None or end_t is None:
+        if args.mode in ARCHIVE_MODES:
+            raise RuntimeError('--start and --end are needed for {} data'.format(args.mode))
+        if len(files) == 0:
+            return(None, None)
+        start_t = float(files[0].stem) if start_t is None else start_t
+        # the tile holding a file still being written is left for the next run
+        end_t   = float(files[-1].stem) + args.file_length_sec if end_t is None else end_t
+    return(start_t, end_t)
+
+def main(args):
+    for role in args.role:
+        files = [] if args.mode in ARCHIVE_MODES else get_files(path=args.data_directory, role=role, mode=args.mode)
+        start_t, end_t = get_time_range(args, files)
+        if start_t is None:
+            print_line('No {} data files in {}'.format(role, args.data_directory), l_style='error')
+            continue
+
+        # an archive's index is loaded once for the build, not once per tile
+        archive = open_archive(args.data_directory, role, args.mode) if args.mode in ARCHIVE_MODES else None
+
+        def read_window(window_start_t, window_end_t):
+            return(get_channels_in_window(path=args.data_directory,
+                                          files=files,
+                                          role=role,
+                                          channels=args.channels,
+                                          start_t=window_start_t,
+                                          end_t=window_end_t,
+                                          mode=args.mode,
+                                          archive=archive))
+
+        def list_sources(window_start_t, window_end_t):
+            return(get_sources_in_window(path=args.data_directory,
+                                         files=files,
+                                         role=role,
+                                         start_t=window_start_t,
+                                         end_t=window_end_t,
+                                         mode=args.mode,
+                                         archive=archive))
+
+        build_start = time.time()
+        data_dir    = os.path.normpath('{}/{}_DAQ/'.format(args.data_directory, role))
+        try:
+            written = build_tiles(read_window=read_window,
+                                  list_sources=list_sources,
+                                  data_dir=data_dir,
+                                  channels=args.channels,
+                                  NFFT=args.nfft,
+                                  Fs=args.sample_rate,
+                                  start_t=start_t,
+                                  end_t=end_t,
+                                  rebuild=args.rebuild)
+        finally:
+            if archive is not None:
+                archive.close()
+        print_line('<info_italic>{} DAQ:</info_italic> {} tile(s) written to {}/{} in {:.1f} seconds'.format(role, written, data_dir, TILE_DIRNAME, time.time() - build_start))
+
+if __name__ == '__main__':
+    # see common_argparse.py for breakdown
+    args = get_build_specgram_tiles_args()
+
+    try:
+        main(args)
+    except KeyboardInterrupt:
+        pass
+    except Exception:
+        traceback.print_exc()
@@ -15,13 +15,20 @@ def get_specgram_bounded_args():
     parser.add_argument('--debug', help='Show debugging print messages', action='store_true')
     parser.add_argument('--quiet', help='No Console Output', action='store_true')
     parser.add_argument('--verbose', help='Verbose output - may slow process on slower CPUs', action='store_true')
-    parser.add_argument('--mode', help='Data output mode', choices=['binary', 'text'], required=False)
+    parser.add_argument('--mode', help='Data output mode', choices=['binary', 'text', 'segment', 'hdf5', 'compressed'], required=False)
     parser.add_argument('--role', nargs='*', help='Prefix to data directory for multiple DAQs Defaults to MASTER/SLAVE', required=False)
     parser.add_argument('-s', '--script', help='Run from script (Will not ask for user input)', action='store_true')
     parser.add_argument('-i', '--interactive', help='Interactive time', action='store_true')
     parser.add_argument('--display', help='Display each plot as they are created -- this will pause execution until the plot is closed', action='store_true')
     parser.add_argument('--pickle', help='By default, figures are NOT pickled (allowing user to look at plots interactively later)', action='store_true')
     parser.add_argument('--mat', help='By default, figures are NOT accompanied by a .mat that includes all the data that went into the figure', action='store_true')
+    parser.add_argument('--mat-iso', help='Same as --mat but the .mat is written with scipy (version 5, the whole window in memory) with an ISO 8601 string for every sample', action='store_true')
+    parser.add_argument('--batch', help='Plot every --role, --channels and --window-sec window in parallel worker processes', action='store_true')
+    parser.add_argument('--channels', nargs='*', help='Channels to plot in --batch mode (defaults to --channel)', required=False, type=int)
+    parser.add_argument('--window-sec', help='Split the time window into figures of this many seconds in --batch mode (default one figure)', required=False, type=float)
+    parser.add_argument('--workers', help='Worker processes for --batch mode (defaults to the number of CPUs)', required=False, type=int)
+    parser.add_argument('--tiles', help='Plot from the spectrogram tiles made by build_specgram_tiles.py when they cover the window', action='store_true')
+    parser.add_argument('--max-columns', help='Average spectrogram columns so a window is at most this wide (0 keeps every column)', required=False, type=int)
     parser.set_defaults(postfix='long_duration',
                         channel=0, 
                         sample_rate=19200,
@@ -30,8 +37,12 @@ def get_specgram_bounded_args():
                         start=None,
                         end=None,
                         mode='text',
+                        max_columns=4096,
                         role=['MASTER', 'SLAVE'])
     args = parser.parse_args()
+    # --mat-iso only changes how the .mat is written
+    if args.mat_iso:
+        args.mat = True
     # if user has run with script flag make sure needed values are set
     if args.script:
         args.interactive = False # just incase. There is probably a cleaner way to do this
@@ -58,6 +69,32 @@ def get_specgram_bounded_args():
     return(args)
 
 
+def get_build_specgram_tiles_args():
+    parser = argparse.ArgumentParser(description='Build the spectrogram tiles specgram_bounded.py --tiles plots from', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--channels', nargs='*', help='Channels to build tiles for', required=False, type=int)
+    parser.add_argument('--sample-rate', help='Sample rate in Hz', required=False, type=int)
+    parser.add_argument('--nfft', help='NFFT', required=False, type=int)
+    parser.add_argument('--file-length-sec', help='Duration of each data file', required=False, type=float)
+    parser.add_argument('--data-directory', help='Root directory for the data', required=True)
+    parser.add_argument('--start', help='Start time (defaults to the first data file)', required=False, type=lambda s: datetime.datetime.strptime(s, '%Y-%m-%d %H:%M:%S'))
+    parser.add_argument('--end', help='End time (defaults to the end of the last data file)', required=False, type=lambda s: datetime.datetime.strptime(s, '%Y-%m-%d %H:%M:%S'))
+    parser.add_argument('--mode', help='Data output mode', choices=['binary', 'text', 'segment', 'hdf5', 'compressed'], required=False)
+    parser.add_argument('--role', nargs='*', help='Prefix to data directory for multiple DAQs Defaults to MASTER/SLAVE', required=False)
+    parser.add_argument('--rebuild', help='Rebuild tiles that already exist', action='store_true')
+    parser.add_argument('-s', '--script', help='Run from script (Will not ask for user input)', action='store_true')
+    parser.set_defaults(channels=[0],
+                        sample_rate=19200,
+                        nfft=256,
+                        file_length_sec=1.0,
+                        start=None,
+                        end=None,
+                        mode='text',
+                        role=['MASTER', 'SLAVE'])
+    args = parser.parse_args()
+    # turn data_directory into pathlib obj
+    args.data_directory = pathlib.Path(args.data_directory)
+    return(args)
+
 def get_postion_bounded_args():
     parser = argparse.ArgumentParser(description='', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--postfix', help='Postfix for fig directory', required=False, type=str)
@@ -0,0 +1,199 @@
+#
+# Woods Hole Oceanographic Institution
+# Author: Caileigh Fitzgerald
+# Email:  cfitzgerald@whoi.edu
+# Date:   06/20/2020
+#
+# File: daq_coordinator.py
+#
+# Runs any number of chained DAQs off one acquisition clock.
+#
+import os
+import contextlib
+from datetime import datetime
+from uldaq import DaqDevice, AInScanFlag, ScanOption, create_float_buffer
+from async_daq_data_handler5 import AsyncDAQDataHandler
+from _async_multi_daq_data_handler import AsyncDAQDataHandler as AsyncMultiDAQDataHandler
+from daq_utils import config_ai_device, config_daq, display_scan_options, get_scaling
+from scan_clock import ScanClock
+
+# the MASTER paces every device, the others sample on its clock
+MASTER_SCAN_OPTIONS = ScanOption.CONTINUOUS | ScanOption.PACEROUT
+SLAVE_SCAN_OPTIONS  = ScanOption.EXTCLOCK | ScanOption.CONTINUOUS
+# seconds of data each DAQ ring buffer holds
+BUFFER_LENGTH_SEC   = 30
+
+def get_roles(device_count):
+    """MASTER first, then SLAVE (two devices) or SLAVE1, SLAVE2, .. (more)."""
+    if device_count == 2:
+        return(['MASTER', 'SLAVE'])
+    return(['MASTER'] + ['SLAVE{}'.format(i) for i in range(1, device_count)])
+
+def get_role_dir(data_directory, role):
+    role_dir = os.path.abspath('{}/{}_DAQ'.format(data_directory, role))
+    if not os.path.exists(role_dir):
+        os.makedirs(role_dir)
+    return(role_dir)
+
+class DAQCoordinator(object):
+    """Starts N chained DAQs and the writers that record them.
+
+    The first device is the MASTER (PACEROUT), every other device is a slave
+    on its clock (EXTCLOCK), so row n of every ring buffer was sampled at the
+    same time. Writers are either one AsyncDAQDataHandler per role (role
+    directories, one writer thread each) or, with merged=True, a single
+    writer that puts every channel side by side in a MULTI_DAQ directory.
+    All writers share the MASTER start time and one ScanClock (one sample
+    clock, so a row gets the same time in every directory) and are started
+    and stopped together.
+
+    Use it as a context manager so every device is disconnected on exit.
+    """
+    def __init__(self, device_descriptors,
+                       channels_per_device,
+                       sample_rate,
+                       file_length_sec,
+                       data_directory,
+                       merged=False,
+                       raw_counts=False,
+                       **writer_kwargs):
+        super(DAQCoordinator, self).__init__()
+        if len(device_descriptors) < 2:
+            raise ValueError('A coordinator needs at least 2 devices, use single_DAQ_collect.py for one')
+        # the writers would refuse this, but only after the scans are running
+        if raw_counts and writer_kwargs.get('file_mode', 'text') == 'text':
+            raise ValueError('Raw counts can not be written in text mode, use a binary file mode')
+        self.roles               = get_roles(len(device_descriptors))
+        self.descriptors         = dict(zip(self.roles, device_descriptors))
+        self.channels_per_device = int(channels_per_device)
+        self.sample_rate         = sample_rate
+        self.file_length_sec     = float(file_length_sec)
+        self.data_directory      = data_directory
+        self.merged              = merged
+        self.raw_counts          = raw_counts
+        # file_mode, compression, .. passed through to every writer
+        self.writer_kwargs       = writer_kwargs
+        self.samples_per_channel = int(sample_rate) * BUFFER_LENGTH_SEC
+        self.flags               = AInScanFlag.NOSCALEDATA if raw_counts else AInScanFlag.DEFAULT
+        self.scan_options        = {r:(MASTER_SCAN_OPTIONS if r == 'MASTER' else SLAVE_SCAN_OPTIONS) for r in self.roles}
+
+        self.daq_device    = {r:None for r in self.roles}
+        self.ai_device     = {r:None for r in self.roles}
+        self.ai_info       = {r:None for r in self.roles}
+        self.input_mode    = {r:None for r in self.roles}
+        self.channel_count = {r:None for r in self.roles}
+        self.v_range       = {r:None for r in self.roles}
+        self.data          = {r:None for r in self.roles}
+        self.rate          = {r:None for r in self.roles}
+        self.writers       = []
+        self.start_time    = None
+        self.clock         = None
+        self._exit_stack   = contextlib.ExitStack()
+
+    def __enter__(self):
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        # disconnects every device connected in connect()
+        self._exit_stack.close()
+
+    def connect(self):
+        for r in self.roles:
+            self.daq_device[r] = self._exit_stack.enter_context(DaqDevice(self.descriptors[r]))
+            # configure the ai_device with the daq_device instance
+            self.ai_device[r], self.ai_info[r] = config_ai_device(daq_device=self.daq_device[r])
+            # finish configuring the options for the daq_device instance
+            self.input_mode[r], self.channel_count[r], self.v_range[r] = config_daq(daq_device=self.daq_device[r],
+                                                                                   ai_info=self.ai_info[r],
+                                                                                   channel_range=(0, self.channels_per_device-1))
+            # Allocate a buffer to receive the data.
+            self.data[r] = create_float_buffer(self.channel_count[r], self.samples_per_channel)
+
+    def start_scan(self, r):
+        self.rate[r] = self.ai_device[r].a_in_scan(0,
+                                                   self.channel_count[r]-1,
+                                                   self.input_mode[r],
+                                                   self.v_range[r],
+                                                   self.samples_per_channel,
+                                                   self.sample_rate,
+                                                   self.scan_options[r],
+                                                   self.flags,
+                                                   self.data[r])
+
+    def start(self):
+        """Connect, start the scans and the writers. Returns the start time (epoch)."""
+        self.connect()
+        # every slave waits for the MASTER's clock, so start them first
+        for r in self.roles[1:]:
+            self.start_scan(r)
+        pre_call  = datetime.now()
+        self.start_scan('MASTER')
+        post_call = datetime.now()
+        # average times from pre scan start and post scan start
+        self.start_time = (pre_call.timestamp() + post_call.timestamp()) / 2
+
+        self.create_writers()
+        # the points of the shared clock are kept with the MASTER data
+        self.clock = ScanClock(self.sample_rate, self.start_time,
+                               '{}/MASTER_clock.csv'.format(get_role_dir(self.data_directory, 'MULTI' if self.merged else 'MASTER')))
+        for writer in self.writers:
+            writer.begin(self.start_time, clock=self.clock)
+        return(self.start_time)
+
+    def get_scaling(self, r):
+        return(get_scaling(self.v_range[r], self.ai_info[r]) if self.raw_counts else None)
+
+    def create_writers(self):
+        if self.merged:
+            self.writers.append(AsyncMultiDAQDataHandler(float_buffers=self.data,
+                                                         ai_devices_dict=self.ai_device,
+                                                         role_write_order=self.roles,
+                                                         file_length_sec=self.file_length_sec,
+                                                         channel_counts=self.channel_count,
+                                                         data_dir=get_role_dir(self.data_directory, 'MULTI'),
+                                                         sample_rate=self.sample_rate,
+                                                         scan_options={r:display_scan_options(self.scan_options[r]) for r in self.roles},
+                                                         v_ranges=self.v_range,
+                                                         input_modes=self.input_mode,
+                                                         flags={r:self.flags for r in self.roles},
+                                                         # every device is the same model on the same range
+                                                         scaling=self.get_scaling('MASTER'),
+                                                         **self.writer_kwargs))
+            return
+        for r in self.roles:
+            self.writers.append(AsyncDAQDataHandler(float_buffer=self.data[r],
+                                                    role=r,
+                                                    ai_device=self.ai_device[r],
+                                                    channel_count=self.channel_count[r],
+                                                    data_dir=get_role_dir(self.data_directory, r),
+                                                    sample_rate=self.sample_rate,
+                                                    scan_options=display_scan_options(self.scan_options[r]),
+                                                    v_range=self.v_range[r],
+                                                    input_mode=self.input_mode[r],
+                                                    flags=self.flags,
+                                                    file_length=self.file_length_sec,
+                                                    scaling=self.get_scaling(r),
+                                                    **self.writer_kwargs))
+
+    def get_scan_status(self):
+        """{role: (status, transfer_status)} for every device."""
+        return({r:self.ai_device[r].get_scan_status() for r in self.roles if self.ai_device[r] is not None})
+
+    def get_total_channels(self):
+        return(sum(self.channel_count[r] for r in self.roles if self.channel_count[r] is not None))
+
+    def stop(self):
+        for writer in self.writers:
+            writer.stop()
+        for writer in self.writers:
+            # writers finish the blocks they already copied out
+            writer.t.join()
+        self.writers = []
+        if self.clock is not None:
+            self.clock.close()
+        # stop the MASTER clock first so the slaves stop on the same row
+        for r in self.roles:
+            if self.rate[r] is not None:
+                self.ai_device[r].scan_stop()
+                self.rate[r] = None
@@ -2,6 +2,7 @@ from uldaq import (get_daq_device_inventory, DaqDevice, AInScanFlag, ScanStatus,
                    ScanOption, create_float_buffer, InterfaceType, AiInputMode, ULException)
 import time
 import os
+import re
 import sys
 import prompt_utils
 from prompt_utils import (daq_validator, 
@@ -138,6 +139,16 @@ def config_daq_options_master_slave(interface_type, script=False, master_id=None
 
     return(selected_devices)
 
+def config_daq_options_chain(interface_type, device_ids):
+    """Return the descriptors for device_ids in order (first is the clock MASTER)."""
+    devices = {d.unique_id: d for d in get_daq_device_inventory(interface_type)}
+    if len(devices) == 0:
+        raise RuntimeError('Error: No DAQ devices found')
+    missing = [device_id for device_id in device_ids if device_id not in devices]
+    if len(missing):
+        raise RuntimeError('Error: Could not find DAQ device(s): {}'.format(', '.join(missing)))
+    return([devices[device_id] for device_id in device_ids])
+
 def config_daq_options(interface_type, script=False):
     # Get descriptors for all of the available DAQ devices.
     # import ipdb; ipdb.set_trace() # BREAKPOINT
@@ -201,7 +212,28 @@ def config_daq(daq_device, ai_info, channel_range):
 
     return(input_mode, channel_count, ranges[range_index])
 
-def create_output_str(transfer_status, rate, scans_run=None, trig_mode=None, role=None):
+def get_range_limits(v_range):
+    """Return (v_min, v_max) for a voltage Range, e.g. BIP1PT25VOLTS -> (-1.25, 1.25)."""
+    match = re.match(r'^(BIP|UNI)(\d*)(?:PT(\d+))?VOLTS$', v_range.name)
+    if match is None:
+        raise ValueError('Can not get the voltage limits of range {}'.format(v_range.name))
+    polarity, whole, fraction = match.groups()
+    v_max = float('{}.{}'.format(whole or '0', fraction or '0'))
+    return((-v_max if polarity == 'BIP' else 0.0, v_max))
+
+def get_scaling(v_range, ai_info):
+    """Everything needed to turn raw (NOSCALEDATA) counts into volts later."""
+    v_min, v_max = get_range_limits(v_range)
+    return({
+        'v_range':    v_range.name,
+        'v_min':      v_min,
+        'v_max':      v_max,
+        'resolution': ai_info.get_resolution(),
+        # NOSCALEDATA still applies the device calibration to the counts
+        'calibrated': True,
+    })
+
+def create_output_str(transfer_status, rate, scans_run=None, trig_mode=None, role=None, raw_counts=False):
     # Build output string
     output_str = []
     if role is None:
@@ -217,7 +249,8 @@ def create_output_str(transfer_status, rate, scans_run=None, trig_mode=None, rol
         output_str.append('<b>CurrentTotalCount =</b> {}'.format(transfer_status.current_total_count))
         output_str.append('<b>CurrentIndex      =</b> {}'.format(transfer_status.current_index))
     output_str.append('<b>-------------------------</b>')
-    output_str.append('<b>Channel     | <red>Raw Voltage</red></b>')
+    # AInScanFlag.NOSCALEDATA scans hold ADC counts, not volts
+    output_str.append('<b>Channel     | <red>{}</red></b>'.format('Raw Counts' if raw_counts else 'Raw Voltage'))
     output_str.append('<b>-------------------------</b>')
     return(output_str)
 
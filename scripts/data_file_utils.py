@@ -0,0 +1,766 @@
+#
+# Woods Hole Oceanographic Institution
+# Author: Caileigh Fitzgerald
+# Email:  cfitzgerald@whoi.edu
+# Date:   06/20/2020
+#
+# File: data_file_utils.py
+#
+# Helpers shared by the DAQ data writers and the plotting scripts
+# .. for naming, writing and reading data files.
+#
+import os
+import csv
+import pathlib
+import json
+import zlib
+import struct
+import functools
+import time
+import numpy as np
+try:
+    # only needed for 'hdf5' mode
+    import h5py
+except ImportError:
+    h5py = None
+try:
+    # only needed for 'lz4' compression
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    # only needed for 'zstd' compression
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    # optional, parses text data files faster than np.loadtxt
+    import pandas
+except ImportError:
+    pandas = None
+
+# Binary data files are .npy files holding a (rows, channels) array.
+# .. little-endian float32 keeps the full resolution of the 16-bit ADC
+# .. at a quarter of the size of the text files
+BINARY_DTYPE = '<f4'
+# Raw ADC counts (AInScanFlag.NOSCALEDATA) are stored as little-endian uint16
+# .. SCALING_FILENAME next to the data holds what is needed to turn them into volts
+RAW_COUNT_DTYPE = '<u2'
+SCALING_FILENAME = 'scaling.json'
+TEXT_VALUE_FORMAT = '%.12f'
+FILE_EXTENSIONS = {
+    'text':    '.txt',
+    'binary':  '.npy',
+    'segment': '.seg',
+    'hdf5':    '.h5',
+    'compressed': '.dqz',
+}
+# modes that keep a whole session in a few large files instead of a file per block
+ARCHIVE_MODES = ['segment', 'hdf5']
+# Directories of per-block files keep the sorted start times of their files in
+# .. '<mode>_file_index.csv' (one epoch per line, the file name without extension)
+FILE_INDEX_FILENAME = '{}_file_index.csv'
+# Segment files hold many file-length blocks back to back (raw BINARY_DTYPE rows)
+# .. SEGMENT_INDEX maps the start time of every block to its place in a segment
+SEGMENT_LENGTH_SEC = 60 * 60
+SEGMENT_INDEX = 'segment_index.csv'
+SEGMENT_INDEX_FIELDS = ['start_epoch', 'segment', 'row_offset', 'rows']
+# HDF5 archives hold one dataset of rows per role plus a '<role>_blocks' dataset
+# .. of (start_epoch, row_offset, rows) for every block appended
+HDF5_COMPRESSION = [None, 'gzip', 'lzf']
+# MATLAB v7.3 .mat files are HDF5 files behind a 512 byte user block that
+# .. starts with MATLAB's 128 byte header (text, version 0x0200, 'IM' endian check)
+MAT_USERBLOCK_SIZE = 512
+MAT_HEADER_TEXT = 'MATLAB 7.3 MAT-file, Platform: GLNXA64, Created on: {} HDF5 schema 1.00 .'
+# long vectors are appended in chunks of this many values
+MAT_CHUNK_VALUES = 1 << 16
+MAT_CLASSES = {
+    np.dtype('float64'): 'double',
+    np.dtype('float32'): 'single',
+    np.dtype('int8'):    'int8',
+    np.dtype('uint8'):   'uint8',
+    np.dtype('int16'):   'int16',
+    np.dtype('uint16'):  'uint16',
+    np.dtype('int32'):   'int32',
+    np.dtype('uint32'):  'uint32',
+    np.dtype('int64'):   'int64',
+    np.dtype('uint64'):  'uint64',
+    np.dtype('bool'):    'logical',
+}
+# Compressed data files (.dqz) are a small JSON header (dtype, shape, codec, filter)
+# .. followed by the filtered and compressed rows
+DQZ_MAGIC = b'DQZ1'
+COMPRESSION_CODECS  = ['gzip', 'lz4', 'zstd']
+COMPRESSION_FILTERS = ['none', 'shuffle', 'delta']
+# favour speed over ratio, the writer has to keep up with the DAQ
+GZIP_LEVEL = 1
+ZSTD_LEVEL = 3
+
+def get_file_extension(mode):
+    try:
+        return(FILE_EXTENSIONS[mode])
+    except KeyError:
+        raise ValueError('Unknown file mode \"{}\" (expected one of: {})'.format(mode, ', '.join(FILE_EXTENSIONS)))
+
+def get_data_filename(data_dir, start_time, mode='text'):
+    return(os.path.join(data_dir, '{:.6f}{}'.format(float(start_time), get_file_extension(mode))))
+
+@functools.lru_cache(maxsize=4)
+def get_text_template(row_count, channel_count):
+    # one printf style template for a whole file
+    # .. every file in a session has the same shape so this is built once
+    row_template = ','.join([TEXT_VALUE_FORMAT] * channel_count) + '\n'
+    return(row_template * row_count)
+
+def format_text_rows(rows):
+    rows = np.asarray(rows, dtype=np.float64)
+    if rows.ndim == 1:
+        rows = rows.reshape(-1, 1)
+    # a single % call formats every value in C instead of one format() per value
+    return(get_text_template(*rows.shape) % tuple(rows.ravel().tolist()))
+
+def write_text_file(file_name, rows):
+    output = format_text_rows(rows)
+    with open(file_name, 'w') as f:
+        f.write(output)
+
+def write_binary_file(file_name, rows, dtype=BINARY_DTYPE):
+    with open(file_name, 'wb') as f:
+        np.save(f, np.asarray(rows, dtype=dtype), allow_pickle=False)
+
+def compress_bytes(payload, codec):
+    if codec == 'gzip':
+        return(zlib.compress(payload, GZIP_LEVEL))
+    elif codec == 'lz4':
+        if lz4 is None:
+            raise RuntimeError('lz4 compression needs the lz4 package (pip install lz4)')
+        return(lz4.frame.compress(payload))
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstd compression needs the zstandard package (pip install zstandard)')
+        return(zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(payload))
+    raise ValueError('Unknown compression codec \"{}\" (expected one of: {})'.format(codec, ', '.join(COMPRESSION_CODECS)))
+
+def decompress_bytes(payload, codec):
+    if codec == 'gzip':
+        return(zlib.decompress(payload))
+    elif codec == 'lz4':
+        if lz4 is None:
+            raise RuntimeError('lz4 compression needs the lz4 package (pip install lz4)')
+        return(lz4.frame.decompress(payload))
+    elif codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstd compression needs the zstandard package (pip install zstandard)')
+        return(zstandard.ZstdDecompressor().decompress(payload))
+    raise ValueError('Unknown compression codec \"{}\" (expected one of: {})'.format(codec, ', '.join(COMPRESSION_CODECS)))
+
+def check_compression(codec, compression_filter, dtype):
+    if codec not in COMPRESSION_CODECS:
+        raise ValueError('Unknown compression codec \"{}\" (expected one of: {})'.format(codec, ', '.join(COMPRESSION_CODECS)))
+    if compression_filter not in COMPRESSION_FILTERS:
+        raise ValueError('Unknown compression filter \"{}\" (expected one of: {})'.format(compression_filter, ', '.join(COMPRESSION_FILTERS)))
+    if compression_filter == 'delta' and np.dtype(dtype).kind not in 'iu':
+        raise ValueError('The delta filter is only lossless for integer data, not {}'.format(np.dtype(dtype)))
+
+#
+# Filters rearrange the rows so they compress better and are undone exactly on read
+# .. shuffle: group the 1st byte of every value, then the 2nd, .. (helps floats)
+# .. delta:   store each row as the difference from the row before (integer counts)
+def apply_filter(rows, compression_filter):
+    if compression_filter == 'shuffle':
+        return(rows.reshape(-1).view(np.uint8).reshape(-1, rows.dtype.itemsize).T.tobytes())
+    elif compression_filter == 'delta':
+        deltas = rows.copy()
+        # integer wrap around is fine, cumsum in the same dtype wraps it back
+        deltas[1:] -= rows[:-1]
+        return(deltas.tobytes())
+    return(rows.tobytes())
+
+def undo_filter(payload, compression_filter, dtype, shape):
+    if compression_filter == 'shuffle':
+        values = np.frombuffer(payload, dtype=np.uint8).reshape(dtype.itemsize, -1).T.copy().view(dtype)
+        return(values.reshape(shape))
+    values = np.frombuffer(payload, dtype=dtype).reshape(shape)
+    if compression_filter == 'delta':
+        return(np.cumsum(values, axis=0, dtype=dtype))
+    return(values)
+
+def write_compressed_file(file_name, rows, codec='gzip', compression_filter='shuffle', dtype=BINARY_DTYPE):
+    rows = np.ascontiguousarray(rows, dtype=dtype)
+    header = json.dumps({
+        'dtype':  rows.dtype.str,
+        'shape':  rows.shape,
+        'codec':  codec,
+        'filter': compression_filter,
+    }).encode()
+    payload = compress_bytes(apply_filter(rows, compression_filter), codec)
+    with open(file_name, 'wb') as f:
+        f.write(DQZ_MAGIC + struct.pack('<I', len(header)) + header + payload)
+
+def read_compressed_file(file_name):
+    with open(file_name, 'rb') as f:
+        contents = f.read()
+    if contents[:len(DQZ_MAGIC)] != DQZ_MAGIC:
+        raise ValueError('{} is not a compressed data file'.format(file_name))
+    header_start = len(DQZ_MAGIC) + 4
+    header_length = struct.unpack('<I', contents[len(DQZ_MAGIC):header_start])[0]
+    header = json.loads(contents[header_start:header_start + header_length].decode())
+    payload = decompress_bytes(contents[header_start + header_length:], header['codec'])
+    return(undo_filter(payload, header['filter'], np.dtype(header['dtype']), tuple(header['shape'])))
+
+def write_data_file(file_name, rows, mode='text', codec='gzip', compression_filter='shuffle', dtype=BINARY_DTYPE):
+    if mode == 'binary':
+        write_binary_file(file_name, rows, dtype=dtype)
+    elif mode == 'compressed':
+        write_compressed_file(file_name, rows, codec=codec, compression_filter=compression_filter, dtype=dtype)
+    elif mode == 'text':
+        write_text_file(file_name, rows)
+    else:
+        raise ValueError('Unknown file mode \"{}\"'.format(mode))
+
+#
+# This method returns a (rows, channels) array for any data file
+# .. the format is picked from the file extension
+def read_data_file(file_name):
+    if str(file_name).endswith(FILE_EXTENSIONS['binary']):
+        return(np.load(file_name, allow_pickle=False))
+    elif str(file_name).endswith(FILE_EXTENSIONS['compressed']):
+        return(read_compressed_file(file_name))
+    return(np.loadtxt(file_name, delimiter=',', ndmin=2))
+
+#
+# This method returns a (rows, len(channels)) array of the selected channels
+# .. of any data file, only those columns are parsed or copied
+def read_file_channels(file_name, channels):
+    channels = list(channels)
+    if str(file_name).endswith(FILE_EXTENSIONS['binary']):
+        return(np.load(file_name, mmap_mode='r', allow_pickle=False)[:, channels])
+    elif str(file_name).endswith(FILE_EXTENSIONS['compressed']):
+        return(read_compressed_file(file_name)[:, channels])
+    if pandas is not None:
+        # usecols keeps file order, index again for the order asked for
+        frame = pandas.read_csv(file_name, header=None, usecols=channels, dtype=np.float64, engine='c')
+        return(frame[channels].to_numpy())
+    return(np.loadtxt(file_name, delimiter=',', usecols=channels, ndmin=2))
+
+def read_data_files(files, channels, scaling=None, dtype=np.float64):
+    """Read the selected channels of files, in order, into one (rows, len(channels)) array.
+
+    The array is allocated once for len(files) files the size of the first
+    one (and grown if a file is longer), every file is copied straight into
+    its rows. Raw counts are scaled to volts a file at a time with scaling.
+    """
+    channels = list(channels)
+    if len(files) == 0:
+        return(np.empty((0, len(channels)), dtype=dtype))
+    data = None
+    rows_read = 0
+    for i, file_name in enumerate(files):
+        rows = counts_to_volts(read_file_channels(file_name, channels), scaling)
+        if data is None:
+            data = np.empty((len(files) * len(rows), len(channels)), dtype=dtype)
+        elif rows_read + len(rows) > len(data):
+            # a longer file than the first, make room for the rest at this size
+            grown = np.empty((rows_read + len(rows) * (len(files) - i), len(channels)), dtype=dtype)
+            grown[:rows_read] = data[:rows_read]
+            data = grown
+        data[rows_read:rows_read + len(rows)] = rows
+        rows_read += len(rows)
+    return(data[:rows_read])
+
+def get_scaling_filename(data_dir):
+    return(os.path.join(data_dir, SCALING_FILENAME))
+
+def write_scaling_file(data_dir, scaling):
+    with open(get_scaling_filename(data_dir), 'w') as f:
+        json.dump(scaling, f, indent=4)
+
+#
+# This method returns the scaling written next to raw count data
+# .. or None if the data in data_dir is already in volts
+@functools.lru_cache(maxsize=32)
+def load_scaling(data_dir):
+    scaling_filename = get_scaling_filename(data_dir)
+    if not os.path.exists(scaling_filename):
+        return(None)
+    with open(scaling_filename, 'r') as f:
+        return(json.load(f))
+
+#
+# This method converts raw ADC counts to volts
+# .. counts span [v_min, v_max) in 2**resolution steps
+def counts_to_volts(counts, scaling):
+    if scaling is None:
+        return(counts)
+    lsb = (scaling['v_max'] - scaling['v_min']) / float(2 ** scaling['resolution'])
+    return(scaling['v_min'] + np.asarray(counts, dtype=np.float64) * lsb)
+
+def get_file_index_filename(data_dir, mode='text'):
+    return(os.path.join(data_dir, FILE_INDEX_FILENAME.format(mode)))
+
+#
+# This method adds a data file to the index of its directory, writers call
+# .. it after every file so readers never have to list the directory
+def append_file_index(data_dir, start_time, mode='text'):
+    with open(get_file_index_filename(data_dir, mode), 'a') as f:
+        f.write('{:.6f}\n'.format(float(start_time)))
+
+def scan_file_index(data_dir, mode='text'):
+    """List data_dir and return the sorted start times of its mode files."""
+    extension = get_file_extension(mode)
+    with os.scandir(data_dir) as entries:
+        epochs = [entry.name[:-len(extension)] for entry in entries
+                  if entry.name.startswith('1') and entry.name.endswith(extension)]
+    return(np.sort(np.array(epochs, dtype=np.float64)))
+
+def build_file_index(data_dir, mode='text'):
+    """List data_dir and write the start times of its mode files to the index.
+
+    The listing is returned even when the index can't be written (a read
+    only archive). A writer can add a file while the directory is listed and
+    append it to the index that is about to be replaced, so the directory is
+    listed again after the rename: only if nothing changed is the index
+    stamped with the directory's time, otherwise it is stamped just before
+    it so the next reader rebuilds it.
+    """
+    epochs = scan_file_index(data_dir, mode)
+    index_filename = get_file_index_filename(data_dir, mode)
+    try:
+        with open(index_filename + '.tmp', 'w') as f:
+            f.write(''.join('{:.6f}\n'.format(epoch) for epoch in epochs))
+        os.replace(index_filename + '.tmp', index_filename)
+    except OSError:
+        return(epochs)
+    dir_mtime = os.stat(data_dir).st_mtime_ns
+    rescan    = scan_file_index(data_dir, mode)
+    # the rename touched the directory, the index is current up to the listing
+    # .. after it (file times are too coarse to leave a stale index to chance)
+    index_mtime = dir_mtime if np.array_equal(rescan, epochs) else dir_mtime - 1
+    try:
+        os.utime(index_filename, ns=(index_mtime, index_mtime))
+    except OSError:
+        pass
+    return(rescan)
+
+#
+# This method returns the sorted start times of the mode files in data_dir.
+# .. The index is rebuilt if it is missing or the directory changed after it
+# .. was last written (files copied in by hand or from an older writer)
+def load_file_index(data_dir, mode='text'):
+    index_filename = get_file_index_filename(data_dir, mode)
+    if not os.path.exists(index_filename) or os.stat(data_dir).st_mtime_ns > os.stat(index_filename).st_mtime_ns:
+        return(build_file_index(data_dir, mode))
+    with open(index_filename, 'r') as f:
+        epochs = np.array(f.read().split(), dtype=np.float64)
+    # sessions append in order, sort anyway in case two writers shared the directory
+    # .. (and drop a file a writer appended to an index that was being rebuilt)
+    if np.any(epochs[1:] <= epochs[:-1]):
+        epochs = np.unique(epochs)
+    return(epochs)
+
+class DataFileIndex(object):
+    """Sorted data files of one directory, found by start time without listing it.
+
+    Behaves like the sorted list of pathlib.Paths that glob would return and
+    get_window() finds the files starting inside a time window with a binary
+    search of the start times.
+    """
+    def __init__(self, data_dir, mode='text'):
+        super(DataFileIndex, self).__init__()
+        self.data_dir = str(data_dir)
+        self.mode     = mode
+        self.epochs   = load_file_index(self.data_dir, mode)
+
+    def __len__(self):
+        return(len(self.epochs))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return([self.get_path(epoch) for epoch in self.epochs[i]])
+        return(self.get_path(self.epochs[i]))
+
+    def __iter__(self):
+        return(iter(self[:]))
+
+    def get_path(self, epoch):
+        return(pathlib.Path(get_data_filename(self.data_dir, epoch, mode=self.mode)))
+
+    def get_window(self, start_t, end_t):
+        """Paths of the files that start in [start_t, end_t]."""
+        first = np.searchsorted(self.epochs, start_t, side='left')
+        last  = np.searchsorted(self.epochs, end_t, side='right')
+        return(self[first:last])
+
+class SegmentWriter(object):
+    """Writes file-length blocks into preallocated segment files.
+
+    Each segment is sized for segment_length seconds when it is created and
+    blocks are copied in through a memory map of just that block's rows.
+    Every block gets a line in SEGMENT_INDEX (start time, segment, row offset,
+    rows) and every segment gets a small .json header with its layout.
+    """
+    def __init__(self, data_dir, channel_count, sample_rate, segment_length=SEGMENT_LENGTH_SEC, dtype=BINARY_DTYPE):
+        super(SegmentWriter, self).__init__()
+        self.data_dir         = data_dir
+        self.channel_count    = int(channel_count)
+        self.sample_rate      = sample_rate
+        self.segment_length   = segment_length
+        self.rows_per_segment = int(sample_rate * segment_length)
+        self.dtype            = np.dtype(dtype)
+        self.row_bytes        = self.dtype.itemsize * self.channel_count
+        self.segment_name     = None
+        self.rows_used        = 0
+
+        index_filename = os.path.join(self.data_dir, SEGMENT_INDEX)
+        new_index = not os.path.exists(index_filename)
+        self.index = open(index_filename, 'a', newline='')
+        self.index_writer = csv.writer(self.index)
+        if new_index:
+            self.index_writer.writerow(SEGMENT_INDEX_FIELDS)
+
+    def open_segment(self, start_time):
+        self.close_segment()
+        self.segment_name = '{:.6f}{}'.format(float(start_time), FILE_EXTENSIONS['segment'])
+        self.rows_used = 0
+        with open(os.path.join(self.data_dir, self.segment_name), 'wb') as f:
+            # reserve the whole segment now (blocks, not a sparse file) so a full
+            # .. disk shows up here and not as a SIGBUS when a block is mapped in
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, self.rows_per_segment * self.row_bytes)
+            else:
+                f.truncate(self.rows_per_segment * self.row_bytes)
+        self.write_header(self.rows_per_segment)
+
+    def get_segment_path(self):
+        """Full path of the segment being written (None between segments)."""
+        if self.segment_name is None:
+            return(None)
+        return(os.path.join(self.data_dir, self.segment_name))
+
+    def write_header(self, rows):
+        header = {
+            'dtype':       self.dtype.str,
+            'channels':    self.channel_count,
+            'sample_rate': self.sample_rate,
+            'rows':        rows,
+        }
+        with open(os.path.join(self.data_dir, self.segment_name + '.json'), 'w') as f:
+            json.dump(header, f)
+
+    def close_segment(self):
+        if self.segment_name is None:
+            return
+        # drop the unused tail so the file size (and header) match the rows in the index
+        with open(os.path.join(self.data_dir, self.segment_name), 'r+b') as f:
+            f.truncate(self.rows_used * self.row_bytes)
+        self.write_header(self.rows_used)
+        self.segment_name = None
+
+    def write(self, start_time, rows):
+        rows = np.asarray(rows)
+        if len(rows) > self.rows_per_segment:
+            # a block longer than a segment is split over as many as it needs
+            for first_row in range(0, len(rows), self.rows_per_segment):
+                self.write(float(start_time) + first_row / float(self.sample_rate), rows[first_row:first_row + self.rows_per_segment])
+            return
+        if self.segment_name is None or self.rows_used + len(rows) > self.rows_per_segment:
+            self.open_segment(start_time)
+
+        block = np.memmap(os.path.join(self.data_dir, self.segment_name),
+                          dtype=self.dtype,
+                          mode='r+',
+                          offset=self.rows_used * self.row_bytes,
+                          shape=rows.shape)
+        block[:] = rows
+        block.flush()
+        del block
+
+        self.index_writer.writerow(['{:.6f}'.format(float(start_time)), self.segment_name, self.rows_used, len(rows)])
+        self.index.flush()
+        self.rows_used += len(rows)
+
+    def close(self):
+        self.close_segment()
+        self.index.close()
+
+def load_segment_index(data_dir):
+    """Return the SEGMENT_INDEX entries for data_dir sorted by start time."""
+    with open(os.path.join(data_dir, SEGMENT_INDEX), 'r', newline='') as f:
+        entries = [(float(row['start_epoch']), row['segment'], int(row['row_offset']), int(row['rows']))
+                   for row in csv.DictReader(f)]
+    return(sorted(entries))
+
+def read_segment_block(data_dir, segment, row_offset, rows):
+    with open(os.path.join(data_dir, segment + '.json'), 'r') as f:
+        header = json.load(f)
+    dtype = np.dtype(header['dtype'])
+    return(np.memmap(os.path.join(data_dir, segment),
+                     dtype=dtype,
+                     mode='r',
+                     offset=row_offset * dtype.itemsize * header['channels'],
+                     shape=(rows, header['channels'])))
+
+#
+# This method returns the rows of every block that starts inside
+# .. [start_t, end_t] as one (rows, channels) array plus the start time
+# .. of its first row (None if there are no blocks in the window)
+def read_segment_window(data_dir, start_t, end_t):
+    blocks = [entry for entry in load_segment_index(data_dir) if start_t <= entry[0] <= end_t]
+    if len(blocks) == 0:
+        return(None, None)
+    data = np.concatenate([read_segment_block(data_dir, *entry[1:]) for entry in blocks])
+    return(blocks[0][0], data)
+
+#
+# This method groups blocks (index entries sorted by start time, start first)
+# .. into runs that start within block_sec of the first block of the run
+def split_blocks(blocks, block_sec):
+    piece = []
+    for block in blocks:
+        if len(piece) and block[0] >= piece[0][0] + block_sec:
+            yield(piece)
+            piece = []
+        piece.append(block)
+    if len(piece):
+        yield(piece)
+
+def map_segment(data_dir, segment):
+    """Read only memory map of every row in a segment file, (rows, channels)."""
+    with open(os.path.join(data_dir, segment + '.json'), 'r') as f:
+        header = json.load(f)
+    dtype     = np.dtype(header['dtype'])
+    filename  = os.path.join(data_dir, segment)
+    row_bytes = dtype.itemsize * header['channels']
+    return(np.memmap(filename, dtype=dtype, mode='r', shape=(os.path.getsize(filename) // row_bytes, header['channels'])))
+
+def get_hdf5_filename(data_dir, role):
+    return(os.path.join(data_dir, '{}{}'.format(role, FILE_EXTENSIONS['hdf5'])))
+
+def has_h5py():
+    return(h5py is not None)
+
+def check_h5py(needed_by='The hdf5 file mode'):
+    if h5py is None:
+        raise RuntimeError('{} needs h5py (pip install h5py)'.format(needed_by))
+
+class HDF5Writer(object):
+    """Appends file-length blocks to a chunked HDF5 dataset for one role.
+
+    The dataset is chunked one block at a time so a time window can be read
+    back without touching the rest of the archive. A new session appends to
+    an existing archive.
+    """
+    def __init__(self, data_dir, role, channel_count, sample_rate, rows_per_block, compression=None, dtype=BINARY_DTYPE):
+        super(HDF5Writer, self).__init__()
+        check_h5py()
+        if compression not in HDF5_COMPRESSION:
+            raise ValueError('Unknown HDF5 compression \"{}\"'.format(compression))
+        self.role     = role
+        self.filename = get_hdf5_filename(data_dir, role)
+        self.h5       = h5py.File(self.filename, 'a')
+
+        if self.role in self.h5:
+            self.data   = self.h5[self.role]
+            self.blocks = self.h5['{}_blocks'.format(self.role)]
+        else:
+            self.data = self.h5.create_dataset(self.role,
+                                               shape=(0, int(channel_count)),
+                                               maxshape=(None, int(channel_count)),
+                                               chunks=(int(rows_per_block), int(channel_count)),
+                                               dtype=dtype,
+                                               compression=compression)
+            self.data.attrs['sample_rate'] = sample_rate
+            self.data.attrs['channels']    = int(channel_count)
+            self.blocks = self.h5.create_dataset('{}_blocks'.format(self.role),
+                                                 shape=(0, 3),
+                                                 maxshape=(None, 3),
+                                                 chunks=(1024, 3),
+                                                 dtype='<f8')
+
+    def write(self, start_time, rows):
+        rows = np.asarray(rows)
+        row_offset = self.data.shape[0]
+        self.data.resize(row_offset + len(rows), axis=0)
+        self.data[row_offset:] = rows
+
+        block_count = self.blocks.shape[0]
+        self.blocks.resize(block_count + 1, axis=0)
+        self.blocks[block_count] = (float(start_time), row_offset, len(rows))
+        if 'start_epoch' not in self.data.attrs:
+            self.data.attrs['start_epoch'] = float(start_time)
+        self.data.attrs['end_epoch'] = float(start_time) + len(rows) / float(self.data.attrs['sample_rate'])
+        # keep what is on disk readable if the box loses power
+        self.h5.flush()
+
+    def close(self):
+        self.h5.close()
+
+#
+# This method returns the rows of every block that starts inside
+# .. [start_t, end_t] from a role's HDF5 archive plus the start time
+# .. of its first row (None if there are no blocks in the window)
+def read_hdf5_window(data_dir, role, start_t, end_t):
+    check_h5py()
+    with h5py.File(get_hdf5_filename(data_dir, role), 'r') as h5:
+        blocks = h5['{}_blocks'.format(role)][:]
+        in_window = blocks[(blocks[:, 0] >= start_t) & (blocks[:, 0] <= end_t)]
+        if len(in_window) == 0:
+            return(None, None)
+        data = h5[role]
+        # blocks are appended in time order so the window is one contiguous run of rows
+        first_row = int(in_window[0, 1])
+        last_row  = int(in_window[-1, 1] + in_window[-1, 2])
+        return(float(in_window[0, 0]), data[first_row:last_row])
+
+class BlockArchive(object):
+    """Reads windows of a segment or hdf5 archive with its block index loaded once.
+
+    The blocks of a window are found with a binary search of their start
+    times and only the channels asked for are copied out, so reading many
+    windows (every tile of a build, every piece of a long window) never
+    reloads the index. Subclasses provide get_blocks(), read_blocks(),
+    get_sources() and close().
+    """
+    def __init__(self, data_dir):
+        super(BlockArchive, self).__init__()
+        self.data_dir = data_dir
+        # None unless the archive holds raw counts
+        self.scaling  = load_scaling(os.path.normpath(data_dir))
+
+    def read_window(self, start_t, end_t, channels):
+        """Start time and (rows, len(channels)) of the blocks starting in [start_t, end_t], (None, None) if there aren't any."""
+        blocks = self.get_blocks(start_t, end_t)
+        if len(blocks) == 0:
+            return(None, None)
+        return(float(blocks[0][0]), self.read_blocks(blocks, channels))
+
+    def iter_window(self, start_t, end_t, channels, block_sec=60):
+        """Yield read_window() of [start_t, end_t] about block_sec seconds at a time."""
+        for piece in split_blocks(self.get_blocks(start_t, end_t), block_sec):
+            yield(float(piece[0][0]), self.read_blocks(piece, channels))
+
+class SegmentArchive(BlockArchive):
+    """The SEGMENT_INDEX of a directory, the segment being read stays mapped."""
+    def __init__(self, data_dir):
+        super(SegmentArchive, self).__init__(data_dir)
+        self.blocks  = load_segment_index(data_dir)
+        self.starts  = np.array([block[0] for block in self.blocks], dtype=np.float64)
+        self.segment = None
+        self.data    = None
+
+    def get_blocks(self, start_t, end_t):
+        first = np.searchsorted(self.starts, start_t, side='left')
+        last  = np.searchsorted(self.starts, end_t, side='right')
+        return(self.blocks[first:last])
+
+    def get_sources(self, start_t, end_t):
+        """Segment files holding the blocks that start in [start_t, end_t]."""
+        segments = sorted(set(block[1] for block in self.get_blocks(start_t, end_t)))
+        return([os.path.join(self.data_dir, segment) for segment in segments])
+
+    def read_blocks(self, blocks, channels):
+        rows = []
+        for block_start, segment, row_offset, block_rows in blocks:
+            if segment != self.segment:
+                self.segment = segment
+                self.data    = map_segment(self.data_dir, segment)
+            rows.append(self.data[row_offset:row_offset + block_rows, channels])
+        return(np.concatenate(rows))
+
+    def close(self):
+        self.segment = None
+        self.data    = None
+
+class HDF5Archive(BlockArchive):
+    """A role's HDF5 archive, kept open with its block table read once."""
+    def __init__(self, data_dir, role):
+        super(HDF5Archive, self).__init__(data_dir)
+        check_h5py()
+        self.h5     = h5py.File(get_hdf5_filename(data_dir, role), 'r')
+        # (start epoch, row offset, rows) appended in time order
+        self.blocks = self.h5['{}_blocks'.format(role)][:]
+        self.data   = self.h5[role]
+
+    def get_blocks(self, start_t, end_t):
+        first = np.searchsorted(self.blocks[:, 0], start_t, side='left')
+        last  = np.searchsorted(self.blocks[:, 0], end_t, side='right')
+        return(self.blocks[first:last])
+
+    def get_sources(self, start_t, end_t):
+        # one file changed by every write, there is nothing to check a window against
+        return([])
+
+    def read_blocks(self, blocks, channels):
+        # h5py reads columns in increasing order, put them back in the order asked for
+        columns   = sorted(set(channels))
+        order     = [columns.index(channel) for channel in channels]
+        # blocks are appended in time order so they are one contiguous run of rows
+        first_row = int(blocks[0][1])
+        last_row  = int(blocks[-1][1] + blocks[-1][2])
+        return(self.data[first_row:last_row, columns][:, order])
+
+    def close(self):
+        self.h5.close()
+
+class MatFileWriter(object):
+    """Writes a MATLAB v7.3 (HDF5 based) .mat file a block at a time.
+
+    Scalars, strings and small arrays are written whole with write_value()
+    and long vectors are grown with append(), so a window never has to be
+    in memory at once. MATLAB arrays are column-major so HDF5 sees every
+    array transposed, a vector comes out as a 1xN row like scipy.io.savemat.
+    """
+    def __init__(self, filename):
+        super(MatFileWriter, self).__init__()
+        check_h5py(needed_by='Writing v7.3 .mat files')
+        self.filename = filename
+        self.h5       = h5py.File(filename, 'w', userblock_size=MAT_USERBLOCK_SIZE)
+
+    def set_class(self, dataset, matlab_class):
+        dataset.attrs['MATLAB_class'] = np.bytes_(matlab_class)
+
+    def get_class(self, dtype):
+        dtype = np.dtype(dtype)
+        if dtype not in MAT_CLASSES:
+            raise ValueError('No MATLAB class for {}'.format(dtype))
+        return(MAT_CLASSES[dtype])
+
+    def write_value(self, name, value):
+        if isinstance(value, str):
+            chars = np.frombuffer(value.encode('utf-16-le'), dtype='<u2')
+            if len(chars) == 0:
+                # MATLAB stores an empty array as its dimensions
+                dataset = self.h5.create_dataset(name, data=np.zeros(2, dtype=np.uint64))
+                dataset.attrs['MATLAB_empty'] = np.uint8(1)
+            else:
+                dataset = self.h5.create_dataset(name, data=chars.reshape(-1, 1))
+            dataset.attrs['MATLAB_int_decode'] = np.int32(2)
+            self.set_class(dataset, 'char')
+            return
+        value   = np.asarray(value)
+        # 1-D arrays are rows, scalars are 1x1
+        dataset = self.h5.create_dataset(name, data=np.atleast_2d(value).T)
+        self.set_class(dataset, self.get_class(value.dtype))
+
+    def create_vector(self, name, dtype=np.float64):
+        dataset = self.h5.create_dataset(name,
+                                         shape=(0, 1),
+                                         maxshape=(None, 1),
+                                         chunks=(MAT_CHUNK_VALUES, 1),
+                                         dtype=dtype)
+        self.set_class(dataset, self.get_class(dtype))
+
+    def append(self, name, values):
+        dataset = self.h5[name]
+        values  = np.asarray(values, dtype=dataset.dtype).reshape(-1, 1)
+        offset  = dataset.shape[0]
+        dataset.resize(offset + len(values), axis=0)
+        dataset[offset:] = values
+
+    def close(self):
+        self.h5.close()
+        # h5py leaves the user block empty, MATLAB looks for its header there
+        header  = MAT_HEADER_TEXT.format(time.strftime('%a %b %d %H:%M:%S %Y')).encode('ascii').ljust(116, b' ')
+        header += b' ' * 8 + b'\x00\x02' + b'IM'
+        with open(self.filename, 'r+b') as f:
+            f.write(header)
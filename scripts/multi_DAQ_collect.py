@@ -15,6 +15,8 @@ from datetime import datetime
 from uldaq import (get_daq_device_inventory, DaqDevice, AInScanFlag, ScanStatus,
                    ScanOption, create_float_buffer, InterfaceType, AiInputMode, ULException)
 from async_daq_data_handler5 import AsyncDAQDataHandler
+from _async_multi_daq_data_handler import AsyncDAQDataHandler as AsyncMultiDAQDataHandler
+from scan_clock import ScanClock
 # import async_daq_data_handler2
 # Methods for handling DAQ config and setup
 from daq_utils import (print_config,
@@ -25,7 +27,8 @@ from daq_utils import (print_config,
                        create_output_str,
                        display_scan_options,
                        clear_eol,
-                       reset_cursor)
+                       reset_cursor,
+                       get_scaling)
 # Methods for interactive prompt when user chooses interactive mode at runtime
 from prompt_utils import (print_title,
                           print_line,
@@ -39,7 +42,7 @@ from prompt_utils import (print_title,
 def get_loading_char(mod):
     return('/' if mod%2==0 else '\\')
 
-def main(args, master_dir, slave_dir):
+def main(args, master_dir, slave_dir, multi_dir=None):
     """Multiple DAQs Collecting in CONTINUOUS mode."""
     daq_device     = {'MASTER': None, 'SLAVE': None}
     ai_device      = {'MASTER': None, 'SLAVE': None}
@@ -53,9 +56,11 @@ def main(args, master_dir, slave_dir):
                       'MASTER': ScanOption.CONTINUOUS | ScanOption.PACEROUT, 
                       'SLAVE':  ScanOption.EXTCLOCK | ScanOption.CONTINUOUS
                       }
+    # raw counts skip the scaling to volts, it is applied when the data is read
+    scan_flag      = AInScanFlag.NOSCALEDATA if args.raw_counts else AInScanFlag.DEFAULT
     flags          = {
-                      'MASTER': AInScanFlag.DEFAULT, 
-                      'SLAVE':  AInScanFlag.DEFAULT
+                      'MASTER': scan_flag, 
+                      'SLAVE':  scan_flag
                       }
     data_dir       = {
                       'MASTER': master_dir, 
@@ -128,22 +133,29 @@ def main(args, master_dir, slave_dir):
                          channel_range=(low_channel['SLAVE'], high_channel['SLAVE']), 
                          voltage_range=v_range['SLAVE'], 
                          scan_options=scan_options['SLAVE'],
+                         mode=args.mode,
                          role='SLAVE',
                          print_head_space=False,
                          is_actual=True)
             print_total_channel_count(args.channels)
 
-        async_writer_SLAVE = AsyncDAQDataHandler(float_buffer=data['SLAVE'], 
-                                                 role='SLAVE', 
-                                                 ai_device=ai_device['SLAVE'], 
-                                                 channel_count=channel_count['SLAVE'], 
-                                                 data_dir=data_dir['SLAVE'],
-                                                 sample_rate=args.sample_rate,
-                                                 scan_options=display_scan_options(scan_options['SLAVE']),
-                                                 v_range=v_range['SLAVE'],
-                                                 input_mode=input_mode['SLAVE'],
-                                                 flags=flags['SLAVE'],
-                                                 file_length=file_length_sec,)
+        async_writers = []
+        if not args.merged:
+            async_writers.append(AsyncDAQDataHandler(float_buffer=data['SLAVE'], 
+                                                     role='SLAVE', 
+                                                     ai_device=ai_device['SLAVE'], 
+                                                     channel_count=channel_count['SLAVE'], 
+                                                     data_dir=data_dir['SLAVE'],
+                                                     sample_rate=args.sample_rate,
+                                                     scan_options=display_scan_options(scan_options['SLAVE']),
+                                                     v_range=v_range['SLAVE'],
+                                                     input_mode=input_mode['SLAVE'],
+                                                     flags=flags['SLAVE'],
+                                                     file_length=file_length_sec,
+                                                     file_mode=args.mode,
+                                                     compression=args.compression,
+                                                     compression_filter=args.compression_filter,
+                                                     scaling=get_scaling(v_range['SLAVE'], ai_info['SLAVE']) if args.raw_counts else None))
         #
         # Now setup 'MASTER' DAQ
         # 
@@ -172,7 +184,7 @@ def main(args, master_dir, slave_dir):
                                                          data['MASTER'])
             post_call = datetime.now()
             # average times from pre scan start and post scan start
-            start_time_epoch = datetime.fromtimestamp(int(pre_call.timestamp() + post_call.timestamp()) / 2)
+            start_time_epoch = datetime.fromtimestamp((pre_call.timestamp() + post_call.timestamp()) / 2)
 
             if not args.quiet:
                 # Print config options
@@ -183,6 +195,7 @@ def main(args, master_dir, slave_dir):
                              channel_range=(low_channel['MASTER'], high_channel['MASTER']), 
                              voltage_range=v_range['MASTER'], 
                              scan_options=scan_options['MASTER'],
+                             mode=args.mode,
                              role='MASTER',
                              print_head_space=False,
                              is_actual=True)
@@ -196,24 +209,50 @@ def main(args, master_dir, slave_dir):
             #   .. both AsyncDAQDataHandler-s
             #
 
-            async_writer_MASTER = AsyncDAQDataHandler(float_buffer=data['MASTER'], 
-                                                      role='MASTER', 
-                                                      ai_device=ai_device['MASTER'], 
-                                                      channel_count=channel_count['MASTER'], 
-                                                      data_dir=data_dir['MASTER'],
-                                                      sample_rate=args.sample_rate,
-                                                      scan_options=display_scan_options(scan_options['MASTER']),
-                                                      v_range=v_range['MASTER'],
-                                                      input_mode=input_mode['MASTER'],
-                                                      flags=flags['MASTER'],
-                                                      file_length=file_length_sec)
+            if args.merged:
+                # one writer reads both buffers and writes MASTER then SLAVE channels to every file
+                async_writers.append(AsyncMultiDAQDataHandler(float_buffers=data, 
+                                                              ai_devices_dict=ai_device, 
+                                                              role_write_order=['MASTER', 'SLAVE'], 
+                                                              file_length_sec=file_length_sec,
+                                                              channel_counts=channel_count,
+                                                              data_dir=multi_dir,
+                                                              sample_rate=args.sample_rate,
+                                                              scan_options={r:display_scan_options(scan_options[r]) for r in scan_options},
+                                                              v_ranges=v_range,
+                                                              input_modes=input_mode,
+                                                              flags=flags,
+                                                              file_mode=args.mode,
+                                                              compression=args.compression,
+                                                              compression_filter=args.compression_filter,
+                                                              # both devices are the same model on the same range
+                                                              scaling=get_scaling(v_range['MASTER'], ai_info['MASTER']) if args.raw_counts else None))
+            else:
+                async_writers.append(AsyncDAQDataHandler(float_buffer=data['MASTER'], 
+                                                         role='MASTER', 
+                                                         ai_device=ai_device['MASTER'], 
+                                                         channel_count=channel_count['MASTER'], 
+                                                         data_dir=data_dir['MASTER'],
+                                                         sample_rate=args.sample_rate,
+                                                         scan_options=display_scan_options(scan_options['MASTER']),
+                                                         v_range=v_range['MASTER'],
+                                                         input_mode=input_mode['MASTER'],
+                                                         flags=flags['MASTER'],
+                                                         file_length=file_length_sec,
+                                                         file_mode=args.mode,
+                                                         compression=args.compression,
+                                                         compression_filter=args.compression_filter,
+                                                         scaling=get_scaling(v_range['MASTER'], ai_info['MASTER']) if args.raw_counts else None))
             
             #
             #   Let Async file writes know we're ready 
             #   .. so they can start writing
             #
-            async_writer_MASTER.begin(start_time_epoch.timestamp())
-            async_writer_SLAVE.begin(start_time_epoch.timestamp())
+            # MASTER and SLAVE run off one sample clock, so they share one ScanClock
+            # .. and a row gets the same time in both directories
+            clock = ScanClock(args.sample_rate, start_time_epoch.timestamp(), '{}/MASTER_clock.csv'.format(multi_dir if args.merged else data_dir['MASTER']))
+            for async_writer in async_writers:
+                async_writer.begin(start_time_epoch.timestamp(), clock=clock)
 
             prev_index      = {'MASTER': 0, 'SLAVE': 0}
             index           = {'MASTER': 0, 'SLAVE': 0}
@@ -229,6 +268,8 @@ def main(args, master_dir, slave_dir):
                     print_line(' |----------------------------------------------------- ')
                 time.sleep(0.1)
                 heart_beat_count = 0
+                # raw counts are whole numbers
+                value_format = '{:.0f}' if args.raw_counts else '{:.6f}'
                 log = '{}/00log.log'.format(args.data_directory)
                 while True:
                     reset_cursor()
@@ -246,16 +287,16 @@ def main(args, master_dir, slave_dir):
                             index['SLAVE'] = transfer_status['SLAVE'].current_index
                             reset_cursor()
                             clear_eol()
-                            output_str = create_output_str(transfer_status['MASTER'], rate['MASTER'], role='MASTER')
+                            output_str = create_output_str(transfer_status['MASTER'], rate['MASTER'], role='MASTER', raw_counts=args.raw_counts)
                             # now append channel values for MASTER
                             for i in range(channel_count['MASTER']):
-                                output_str.append('<b>Channel</b> [<b>{}</b>] = {:.6f}'.format(i+low_channel['MASTER'], 
-                                                                                               data['MASTER'][index['MASTER'] + i]))
-                            output_str += create_output_str(transfer_status['SLAVE'], rate['SLAVE'], role='SLAVE')
+                                output_str.append('<b>Channel</b> [<b>{}</b>] = {}'.format(i+low_channel['MASTER'], 
+                                                                                           value_format.format(data['MASTER'][index['MASTER'] + i])))
+                            output_str += create_output_str(transfer_status['SLAVE'], rate['SLAVE'], role='SLAVE', raw_counts=args.raw_counts)
                             # now append channel values for SLAVE
                             for i in range(channel_count['SLAVE']):
-                                output_str.append('<b>Channel</b> [<b>{}</b>] = {:.6f}'.format(i+low_channel['SLAVE'], 
-                                                                                               data['SLAVE'][index['SLAVE'] + i]))
+                                output_str.append('<b>Channel</b> [<b>{}</b>] = {}'.format(i+low_channel['SLAVE'], 
+                                                                                           value_format.format(data['SLAVE'][index['SLAVE'] + i])))
                             print_lines(output_str)
 
                         #
@@ -289,6 +330,7 @@ def main(args, master_dir, slave_dir):
                                  channel_range=(low_channel['MASTER'], high_channel['MASTER']), 
                                  voltage_range=v_range['MASTER'], 
                                  scan_options=scan_options['MASTER'],
+                                 mode=args.mode,
                                  role='MASTER',
                                  print_head_space=False,
                                  is_actual=True)
@@ -300,6 +342,7 @@ def main(args, master_dir, slave_dir):
                                  channel_range=(low_channel['SLAVE'], high_channel['SLAVE']), 
                                  voltage_range=v_range['SLAVE'], 
                                  scan_options=scan_options['SLAVE'],
+                                 mode=args.mode,
                                  role='SLAVE',
                                  print_head_space=False,
                                  is_actual=True)
@@ -307,9 +350,10 @@ def main(args, master_dir, slave_dir):
 
                 raise(KeyboardInterrupt)
             finally:
-                async_writer_MASTER.stop()
-                async_writer_SLAVE.stop()
+                for async_writer in async_writers:
+                    async_writer.stop()
                 time.sleep(2)
+                clock.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -320,14 +364,22 @@ if __name__ == '__main__':
     parser.add_argument('--debug', help='Show debugging print messages', action='store_true')
     parser.add_argument('--quiet', help='No Console Output', action='store_true')
     parser.add_argument('--verbose', help='Verbose output - may slow process on slower CPUs', action='store_true')
-    parser.add_argument('--mode', help='Data output mode', choices=['binary', 'text'], required=False)
+    parser.add_argument('--mode', help='Data output mode', choices=['binary', 'text', 'segment', 'hdf5', 'compressed'], required=False)
+    parser.add_argument('--compression', help='Codec for the compressed mode (lz4 and zstd need the lz4/zstandard packages)', choices=['gzip', 'lz4', 'zstd'], required=False)
+    parser.add_argument('--compression-filter', help='Filter applied before compressing (delta is for raw integer counts)', choices=['none', 'shuffle', 'delta'], required=False)
+    parser.add_argument('--raw-counts', help='Record raw 16-bit ADC counts (scaled to volts when plotted), needs a binary file mode', action='store_true')
+    parser.add_argument('--merged', help='Write MASTER and SLAVE channels side by side to one MULTI_DAQ directory', action='store_true')
     parser.add_argument('-i', '--interactive', help='Set parameters interactively or, use passed values (or default values)', action='store_true')
     parser.add_argument('-s', '--script', help='Run from script (Will not ask for user input)', action='store_true')
     parser.add_argument('-t', '--test', help='Run as test and exit smoothly', action='store_true')
-    parser.set_defaults(channels=16, sample_rate=19200, file_length_sec=1.0, data_directory='{}/data_{}'.format(os.getcwd(), datetime.now()), mode='text')
+    parser.set_defaults(channels=16, sample_rate=19200, file_length_sec=1.0, data_directory='{}/data_{}'.format(os.getcwd(), datetime.now()), mode='text',
+                        compression='gzip', compression_filter='shuffle')
     args = parser.parse_args()
     if args.test:
         args.quiet = True
+    # checked here, the writers are only created after the scans have started
+    if args.raw_counts and args.mode == 'text':
+        parser.error('--raw-counts needs a binary file mode (--mode binary, segment, hdf5 or compressed)')
     time.sleep(0.2)
     os.system('clear')
     
@@ -403,12 +455,18 @@ if __name__ == '__main__':
 
         master_dir = os.path.abspath('{}/MASTER_DAQ'.format(args.data_directory))
         slave_dir  = os.path.abspath('{}/SLAVE_DAQ'.format(args.data_directory))
+        multi_dir  = None
+        if args.merged:
+            multi_dir = os.path.abspath('{}/MULTI_DAQ'.format(args.data_directory))
+            if not os.path.exists(multi_dir):
+                os.mkdir(multi_dir)
         #
         #   Start main thread
         #
         main(args=args,
              master_dir=master_dir,
-             slave_dir=slave_dir)
+             slave_dir=slave_dir,
+             multi_dir=multi_dir)
     except ULException as e:
         print_line('\n UL Specific Exception Thrown: {}\n'.format(e))
 
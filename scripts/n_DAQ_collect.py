@@ -0,0 +1,141 @@
+#
+# Woods Hole Oceanographic Institution
+# Author: Caileigh Fitzgerald
+# Email:  cfitzgerald@whoi.edu
+# Date:   06/20/2020
+#
+# File: n_DAQ_collect.py
+#
+from __future__ import print_function
+import time
+import os
+import argparse
+from datetime import datetime
+from uldaq import InterfaceType, ULException
+from daq_coordinator import DAQCoordinator
+# Methods for handling DAQ config and setup
+from daq_utils import (print_config,
+                       print_total_channel_count,
+                       config_daq_options_chain,
+                       create_output_str,
+                       get_config_options,
+                       clear_eol,
+                       reset_cursor)
+from prompt_utils import print_line, print_lines
+
+def get_loading_char(mod):
+    return('/' if mod%2==0 else '\\')
+
+def print_coordinator_config(args, coordinator):
+    for r in coordinator.roles:
+        print_config(sample_rate=coordinator.rate[r] or args.sample_rate,
+                     file_length=args.file_length_sec,
+                     data_directory=args.data_directory,
+                     input_mode=coordinator.input_mode[r].name,
+                     channel_range=(0, coordinator.channel_count[r]-1),
+                     voltage_range=coordinator.v_range[r],
+                     scan_options=coordinator.scan_options[r],
+                     mode=args.mode,
+                     role=r,
+                     print_head_space=False,
+                     is_actual=True)
+    print_total_channel_count(coordinator.get_total_channels())
+
+def main(args):
+    """N DAQs Collecting in CONTINUOUS mode off the first device's clock."""
+    try:
+        descriptors = config_daq_options_chain(interface_type=InterfaceType.USB, device_ids=args.device_ids)
+    except RuntimeError as e:
+        print_line(e)
+        exit(1)
+
+    start_test = time.time()
+    with DAQCoordinator(device_descriptors=descriptors,
+                        channels_per_device=args.channels_per_device,
+                        sample_rate=args.sample_rate,
+                        file_length_sec=args.file_length_sec,
+                        data_directory=args.data_directory,
+                        merged=args.merged,
+                        raw_counts=args.raw_counts,
+                        file_mode=args.mode,
+                        compression=args.compression,
+                        compression_filter=args.compression_filter) as coordinator:
+        start_time_epoch = datetime.fromtimestamp(coordinator.start())
+        if not args.quiet:
+            print_coordinator_config(args, coordinator)
+            print_line(' <info><b>ACTUAL START TIME:</b></info> <time>{}</time> epoch:[<time>{}</time>]'.format(start_time_epoch, start_time_epoch.timestamp()))
+            print('')
+            print_line(' | <info>CTRL + C to terminate the process</info>       ')
+            print_line(' |----------------------------------------------------- ')
+        time.sleep(0.1)
+        heart_beat_count = 0
+        try:
+            while True:
+                reset_cursor()
+                clear_eol()
+                heart_beat_count += 1
+                if heart_beat_count >= 1000:
+                    heart_beat_count = 0
+                print('Scanning... {}'.format(get_loading_char(heart_beat_count)))
+                if not args.quiet and args.verbose:
+                    output_str = []
+                    for r, (status, transfer_status) in coordinator.get_scan_status().items():
+                        output_str += create_output_str(transfer_status, coordinator.rate[r], role=r, raw_counts=args.raw_counts)
+                    print_lines(output_str)
+                #
+                #   All file writing happens in the writer threads.
+                #   .. run time.sleep(file_length) to print out info for user
+                #
+                time.sleep(args.file_length_sec)
+                if time.time() - start_test >= 10 and args.test:
+                    # breakout!
+                    print_line('Leaving from test!')
+                    raise(KeyboardInterrupt)
+        except KeyboardInterrupt:
+            if not args.test:
+                os.system('clear')
+            if not args.quiet:
+                print_coordinator_config(args, coordinator)
+            raise(KeyboardInterrupt)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--device-ids', nargs='+', help='Unique IDs of the DAQs, the first one is the clock MASTER', required=True)
+    parser.add_argument('--channels-per-device', help='Number of channels to record on every DAQ', required=False, type=int)
+    parser.add_argument('--sample-rate', help='Sample rate in Hz', required=False, type=int)
+    parser.add_argument('--file-length-sec', help='Duration of each data file', required=False, type=int)
+    parser.add_argument('--data-directory', help='Directory to store the <ROLE>_DAQ data directories', required=False)
+    parser.add_argument('--quiet', help='No Console Output', action='store_true')
+    parser.add_argument('--verbose', help='Verbose output - may slow process on slower CPUs', action='store_true')
+    parser.add_argument('--mode', help='Data output mode', choices=['binary', 'text', 'segment', 'hdf5', 'compressed'], required=False)
+    parser.add_argument('--compression', help='Codec for the compressed mode (lz4 and zstd need the lz4/zstandard packages)', choices=['gzip', 'lz4', 'zstd'], required=False)
+    parser.add_argument('--compression-filter', help='Filter applied before compressing (delta is for raw integer counts)', choices=['none', 'shuffle', 'delta'], required=False)
+    parser.add_argument('--raw-counts', help='Record raw 16-bit ADC counts (scaled to volts when plotted), needs a binary file mode', action='store_true')
+    parser.add_argument('--merged', help='Write every channel side by side to one MULTI_DAQ directory', action='store_true')
+    parser.add_argument('-s', '--script', help='Run from script (Will not ask for user input)', action='store_true')
+    parser.add_argument('--use-config', help='Use config file (its channels are the channels per device)', action='store_true')
+    parser.add_argument('-t', '--test', help='Run as test and exit smoothly', action='store_true')
+    parser.set_defaults(channels_per_device=8, sample_rate=19200, file_length_sec=1.0, data_directory='{}/data_{}'.format(os.getcwd(), datetime.now()), mode='text',
+                        compression='gzip', compression_filter='shuffle')
+    args = parser.parse_args()
+    if args.test or args.script:
+        args.quiet = True
+
+    if args.use_config:
+        args = get_config_options(args)
+        args.channels_per_device = args.channels
+    # checked here, the writers are only created after the scans have started
+    if args.raw_counts and args.mode == 'text':
+        parser.error('--raw-counts needs a binary file mode (--mode binary, segment, hdf5 or compressed)')
+    os.system('clear')
+
+    try:
+        if not os.path.exists(args.data_directory):
+            os.makedirs(args.data_directory)
+        args.data_directory = os.path.abspath(args.data_directory)
+        main(args=args)
+    except ULException as e:
+        print_line('\n UL Specific Exception Thrown: {}\n'.format(e))
+
+    except KeyboardInterrupt:
+        print_line('\n\n\tEnding...\n')
@@ -2,6 +2,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pathlib
 import glob
+import bisect
 import os
 import sys
 import time
@@ -17,26 +18,44 @@ import traceback
 from gps_data_packet import GPSDataPacket, GPSLogParser, GPSPlotter
 from imu_data_packet import IMUDataPacket, IMULogParser, IMUPlotter
 from ais_data_packet import AISDataPacket, AISLogParser, AISPlotter
+from data_file_utils import (read_file_channels,
+                             read_data_files,
+                             load_scaling,
+                             counts_to_volts,
+                             read_segment_window,
+                             read_hdf5_window,
+                             SegmentArchive,
+                             HDF5Archive,
+                             DataFileIndex,
+                             MatFileWriter,
+                             ARCHIVE_MODES)
+from specgram_tiles import read_tile_window
 
 #
-# This method pull n channel data from file and returns list of floats
+# This method pull n channel data from file and returns an array of volts
 def get_data(filename, selected_channel):
-    data = []
-    with open(filename, 'r') as f:
-        start = time.time()
-        for i, line in enumerate(f.readlines()):
-            if time.time()-start >= 1:
-                start = time.time()
-            channel_data = line.split(',')
-            data.append(float(channel_data[selected_channel]))
-    return(data)
+    # raw count data has a scaling file next to it, volts come back unchanged
+    scaling = load_scaling(str(pathlib.Path(filename).parent))
+    return(counts_to_volts(read_file_channels(filename, [selected_channel])[:, 0], scaling))
+
+#
+# This method returns a (samples, len(channels)) array of volts for the
+# .. channels of every file in files (one directory, sorted by start time)
+def get_channels_from_list_files(files, channels):
+    if len(files) == 0:
+        return(np.empty((0, len(channels))))
+    scaling = load_scaling(str(pathlib.Path(files[0]).parent))
+    return(read_data_files(files, channels, scaling=scaling))
 
 def get_data_from_list_files(files, selected_channel):
-    data = []
-    for file in files:
-        d = get_data(file, selected_channel)
-        [data.append(x) for x in d]
-    return(data)
+    return(get_channels_from_list_files(files, [selected_channel])[:, 0])
+
+#
+# This method yields the selected channel of files_per_block files at a time
+# .. so a long window can be processed without holding all of it
+def iter_data_from_list_files(files, selected_channel, files_per_block=60):
+    for i in range(0, len(files), files_per_block):
+        yield(get_data_from_list_files(files[i:i + files_per_block], selected_channel))
 
 #
 # This method returns only the files that fall within the specified 
@@ -45,13 +64,12 @@ def get_files_in_window(files, start_t, end_t):
     if start_t == None or end_t == None:
         return(files)
 
-    files_in_window = []
+    if isinstance(files, DataFileIndex):
+        return(files.get_window(start_t, end_t))
     # keep files that are between start_t and end_t
-    for file in files:
-        if float(file.stem) >= start_t and\
-           float(file.stem) <= end_t:
-            files_in_window.append(file)
-    return(files_in_window)
+    # .. files is sorted by start time, so the window is one slice
+    epochs = [float(file.stem) for file in files]
+    return(files[bisect.bisect_left(epochs, start_t):bisect.bisect_right(epochs, end_t)])
 
 def get_log_parser(path, pos_type, imu_use_euler=True):
     # TODO: handle possible failure if path does not have GPS.csv etc...
@@ -83,8 +101,95 @@ def get_pos_data_in_window(parser, start_t, end_t, pos_type):
     data, start_actual = parser.parse(start=start_t, end=end_t, required_fields=required_fields)
     return(data, start_actual)
 
-def get_files(path, role):
-    return(sorted(pathlib.Path('{}/{}_DAQ/'.format(path, role)).glob('1*.txt')))
+#
+# This method returns the start time of the first block in the window and a
+# .. (rows, channels) array for data stored in one of the ARCHIVE_MODES
+def get_archive_window(path, role, start_t, end_t, mode):
+    data_dir = '{}/{}_DAQ/'.format(path, role)
+    if mode == 'segment':
+        window_start, rows = read_segment_window(data_dir, start_t, end_t)
+    elif mode == 'hdf5':
+        window_start, rows = read_hdf5_window(data_dir, role, start_t, end_t)
+    else:
+        raise RuntimeError('\"{}\" is not an archive file mode (expected one of: {})'.format(mode, ', '.join(ARCHIVE_MODES)))
+    if rows is not None:
+        rows = counts_to_volts(rows, load_scaling(os.path.normpath(data_dir)))
+    return(window_start, rows)
+
+#
+# This method opens a role's archive for reading many of its windows with the
+# .. index loaded once (see BlockArchive), close() it when done
+def open_archive(path, role, mode):
+    data_dir = '{}/{}_DAQ/'.format(path, role)
+    if mode == 'segment':
+        return(SegmentArchive(data_dir))
+    elif mode == 'hdf5':
+        return(HDF5Archive(data_dir, role))
+    raise RuntimeError('\"{}\" is not an archive file mode (expected one of: {})'.format(mode, ', '.join(ARCHIVE_MODES)))
+
+#
+# This method returns the start time of the first file (or block) in the window
+# .. and a (samples, len(channels)) array of volts for any data file mode,
+# .. archive is an open_archive() of the role to read from (if there is one)
+def get_channels_in_window(path, files, role, channels, start_t, end_t, mode, archive=None):
+    if archive is not None:
+        window_start, rows = archive.read_window(start_t, end_t, channels)
+        return(window_start, None if rows is None else counts_to_volts(rows, archive.scaling))
+    if mode in ARCHIVE_MODES:
+        window_start, rows = get_archive_window(path=path, role=role, start_t=start_t, end_t=end_t, mode=mode)
+        return(window_start, None if rows is None else rows[:, channels])
+    files_in_window = get_files_in_window(files=files, start_t=start_t, end_t=end_t)
+    if len(files_in_window) == 0:
+        return(None, None)
+    return(float(files_in_window[0].stem), get_channels_from_list_files(files_in_window, channels))
+
+#
+# This method returns the files the data of the window is read from so a
+# .. spectrogram tile can be checked against their modification times. An
+# .. hdf5 archive is one file changed by every write, so none are returned
+def get_sources_in_window(path, files, role, start_t, end_t, mode, archive=None):
+    if archive is not None:
+        return(archive.get_sources(start_t, end_t))
+    if mode == 'segment':
+        return(SegmentArchive('{}/{}_DAQ/'.format(path, role)).get_sources(start_t, end_t))
+    if mode in ARCHIVE_MODES:
+        return([])
+    return(get_files_in_window(files=files, start_t=start_t, end_t=end_t))
+
+#
+# This method yields (start time, (samples, len(channels)) volts) of the window
+# .. a piece at a time, files_per_block files or about block_sec seconds of an
+# .. archive, so the memory used is the same however long the window is
+def iter_channels_in_window(path, files, role, channels, start_t, end_t, mode, files_per_block=60, block_sec=60):
+    if mode not in ARCHIVE_MODES:
+        files_in_window = get_files_in_window(files=files, start_t=start_t, end_t=end_t)
+        for i in range(0, len(files_in_window), files_per_block):
+            block_files = files_in_window[i:i + files_per_block]
+            yield(float(block_files[0].stem), get_channels_from_list_files(block_files, channels))
+        return
+    archive = open_archive(path, role, mode)
+    try:
+        for piece_start, rows in archive.iter_window(start_t, end_t, channels, block_sec=block_sec):
+            yield(piece_start, counts_to_volts(rows, archive.scaling))
+    finally:
+        archive.close()
+
+def iter_channel_in_window(path, files, role, channel, start_t, end_t, mode, files_per_block=60, block_sec=60):
+    for piece_start, rows in iter_channels_in_window(path, files, role, [channel], start_t, end_t, mode,
+                                                     files_per_block=files_per_block, block_sec=block_sec):
+        yield(piece_start, rows[:, 0])
+
+#
+# This method puts the spectrogram of a window together from the tiles cached
+# .. by build_specgram_tiles.py, returns the tile (see specgram_tiles.py) and
+# .. how many tiles the window needs that haven't been built
+def get_specgram_from_tiles(path, role, channel, NFFT, Fs, start_t, end_t, max_columns=None):
+    data_dir = os.path.normpath('{}/{}_DAQ/'.format(path, role))
+    return(read_tile_window(data_dir, channel, NFFT, Fs, start_t, end_t, max_columns=max_columns))
+
+def get_files(path, role, mode='text'):
+    # sorted like a glob of the directory but read from (or building) its file index
+    return(DataFileIndex(os.path.normpath('{}/{}_DAQ/'.format(path, role)), mode))
 
 def create_data_dir(path):
     if not os.path.exists(path):
@@ -123,6 +228,96 @@ def get_pos_fig_dir(path, postfix, pickle_fig, mat):
         'mat': mat_dir
         })
 
+#
+# This method saves (and optionally pickles and shows) a finished figure
+def save_fig(fig, fig_dir, png_file_name, pickle_fig=False, show=False, print_success=True):
+    # save fig and output progress to console
+    fig_filename = '{}/{}.png'.format(fig_dir['fig'], png_file_name)
+
+    plt.savefig(fig_filename)
+    if pickle_fig:
+        if show:
+            # we can't pickle a file AND display it.
+            # .. raise RuntimeError so user knows they are not pickling
+            raise RuntimeError('Displaying the plot AND pickling the fig is not supported at this time.')
+        # Save figure handle to disk
+        with open('{}/{}.pickle'.format(fig_dir['pickle'], png_file_name), 'wb') as f:
+            pl.dump(fig, f)
+            if print_success:
+                print_line('<info_italic>Created:</info_italic> {}.pickle'.format('{}/{}'.format(fig_dir['pickle'], png_file_name)))
+
+    if show:
+        plt.show()
+    if print_success: 
+        print_line('<info_italic>Created:</info_italic> {}'.format(fig_filename))
+    plt.close(fig)
+
+#
+# This method takes a finished StreamingSpectrogram and StreamingEnvelope
+# .. (see streaming_stft.py) for a selected channel to create multiple plots
+# .. the same layout as create_specgram_fig without the samples themselves
+def create_streamed_specgram_fig(spectrogram, envelope, fig_dir, png_file_name, title, start_time, selected_channel, pickle_fig=False, show=False, print_success=True):
+    Pxx, freqs, bins = spectrogram.finish()
+    sample, v_min, v_max = envelope.finish()
+    Z = 10. * np.log10(np.maximum(Pxx, np.finfo(np.float64).tiny))
+    draw_specgram_fig(Z, freqs, bins, sample, v_min, v_max, spectrogram.NFFT, spectrogram.Fs,
+                      fig_dir, png_file_name, title, start_time, selected_channel,
+                      pickle_fig=pickle_fig, show=show, print_success=print_success)
+
+#
+# This method takes a spectrogram tile (see get_specgram_from_tiles) to create
+# .. the same plots as create_streamed_specgram_fig without touching the data
+def create_tiled_specgram_fig(tile, fig_dir, png_file_name, title, start_time, selected_channel, pickle_fig=False, show=False, print_success=True):
+    Fs   = float(tile['Fs'])
+    bins = tile['times'] - start_time.timestamp()
+    draw_specgram_fig(tile['db'].T, tile['freqs'], bins, bins * Fs, tile['v_min'], tile['v_max'], int(tile['NFFT']), Fs,
+                      fig_dir, png_file_name, title, start_time, selected_channel,
+                      pickle_fig=pickle_fig, show=show, print_success=print_success)
+
+#
+# This method draws and saves the spectrogram figure from Z (dB, freqs x columns)
+# .. with the columns centred on bins and a min/max envelope of the voltage
+def draw_specgram_fig(Z, freqs, bins, sample, v_min, v_max, NFFT, Fs, fig_dir, png_file_name, title, start_time, selected_channel, pickle_fig=False, show=False, print_success=True):
+    fig = plt.figure(constrained_layout=True)
+    fig.set_size_inches(17, 11)
+
+    gs = GridSpec(3, 6, figure=fig)
+
+    ax1 = plt.subplot(gs.new_subplotspec((0, 0), colspan=6))
+    ax1.fill_between(sample, v_min, v_max, linewidth=0.5)
+    ax1.set_title('Voltage vs. Sample Number')
+    ax1.set_xlabel('Sample Number')
+    ax1.set_ylabel('Voltage')
+
+    ax2 = plt.subplot(gs.new_subplotspec((1, 0), colspan=6))
+    # drawn like ax.specgram: dB image spanning the column centres
+    if len(bins) > 1:
+        half_column = (bins[1] - bins[0]) / 2.0
+    else:
+        half_column = NFFT / (2.0 * Fs)
+    extent = (bins[0] - half_column if len(bins) else 0.0,
+              bins[-1] + half_column if len(bins) else 0.0,
+              freqs[0], freqs[-1])
+    ax2.imshow(Z, extent=extent, origin='lower', aspect='auto', interpolation='nearest')
+    ax2.set_title('Channel {} Spectrogram Fs={}Hz, NFFT={}'.format(selected_channel, Fs, NFFT))
+    ax2.set_xlabel('Time in seconds since {}'.format(start_time))
+    ax2.set_ylabel('Frequency Hz')
+
+    ax3 = plt.subplot(gs.new_subplotspec((2, 0), colspan=6))
+    # mean of the spectrogram columns (as power) is the Welch estimate of the PSD
+    if Z.shape[1]:
+        psd = 10. * np.log10(np.maximum(np.power(10., np.asarray(Z, dtype=np.float64) / 10.).mean(axis=1), np.finfo(np.float64).tiny))
+    else:
+        psd = np.zeros(len(freqs))
+    ax3.plot(freqs, psd)
+    ax3.grid(True)
+    ax3.set_title('Power Spectral Density')
+    ax3.set_xlabel('Frequency Hz')
+    ax3.set_ylabel('Power Spectral Density (dB/Hz)')
+
+    fig.suptitle(title, fontsize=16)
+    save_fig(fig, fig_dir, png_file_name, pickle_fig=pickle_fig, show=show, print_success=print_success)
+
 #
 # This method takes the voltage and time data for a specific roles
 # .. data on a selected channel to create multiple plots
@@ -153,27 +348,7 @@ def create_specgram_fig(t, x, NFFT, Fs, fig_dir, png_file_name, title, start_tim
     ax4.set_title('Frequencies Corresponding to Power Spectral Density')
 
     fig.suptitle(title, fontsize=16)
-
-    # save fig and output progress to console
-    fig_filename = '{}/{}.png'.format(fig_dir['fig'], png_file_name)
-
-    plt.savefig(fig_filename)
-    if pickle_fig:
-        if show:
-            # we can't pickle a file AND display it.
-            # .. raise RuntimeError so user knows they are not pickling
-            raise RuntimeError('Displaying the plot AND pickling the fig is not supported at this time.')
-        # Save figure handle to disk
-        with open('{}/{}.pickle'.format(fig_dir['pickle'], png_file_name), 'wb') as f:
-            pl.dump(fig, f)
-            if print_success:
-                print_line('<info_italic>Created:</info_italic> {}.pickle'.format('{}/{}'.format(fig_dir['pickle'], png_file_name)))
-
-    if show:
-        plt.show()
-    if print_success: 
-        print_line('<info_italic>Created:</info_italic> {}'.format(fig_filename))
-    plt.close(fig)
+    save_fig(fig, fig_dir, png_file_name, pickle_fig=pickle_fig, show=show, print_success=print_success)
 
 #
 # This method takes the voltage and time data for a specific roles
@@ -199,37 +374,38 @@ def create_position_fig(parser, pos_type, fig_dir, png_file_name, title, start_t
         plt.xticks(rotation=25)
 
     fig.suptitle(title, fontsize=16)
-
-    # save fig and output progress to console
-    fig_filename = '{}/{}.png'.format(fig_dir['fig'], png_file_name)
-
-    plt.savefig(fig_filename)
-    if pickle_fig:
-        if show:
-            # we can't pickle a file AND display it.
-            # .. raise RuntimeError so user knows they are not pickling
-            raise RuntimeError('Displaying the plot AND pickling the fig is not supported at this time.')
-        # Save figure handle to disk
-        with open('{}/{}.pickle'.format(fig_dir['pickle'], png_file_name), 'wb') as f:
-            pl.dump(fig, f)
-            if print_success:
-                print_line('<info_italic>Created:</info_italic> {}.pickle'.format('{}/{}'.format(fig_dir['pickle'], png_file_name)))
-
-    if show:
-        plt.show()
-    if print_success: 
-        print_line('<info_italic>Created:</info_italic> {}'.format(fig_filename))
-    plt.close(fig)
+    save_fig(fig, fig_dir, png_file_name, pickle_fig=pickle_fig, show=show, print_success=print_success)
 
 def save_mat(params, fname, print_success=True):
     sio.savemat('{}.mat'.format(fname), params)
     if print_success:
         print_line('<info_italic>Created:</info_italic> {}.mat'.format(fname))
 
-def create_mat_params(t_vect, t_vect_precision_error, x, NFFT, Fs, fig_dir, png_file_name, selected_channel, role):
+#
+# This method starts a v7.3 .mat for a window and returns its MatFileWriter
+# .. (see data_file_utils.py), append the samples to its voltage_vector as they
+# .. are read. Time is start_time_epoch and Fs:
+# .. t = start_time_epoch + (0:numel(voltage_vector) - 1) / Fs
+def create_mat_file(window_start, NFFT, Fs, fig_dir, png_file_name, selected_channel, role):
+    fname  = '{}/{}'.format(fig_dir['mat'], png_file_name)
+    writer = MatFileWriter('{}.mat'.format(fname))
+    writer.write_value('start_time_ISO', datetime.datetime.fromtimestamp(window_start).isoformat())
+    writer.write_value('start_time_epoch', np.float64(window_start))
+    # double so t above isn't integer division in MATLAB
+    writer.write_value('Fs', np.float64(Fs))
+    writer.write_value('NFFT', np.uint32(NFFT))
+    writer.write_value('channel', np.uint8(selected_channel))
+    writer.write_value('role', role)
+    writer.create_vector('voltage_vector', np.float64)
+    return(writer, fname)
+
+#
+# This method takes a time vector from create_time_vector and returns the
+# .. .mat fields for the window, the ISO strings (one per sample) only if iso_times
+def create_mat_params(t_vect, t_vect_precision_error, x, NFFT, Fs, fig_dir, png_file_name, selected_channel, role, iso_times=False):
     params = {
-        'uniform_time_vector_ISO': [t.isoformat() for t in t_vect],
-        'uniform_time_vector_epoch': [np.float64(t.timestamp()) for t in t_vect],
+        'start_time_ISO': get_iso_time_vector(t_vect[:1])[0] if len(t_vect) else '',
+        'uniform_time_vector_epoch': get_epoch_time_vector(t_vect),
         'time_vector_step_precision_error_sec': np.float64(t_vect_precision_error),
         'voltage_vector': np.array(x),
         'NFFT': np.uint32(NFFT),
@@ -237,6 +413,8 @@ def create_mat_params(t_vect, t_vect_precision_error, x, NFFT, Fs, fig_dir, png_
         'channel': np.uint8(selected_channel),
         'role': role,
     }
+    if iso_times:
+        params['uniform_time_vector_ISO'] = get_iso_time_vector(t_vect)
     return(params, '{}/{}'.format(fig_dir['mat'], png_file_name))
 
 def create_time_vector(data, dt_between_samples, start_t, is_data_contiguous):
@@ -246,18 +424,29 @@ def create_time_vector(data, dt_between_samples, start_t, is_data_contiguous):
     # .. the DAQ data is recorded continuously with no gaps
     # .. the timestamp first the first value is the only one that matters
     # .. for this context.
-    t_vect = []
-    total_seconds = (len(data) * dt_between_samples)
-    # np.linspace because it's inclusive
-    # .. and adding a 0.0 time delta to the start seemed more intuitive
-    t, t_step_actual = np.linspace(0.0, total_seconds, len(data), retstep=True)
-    # record floating point precision error for time vector
-    precision_error = np.abs(t_step_actual - dt_between_samples)
-
-    for dt in t:
-        t_vect.append(start_t + datetime.timedelta(seconds=dt))
+    # .. t_vect is a datetime64[ns] array (the same wall clock times as start_t)
+    # .. each sample is rounded to the nearest ns instead of adding up a rounded step
+    offset_ns = np.rint(np.arange(len(data), dtype=np.float64) * (dt_between_samples * 1e9)).astype(np.int64)
+    t_vect    = np.datetime64(start_t, 'ns') + offset_ns.astype('timedelta64[ns]')
+    # record the precision error of the time vector (worst case, from rounding to ns)
+    precision_error = 0.5e-9 if len(data) > 1 else 0.0
 
     return(precision_error, t_vect)
 
+#
+# This method returns the epoch (float64 seconds) of every time in a time vector
+# .. from create_time_vector, its times are local wall clock like a naive datetime
+def get_epoch_time_vector(t_vect):
+    if len(t_vect) == 0:
+        return(np.empty(0))
+    first = t_vect[0].astype('datetime64[us]').astype(datetime.datetime)
+    return(first.timestamp() + (t_vect - t_vect[0]) / np.timedelta64(1, 's'))
+
+#
+# This method returns the ISO 8601 strings of a time vector from create_time_vector
+# .. only ask for these when needed, it is one python string per sample
+def get_iso_time_vector(t_vect):
+    return(np.datetime_as_string(t_vect, unit='us'))
+
 def fill_non_uniform_tvec(t_vect, d_vect, handle_null):
     pass
\ No newline at end of file
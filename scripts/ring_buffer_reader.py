@@ -0,0 +1,72 @@
+import time
+import numpy as np
+
+class RingBufferReader(object):
+    """Copies the rows a DAQ has scanned out of its ring buffer in bulk.
+
+    The DAQ reports how many samples it has written (current_total_count,
+    which never wraps) through get_scan_status(). The reader keeps its own
+    count of rows consumed, so the new rows are always the region between
+    the two, copied with at most two slices of a numpy view of the buffer.
+    """
+    def __init__(self, float_buffer, ai_device, channel_count):
+        super(RingBufferReader, self).__init__()
+        self.ai_device       = ai_device
+        self.channel_count   = int(channel_count)
+        # zero-copy view of the ctypes buffer from create_float_buffer
+        self.buffer_view     = np.ctypeslib.as_array(float_buffer)
+        self.buffer_length   = len(float_buffer)
+        # create_float_buffer(channels, samples) so the buffer wraps on a row boundary
+        self.buffer_rows     = self.buffer_length // self.channel_count
+        self.status          = None
+        self.transfer_status = None
+        self.rows_read       = 0
+        self.total_rows      = None
+        # time.monotonic() around the last get_scan_status() (see ScanClock)
+        self.poll_start      = None
+        self.poll_stop       = None
+
+    def update(self):
+        """Poll the DAQ, return the rows scanned so far (None if the buffer is still empty)."""
+        self.poll_start = time.monotonic()
+        self.status, self.transfer_status = self.ai_device.get_scan_status()
+        self.poll_stop  = time.monotonic()
+        if self.transfer_status.current_index == -1:
+            self.total_rows = None
+        else:
+            self.total_rows = self.transfer_status.current_total_count // self.channel_count
+        return(self.total_rows)
+
+    def rows_available(self):
+        if self.total_rows is None:
+            return(0)
+        return(self.total_rows - self.rows_read)
+
+    def is_lapped(self):
+        """True if the DAQ has overwritten rows that were never read."""
+        return(self.rows_available() > self.buffer_rows)
+
+    def skip_to(self, row):
+        self.rows_read = row
+
+    def get_oldest_row(self):
+        """First row that has not been overwritten yet."""
+        return(max(self.total_rows - self.buffer_rows, 0))
+
+    def copy_rows(self, first_row, out):
+        """Copy len(out) rows starting at first_row into out, a (rows, channel_count) array."""
+        rows  = len(out)
+        start = (first_row % self.buffer_rows) * self.channel_count
+        stop  = start + rows * self.channel_count
+        if stop > self.buffer_length:
+            # Buffer has wrapped around.
+            split = (self.buffer_length - start) // self.channel_count
+            out[:split] = self.buffer_view[start:].reshape(-1, self.channel_count)
+            out[split:] = self.buffer_view[:stop - self.buffer_length].reshape(-1, self.channel_count)
+        else:
+            out[:] = self.buffer_view[start:stop].reshape(-1, self.channel_count)
+
+    def read_into(self, out):
+        """Copy the next len(out) rows into out, a (rows, channel_count) array."""
+        self.copy_rows(self.rows_read, out)
+        self.rows_read += len(out)
@@ -0,0 +1,126 @@
+import time
+import os
+import collections
+import threading
+import numpy as np
+
+# polls of the DAQ that took longer than this are too uncertain to use (seconds)
+MAX_POLL_SEC = 0.005
+# seconds between clock points
+CLOCK_POINT_SEC = 1.0
+# the fit replaces the nominal sample rate once the points span this many seconds
+MIN_FIT_SPAN_SEC = 60.0
+# most recent points kept for the fit (~6 hours at one per second)
+MAX_CLOCK_POINTS = 6 * 3600
+# the difference between the stamped times and the fit is slewed out over about
+# .. this many seconds, never faster than MAX_SLEW seconds per second, so file
+# .. times never jump (consecutive files can't overlap or leave a gap)
+CLOCK_SLEW_SEC = 60.0
+MAX_SLEW = 0.0005
+
+class ScanClock(object):
+    """Maps scan rows to host epoch times, correcting for sample clock drift.
+
+    Every time a writer polls the DAQ it hands add_point() the rows scanned
+    so far and the monotonic time before and after the poll. Quick polls
+    become (host epoch, total rows) points and a straight line fit through
+    the recent points gives the real sample rate and where row 0 really was,
+    so file times follow the host (NTP/GPS disciplined) clock instead of
+    start_time + rows / sample_rate. Until the points span MIN_FIT_SPAN_SEC
+    the nominal rate and start_time are used.
+
+    The mapping never steps to a new fit: it is a line through the last row
+    it stamped, with the fitted rate nudged (see MAX_SLEW) until it meets
+    the fit. Writers on the same sample clock (chained DAQs, a capture
+    handler next to the continuous writer) share one ScanClock so a row gets
+    the same time in every directory; it is safe to use from their threads.
+    Points are also appended to filename (csv) so the fit can be redone
+    after the deployment, close() it when every writer is done.
+    """
+    def __init__(self, sample_rate, start_time, filename=None):
+        super(ScanClock, self).__init__()
+        self.sample_rate  = float(sample_rate)
+        self.start_time   = float(start_time)
+        self.filename     = filename
+        self.file         = None
+        self.closed       = False
+        self.lock         = threading.Lock()
+        # wall clock at monotonic zero, taken once so a step of the wall clock
+        # .. mid run can't bend the fit (NTP still slews the monotonic clock)
+        self.epoch_offset = time.time() - time.monotonic()
+        self.rows         = collections.deque(maxlen=MAX_CLOCK_POINTS)
+        self.times        = collections.deque(maxlen=MAX_CLOCK_POINTS)
+        self.last_point   = None
+        # row_to_epoch(row) = anchor_time + (row - anchor_row) * sec_per_row
+        self.anchor_row   = 0
+        self.anchor_time  = self.start_time
+        self.sec_per_row  = 1.0 / self.sample_rate
+        # last row handed out by row_to_epoch(), new fits are anchored there
+        self.last_row     = 0
+        # fitted rate (nominal until there is a fit)
+        self.rate         = self.sample_rate
+        self.is_fit       = False
+
+    def add_point(self, total_rows, poll_start, poll_stop):
+        """Record that total_rows had been scanned between two time.monotonic() readings."""
+        if total_rows is None or poll_stop - poll_start > MAX_POLL_SEC:
+            return(False)
+        with self.lock:
+            if self.last_point is not None and poll_stop - self.last_point < CLOCK_POINT_SEC:
+                return(False)
+            self.last_point = poll_stop
+            host_time = self.epoch_offset + (poll_start + poll_stop) / 2
+            self.rows.append(total_rows)
+            self.times.append(host_time)
+            self.fit()
+            self.write_point(host_time, total_rows, poll_stop - poll_start)
+        return(True)
+
+    def write_point(self, host_time, total_rows, poll_sec):
+        if self.filename is None or self.closed:
+            return
+        if self.file is None:
+            new_file  = not os.path.exists(self.filename)
+            # line buffered, every point is on disk as soon as it is written
+            self.file = open(self.filename, 'a', buffering=1)
+            if new_file:
+                self.file.write('host_epoch,total_rows,poll_sec,rate_hz\n')
+        self.file.write('{:.6f},{},{:.6f},{:.6f}\n'.format(host_time, total_rows, poll_sec, self.rate))
+
+    def fit(self):
+        if self.times[-1] - self.times[0] < MIN_FIT_SPAN_SEC:
+            return
+        # fit relative to the first point to keep the epoch out of the least squares
+        rows  = np.asarray(self.rows, dtype=np.float64) - self.rows[0]
+        times = np.asarray(self.times, dtype=np.float64) - self.times[0]
+        fit_sec_per_row, intercept = np.polyfit(rows, times, 1)
+        self.rate   = 1.0 / fit_sec_per_row
+        self.is_fit = True
+
+        # re-anchor on the last stamped row so the next stamp follows on from it
+        anchor_time = self.get_epoch(self.last_row)
+        fit_time    = self.times[0] + intercept + (self.last_row - self.rows[0]) * fit_sec_per_row
+        # positive when the stamps are behind the fit, so run the clock a little fast
+        slew = np.clip((fit_time - anchor_time) / CLOCK_SLEW_SEC, -MAX_SLEW, MAX_SLEW)
+        self.anchor_row  = self.last_row
+        self.anchor_time = anchor_time
+        self.sec_per_row = fit_sec_per_row * (1.0 + slew)
+
+    def get_epoch(self, row):
+        return(self.anchor_time + (row - self.anchor_row) * self.sec_per_row)
+
+    def row_to_epoch(self, row):
+        with self.lock:
+            self.last_row = max(self.last_row, row)
+            return(float(self.get_epoch(row)))
+
+    def epoch_to_row(self, epoch):
+        with self.lock:
+            return(int(round(self.anchor_row + (epoch - self.anchor_time) / self.sec_per_row)))
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,53 @@
+#
+# Woods Hole Oceanographic Institution
+# Author: Caileigh Fitzgerald
+# Email:  cfitzgerald@whoi.edu
+# Date:   06/20/2020
+#
+# File: session_log.py
+#
+import queue
+import logging
+import logging.handlers
+from datetime import datetime
+
+class SessionLog(object):
+    """Append only log for one data writer.
+
+    The log file is opened once for the whole session. Writes are put on a
+    queue and a background listener thread does the file I/O, so the writer
+    thread never waits on the disk.
+    """
+    def __init__(self, log_filename, role):
+        super(SessionLog, self).__init__()
+        self.log_filename = log_filename
+        self.role         = role
+        self.queue        = queue.Queue()
+
+        self.file_handler = logging.FileHandler(self.log_filename, mode='a')
+        # callers build their own lines (and newlines)
+        self.file_handler.terminator = ''
+        self.file_handler.setFormatter(logging.Formatter('%(message)s'))
+
+        # not registered with logging.getLogger() so every session gets its own
+        self.logger = logging.Logger('{}_log'.format(self.role), level=logging.INFO)
+        self.logger.addHandler(logging.handlers.QueueHandler(self.queue))
+
+        self.listener = logging.handlers.QueueListener(self.queue, self.file_handler)
+        self.listener.start()
+
+    def write(self, output, prefix_tstamp=False):
+        if prefix_tstamp:
+            output = '[{}]: {}'.format(datetime.now(), output)
+        self.logger.info(output)
+
+    def record(self, event, **fields):
+        """Write one key=value line, e.g. [tstamp] FILE file=... rows=..."""
+        output = ' '.join(['[{}] {}'.format(datetime.now(), event)] +
+                          ['{}={}'.format(k, v) for k, v in fields.items()])
+        self.logger.info(output + '\n')
+
+    def close(self):
+        # drains anything still queued before closing the file
+        self.listener.stop()
+        self.file_handler.close()
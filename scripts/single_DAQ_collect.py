@@ -16,6 +16,8 @@ from uldaq import (get_daq_device_inventory, DaqDevice, AInScanFlag, ScanStatus,
                    ScanOption, create_float_buffer, InterfaceType, AiInputMode, ULException)
 # from async_daq_data_handler import AsyncDAQDataHandler
 from async_daq_data_handler5 import AsyncDAQDataHandler
+from async_daq_data_handler_capture import AsyncTriggeredCaptureHandler
+from stream_detectors import ThresholdDetector, StaLtaDetector, BandEnergyDetector, DETECTORS
 # Methods for handling DAQ config and setup
 from daq_utils import (print_config, 
                        config_daq, 
@@ -25,7 +27,8 @@ from daq_utils import (print_config,
                        display_scan_options,
                        get_config_options,
                        clear_eol,
-                       reset_cursor)
+                       reset_cursor,
+                       get_scaling)
 # Methods for interactive prompt when user chooses interactive mode at runtime
 from prompt_utils import (print_title,
                           print_line,
@@ -39,6 +42,17 @@ from prompt_utils import (print_title,
 def get_loading_char(mod):
     return('/' if mod%2==0 else '\\')
 
+def get_detectors(args, channel_count, rate):
+    channels  = args.detect_channels if args.detect_channels else list(range(channel_count))
+    detectors = []
+    if 'threshold' in args.detect:
+        detectors.append(ThresholdDetector(channels, args.threshold_level))
+    if 'sta_lta' in args.detect:
+        detectors.append(StaLtaDetector(channels, rate, args.sta_sec, args.lta_sec, args.sta_lta_ratio))
+    if 'band_energy' in args.detect:
+        detectors.append(BandEnergyDetector(channels, rate, args.band_hz[0], args.band_hz[1], args.band_window_sec, args.band_level))
+    return(detectors)
+
 def main(args):
     """Single DAQ Collection CONTINUOUS."""
     daq_device     = None
@@ -46,7 +60,8 @@ def main(args):
     status         = ScanStatus.IDLE
     interface_type = InterfaceType.USB
     scan_options   = ScanOption.CONTINUOUS
-    flags          = AInScanFlag.DEFAULT
+    # raw counts skip the scaling to volts, it is applied when the data is read
+    flags          = AInScanFlag.NOSCALEDATA if args.raw_counts else AInScanFlag.DEFAULT
     data_dir       = args.data_directory
     low_channel    = 0
     high_channel   = args.channels-1
@@ -85,7 +100,8 @@ def main(args):
                      input_mode=input_mode.name, 
                      channel_range=(low_channel, high_channel), 
                      voltage_range=v_range, 
-                     scan_options=scan_options)
+                     scan_options=scan_options,
+                     mode=args.mode)
 
         if not args.script:
             try:
@@ -100,7 +116,7 @@ def main(args):
                                    rate, scan_options, flags, data)
         post_call = datetime.now()
         # average times from pre scan start and post scan start
-        start_time_epoch = datetime.fromtimestamp(int(pre_call.timestamp() + post_call.timestamp()) / 2)
+        start_time_epoch = datetime.fromtimestamp((pre_call.timestamp() + post_call.timestamp()) / 2)
 
         async_writer = AsyncDAQDataHandler(float_buffer=data, 
                                            role='SINGLE', 
@@ -112,7 +128,11 @@ def main(args):
                                            v_range=v_range,
                                            input_mode=input_mode,
                                            flags=flags,
-                                           file_length=file_length_sec)
+                                           file_length=file_length_sec,
+                                           file_mode=args.mode,
+                                           compression=args.compression,
+                                           compression_filter=args.compression_filter,
+                                           scaling=get_scaling(v_range, ai_info) if args.raw_counts else None)
         os.system('clear')
         # Print config options
         print_config(sample_rate=rate, 
@@ -121,12 +141,41 @@ def main(args):
                      input_mode=input_mode.name, 
                      channel_range=(low_channel, high_channel), 
                      voltage_range=v_range, 
-                     scan_options=scan_options)
+                     scan_options=scan_options,
+                     mode=args.mode)
+
+        # the detectors read the same buffer and write event windows to their own directory
+        event_writer = None
+        if args.detect:
+            event_dir = os.path.join(data_dir, 'EVENTS')
+            if not os.path.exists(event_dir):
+                os.makedirs(event_dir)
+            event_writer = AsyncTriggeredCaptureHandler(float_buffer=data,
+                                                        role='EVENTS',
+                                                        ai_device=ai_device,
+                                                        channel_count=channel_count,
+                                                        data_dir=event_dir,
+                                                        sample_rate=rate,
+                                                        scan_options=display_scan_options(scan_options),
+                                                        v_range=v_range,
+                                                        input_mode=input_mode,
+                                                        flags=flags,
+                                                        pre_trigger_sec=args.pre_trigger_sec,
+                                                        post_trigger_sec=args.post_trigger_sec,
+                                                        trigger_holdoff_sec=args.trigger_holdoff_sec,
+                                                        detectors=get_detectors(args, channel_count, rate),
+                                                        file_mode='binary',
+                                                        scaling=get_scaling(v_range, ai_info) if args.raw_counts else None)
 
         # start file writer thread
         async_writer.begin(start_time_epoch.timestamp())
+        if event_writer is not None:
+            # same scan, so event times come from the continuous writer's clock
+            event_writer.begin(start_time_epoch.timestamp(), clock=async_writer.clock)
         prev_index=0
         heart_beat_count=0
+        # raw counts are whole numbers
+        value_format = '{:.0f}' if args.raw_counts else '{:.6f}'
         try:
             start=time.time()
             print_line('\n | <info>CTRL + C to terminate the process</info>       ')
@@ -143,10 +192,10 @@ def main(args):
                     if heart_beat_count >= 1000:
                         heart_beat_count = 0
                     print('Scanning... {}'.format(get_loading_char(heart_beat_count)))
-                    output_str = create_output_str(transfer_status, rate)
+                    output_str = create_output_str(transfer_status, rate, raw_counts=args.raw_counts)
                     # now append channel values
                     for i in range(channel_count):
-                        output_str.append('<b>Channel</b> [<b>{}</b>] = <red>{:.6f}</red>'.format(i+low_channel, data[index + i]))
+                        output_str.append('<b>Channel</b> [<b>{}</b>] = <red>{}</red>'.format(i+low_channel, value_format.format(data[index + i])))
                     print_lines(output_str)
                     print('')
 
@@ -163,10 +212,13 @@ def main(args):
                          channel_range=(low_channel, high_channel), 
                          voltage_range=v_range, 
                          scan_options=scan_options,
+                         mode=args.mode,
                          print_head_space=False)
             raise(KeyboardInterrupt)
         finally:
             async_writer.stop()
+            if event_writer is not None:
+                event_writer.stop()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -177,11 +229,30 @@ if __name__ == '__main__':
     parser.add_argument('--debug', help='Show debugging print messages', action='store_true')
     parser.add_argument('--quiet', help='No Console Output', action='store_true')
     parser.add_argument('--verbose', help='Verbose output - may slow process on slower CPUs', action='store_true')
-    parser.add_argument('--mode', help='Data output mode', choices=['binary', 'text'], required=False)
+    parser.add_argument('--mode', help='Data output mode', choices=['binary', 'text', 'segment', 'hdf5', 'compressed'], required=False)
+    parser.add_argument('--compression', help='Codec for the compressed mode (lz4 and zstd need the lz4/zstandard packages)', choices=['gzip', 'lz4', 'zstd'], required=False)
+    parser.add_argument('--compression-filter', help='Filter applied before compressing (delta is for raw integer counts)', choices=['none', 'shuffle', 'delta'], required=False)
+    parser.add_argument('--raw-counts', help='Record raw 16-bit ADC counts (scaled to volts when plotted), needs a binary file mode', action='store_true')
+    parser.add_argument('--detect', help='Also write an event file around every detection (levels are in raw counts with --raw-counts)', nargs='+', choices=DETECTORS, required=False)
+    parser.add_argument('--detect-channels', help='Channels the detectors watch (default all)', nargs='+', type=int, required=False)
+    parser.add_argument('--threshold-level', help='Level for the threshold detector', required=False, type=float)
+    parser.add_argument('--sta-sec', help='Short term average window for the sta_lta detector', required=False, type=float)
+    parser.add_argument('--lta-sec', help='Long term average window for the sta_lta detector', required=False, type=float)
+    parser.add_argument('--sta-lta-ratio', help='STA/LTA ratio that triggers the sta_lta detector', required=False, type=float)
+    parser.add_argument('--band-hz', help='Low and high edge of the band_energy detector band', nargs=2, type=float, required=False)
+    parser.add_argument('--band-window-sec', help='Window length for the band_energy detector', required=False, type=float)
+    parser.add_argument('--band-level', help='Mean band power that triggers the band_energy detector', required=False, type=float)
+    parser.add_argument('--pre-trigger-sec', help='Seconds kept before each detection', required=False, type=float)
+    parser.add_argument('--post-trigger-sec', help='Seconds kept after each detection', required=False, type=float)
+    parser.add_argument('--trigger-holdoff-sec', help='Ignore detections this soon after the last one', required=False, type=float)
     parser.add_argument('-i', '--interactive', help='Set parameters interactively or, use passed values (or default values)', action='store_true')
     parser.add_argument('-s', '--script', help='Run from script (Will not ask for user input)', action='store_true')
     parser.add_argument('--use-config', help='Use config file', action='store_true')
-    parser.set_defaults(channels=1, sample_rate=38400, file_length_sec=1.0, data_directory=os.getcwd()+'/data', mode='text')
+    parser.set_defaults(channels=1, sample_rate=38400, file_length_sec=1.0, data_directory=os.getcwd()+'/data', mode='text',
+                        compression='gzip', compression_filter='shuffle',
+                        threshold_level=1.0, sta_sec=0.05, lta_sec=5.0, sta_lta_ratio=4.0,
+                        band_hz=[1000.0, 5000.0], band_window_sec=0.1, band_level=0.01,
+                        pre_trigger_sec=1.0, post_trigger_sec=2.0, trigger_holdoff_sec=1.0)
     args = parser.parse_args()
     if args.script:
         args.quiet = True
@@ -189,6 +260,9 @@ if __name__ == '__main__':
     if args.use_config:
         args.interactive = False
         args = get_config_options(args)
+    # checked here, the writer is only created after the scan has started
+    if args.raw_counts and args.mode == 'text':
+        parser.error('--raw-counts needs a binary file mode (--mode binary, segment, hdf5 or compressed)')
 
     time.sleep(0.2)
     os.system('clear')
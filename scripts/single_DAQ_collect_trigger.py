@@ -10,11 +10,13 @@ from __future__ import print_function
 import sys
 import time
 import os
+import signal
 import argparse
 from datetime import datetime
 from uldaq import (get_daq_device_inventory, DaqDevice, AInScanFlag, ScanStatus,
                    ScanOption, TriggerType, create_float_buffer, InterfaceType, AiInputMode, ULException)
 from async_daq_data_handler_triggered import AsyncDAQDataHandler
+from async_daq_data_handler_capture import AsyncTriggeredCaptureHandler
 # Methods for handling DAQ config and setup
 from daq_utils import (print_config, 
                        config_daq, 
@@ -35,6 +37,10 @@ from prompt_utils import (print_title,
                           path_validator, PathCompleter,
                           number_validator, float_validator, style)
 
+# minimum ring buffer length for --capture, in seconds and in event windows
+CAPTURE_BUFFER_SEC     = 30
+CAPTURE_BUFFER_WINDOWS = 4
+
 def get_loading_char(mod):
     return('/' if mod%2==0 else '\\')
 
@@ -48,7 +54,7 @@ def start_scan(ai_device, low_channel, high_channel, input_mode,
                                rate, scan_options, flags, data)
     post_call = datetime.now()
     # average times from pre scan start and post scan start
-    start_time_epoch = datetime.fromtimestamp(int(pre_call.timestamp() + post_call.timestamp()) / 2)
+    start_time_epoch = datetime.fromtimestamp((pre_call.timestamp() + post_call.timestamp()) / 2)
     return(start_time_epoch, rate)
 
 def main(args):
@@ -123,7 +129,7 @@ def main(args):
                                    rate, scan_options, flags, data)
         post_call = datetime.now()
         # average times from pre scan start and post scan start
-        start_time_epoch = datetime.fromtimestamp(int(pre_call.timestamp() + post_call.timestamp()) / 2)
+        start_time_epoch = datetime.fromtimestamp((pre_call.timestamp() + post_call.timestamp()) / 2)
 
         async_writer = AsyncDAQDataHandler(float_buffer=data, 
                                            role='SINGLE', 
@@ -226,6 +232,95 @@ def main(args):
         finally:
             async_writer.stop()
 
+def main_capture(args):
+    """Single DAQ Collection CONTINUOUS, writing a pre/post-trigger window for each trigger."""
+    interface_type = InterfaceType.USB
+    scan_options   = ScanOption.CONTINUOUS
+    flags          = AInScanFlag.DEFAULT
+    data_dir       = args.data_directory
+    low_channel    = 0
+    high_channel   = args.channels-1
+    rate           = args.sample_rate
+    window_sec     = args.pre_trigger_sec + args.post_trigger_sec
+    # the ring buffer has to hold the whole window plus time for the writer to copy it out
+    samples_per_channel = int(rate * max(CAPTURE_BUFFER_SEC, CAPTURE_BUFFER_WINDOWS * window_sec))
+    trig_mode = 'SOFTWARE (SIGUSR1)' if args.trigger_channel is None else 'CHANNEL {} >= {}'.format(args.trigger_channel, args.trigger_level)
+
+    try:
+        daq_device_params = config_daq_options(interface_type=interface_type, script=args.script)
+    except RuntimeError as e:
+        print_line(e)
+        exit(1)
+
+    with DaqDevice(daq_device_params) as daq_device:
+        ai_device, ai_info                 = config_ai_device(daq_device=daq_device)
+        input_mode, channel_count, v_range = config_daq(daq_device=daq_device,
+                                                        ai_info=ai_info,
+                                                        channel_range=(low_channel, high_channel))
+        # Allocate a buffer to receive the data.
+        data = create_float_buffer(channel_count, samples_per_channel)
+        async_writer = AsyncTriggeredCaptureHandler(float_buffer=data,
+                                                    role='SINGLE',
+                                                    ai_device=ai_device,
+                                                    channel_count=channel_count,
+                                                    data_dir=data_dir,
+                                                    sample_rate=rate,
+                                                    scan_options=display_scan_options(scan_options),
+                                                    v_range=v_range,
+                                                    input_mode=input_mode,
+                                                    flags=flags,
+                                                    pre_trigger_sec=args.pre_trigger_sec,
+                                                    post_trigger_sec=args.post_trigger_sec,
+                                                    trigger_channel=args.trigger_channel,
+                                                    trigger_level=args.trigger_level,
+                                                    file_mode=args.mode)
+        # kill -USR1 <pid> captures the window around now
+        signal.signal(signal.SIGUSR1, lambda signum, frame: async_writer.trigger(source='SIGUSR1'))
+        try:
+            start_time_epoch, ack_rate = start_scan(ai_device, low_channel, high_channel, input_mode, v_range,
+                                                    samples_per_channel, rate, scan_options, flags, data)
+            async_writer.begin(start_time_epoch.timestamp())
+            os.system('clear')
+            print_config(sample_rate=ack_rate,
+                         file_length=window_sec,
+                         data_directory=data_dir,
+                         input_mode=input_mode.name,
+                         channel_range=(low_channel, high_channel),
+                         voltage_range=v_range,
+                         scan_options=scan_options,
+                         trig_mode=trig_mode)
+            print_line('\n | <info>kill -USR1 {} to trigger a capture</info>'.format(os.getpid()))
+            print_line(  ' | <info>CTRL + C to terminate the process</info>       ')
+            print_line(  ' |----------------------------------------------------- ')
+            heart_beat_count = 0
+            while True:
+                reset_cursor()
+                clear_eol()
+                heart_beat_count += 1
+                if heart_beat_count >= 1000:
+                    heart_beat_count = 0
+                print('Scanning... {} events: {} lost: {}'.format(get_loading_char(heart_beat_count),
+                                                                  async_writer.events,
+                                                                  async_writer.events_lost))
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            os.system('clear')
+            print_config(sample_rate=rate,
+                         file_length=window_sec,
+                         data_directory=data_dir,
+                         input_mode=input_mode.name,
+                         channel_range=(low_channel, high_channel),
+                         voltage_range=v_range,
+                         scan_options=scan_options,
+                         print_head_space=False,
+                         trig_mode=trig_mode)
+            print_line('   <info><b>Events Captured:</b></info> <b><title>{}</title></b>'.format(async_writer.events))
+            raise(KeyboardInterrupt)
+        finally:
+            async_writer.stop()
+            async_writer.t.join()
+            ai_device.scan_stop()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--channels', help='Number of channels or elements on the array to record with', required=False, type=int)
@@ -237,10 +332,16 @@ if __name__ == '__main__':
     parser.add_argument('--verbose', help='Verbose output - may slow process on slower CPUs', action='store_true')
     parser.add_argument('--mode', help='Data output mode', choices=['binary', 'text'], required=False)
     parser.add_argument('--trig-type', help='Trigger type', choices=['POS_EDGE', 'NEG_EDGE', 'HIGH', 'LOW'], required=False)
+    parser.add_argument('--capture', help='Scan continuously and write a pre/post-trigger window around every trigger', action='store_true')
+    parser.add_argument('--pre-trigger-sec', help='Seconds kept before each trigger (--capture)', required=False, type=float)
+    parser.add_argument('--post-trigger-sec', help='Seconds kept after each trigger (--capture)', required=False, type=float)
+    parser.add_argument('--trigger-channel', help='Channel carrying the trigger signal, SIGUSR1 only if not set (--capture)', required=False, type=int)
+    parser.add_argument('--trigger-level', help='Trigger channel level in volts (--capture)', required=False, type=float)
     parser.add_argument('-i', '--interactive', help='Set parameters interactively or, use passed values (or default values)', action='store_true')
     parser.add_argument('-s', '--script', help='Run from script (Will not ask for user input)', action='store_true')
     parser.add_argument('--use-config', help='Use config file', action='store_true')
-    parser.set_defaults(channels=1, sample_rate=38400, file_length_sec=1.0, data_directory=os.getcwd()+'/data', mode='text', trig_type='POS_EDGE')
+    parser.set_defaults(channels=1, sample_rate=38400, file_length_sec=1.0, data_directory=os.getcwd()+'/data', mode='text', trig_type='POS_EDGE',
+                        pre_trigger_sec=1.0, post_trigger_sec=1.0, trigger_level=2.5)
     args = parser.parse_args()
     if args.script:
         args.quiet = True
@@ -315,7 +416,10 @@ if __name__ == '__main__':
         #
         #   Start main thread
         #
-        main(args)
+        if args.capture:
+            main_capture(args)
+        else:
+            main(args)
     except ULException as e:
         print_line('\n\tUL Specific Exception Thrown: ', e)
 
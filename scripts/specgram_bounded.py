@@ -14,18 +14,206 @@ from prompt_utils import print_line, print_lines, get_yes_no
 import scipy.io as sio
 import pickle as pl
 import traceback
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 
 # plot utils 
 from plot_utils import (get_data_from_list_files,
+                        iter_data_from_list_files,
+                        iter_channel_in_window,
+                        iter_channels_in_window,
                         get_files_in_window,
-                        create_specgram_fig,
+                        get_specgram_from_tiles,
+                        create_streamed_specgram_fig,
+                        create_tiled_specgram_fig,
                         save_mat,
+                        create_mat_file,
                         create_mat_params,
                         get_files,
+                        get_archive_window,
                         create_data_dir,
                         get_fig_dir,
                         create_time_vector)
 from common_argparse import get_specgram_bounded_args
+from data_file_utils import ARCHIVE_MODES, has_h5py
+from streaming_stft import StreamingSpectrogram, StreamingEnvelope, get_decimation, get_noverlap
+
+def get_png_file_name(role, channel, window_start):
+    return('{}_CH{}_{}'.format(role, channel, window_start))
+
+def get_specgram_title(role, channel, start, end):
+    title = 'Data for Channel {} on {} DAQ device'.format(channel, role)
+    title = title.replace(' ', '\ ')
+    return(r"$\bf{" + title + "}$\n" + 'Start: {}, Stop: {}, Duration: {}'.format(start, end, str(end - start)))
+
+#
+# This method returns the StreamingSpectrogram and StreamingEnvelope that one
+# .. channel of a window is fed through
+def create_window_streams(start, end, NFFT, Fs, max_columns):
+    window_samples = int((end - start).total_seconds() * Fs)
+    noverlap       = get_noverlap(NFFT)
+    spectrogram    = StreamingSpectrogram(NFFT=NFFT, Fs=Fs, noverlap=noverlap,
+                                          decimate=get_decimation(window_samples, NFFT, noverlap, max_columns))
+    envelope       = StreamingEnvelope(samples_per_point=(window_samples // max_columns) if max_columns else 1)
+    return(spectrogram, envelope)
+
+#
+# This method runs blocks (arrays of samples, in order) of one channel through
+# .. a StreamingSpectrogram and saves the figure for the window
+def create_window_specgram(blocks, role, channel, window_start, start, end, NFFT, Fs, max_columns, fig_dir,
+                           pickle_fig=False, show=False, print_success=True):
+    #
+    #   Stream the window through the spectrogram a block at a time
+    #   .. only the (decimated) spectrogram and a min/max envelope of the
+    #   .. voltage are kept, never the whole window
+    #
+    spectrogram, envelope = create_window_streams(start, end, NFFT, Fs, max_columns)
+    for block in blocks:
+        spectrogram.feed(block)
+        envelope.feed(block)
+
+    # this will create and save the figure
+    create_streamed_specgram_fig(spectrogram=spectrogram,
+                                 envelope=envelope,
+                                 fig_dir=fig_dir,
+                                 png_file_name=get_png_file_name(role, channel, window_start),
+                                 title=get_specgram_title(role, channel, start, end),
+                                 start_time=start,
+                                 selected_channel=channel,
+                                 pickle_fig=pickle_fig,
+                                 show=show,
+                                 print_success=print_success)
+
+def append_to_mat(blocks, mat_writer):
+    # hands the blocks on after adding them to the .mat
+    for block in blocks:
+        mat_writer.append('voltage_vector', block)
+        yield(block)
+
+def init_batch_worker():
+    # workers only ever write files
+    plt.switch_backend('Agg')
+
+#
+# This method is run in a batch worker process: it reads the window once, a
+# .. piece of every channel at a time (see iter_channels_in_window), feeds each
+# .. channel through its own spectrogram and saves a figure per channel
+def render_window_specgrams(job):
+    pieces = iter_channels_in_window(path=job['path'],
+                                     files=job['files'],
+                                     role=job['role'],
+                                     channels=job['channels'],
+                                     start_t=job['start'].timestamp(),
+                                     end_t=job['end'].timestamp() - 1e-6,
+                                     mode=job['mode'])
+    first = next(pieces, None)
+    if first is None:
+        return([])
+    window_start = first[0]
+    streams = [create_window_streams(job['start'], job['end'], job['NFFT'], job['Fs'], job['max_columns']) for _ in job['channels']]
+    for rows in itertools.chain([first[1]], (rows for _, rows in pieces)):
+        for column, (spectrogram, envelope) in enumerate(streams):
+            spectrogram.feed(rows[:, column])
+            envelope.feed(rows[:, column])
+
+    png_files = []
+    for channel, (spectrogram, envelope) in zip(job['channels'], streams):
+        png_file_name = get_png_file_name(job['role'], channel, window_start)
+        create_streamed_specgram_fig(spectrogram=spectrogram,
+                                     envelope=envelope,
+                                     fig_dir=job['fig_dir'],
+                                     png_file_name=png_file_name,
+                                     title=get_specgram_title(job['role'], channel, job['start'], job['end']),
+                                     start_time=job['start'],
+                                     selected_channel=channel,
+                                     pickle_fig=job['pickle_fig'],
+                                     show=False,
+                                     print_success=False)
+        png_files.append('{}/{}.png'.format(job['fig_dir']['fig'], png_file_name))
+    return(png_files)
+
+#
+# This method plots the window from the spectrogram tile cache (see
+# .. build_specgram_tiles.py), returns False if any of its tiles are missing
+def create_tiled_specgram(args, role, fig_dir):
+    tile, missing = get_specgram_from_tiles(path=args.data_directory,
+                                            role=role,
+                                            channel=args.channel,
+                                            NFFT=args.nfft,
+                                            Fs=args.sample_rate,
+                                            start_t=args.start.timestamp(),
+                                            end_t=args.end.timestamp(),
+                                            max_columns=args.max_columns)
+    if missing:
+        if not args.script:
+            print_line('{} spectrogram tile(s) missing for this window, using the data files'.format(missing), l_style='info_italic')
+        return(False)
+    if tile is None:
+        # every tile of the window is empty, the data files will say there is no data
+        return(False)
+    # named by the first sample in the first column like the figures made from the data
+    window_start = tile['times'][0] - float(tile['NFFT']) / (2.0 * args.sample_rate) if len(tile['times']) else args.start.timestamp()
+    create_tiled_specgram_fig(tile=tile,
+                              fig_dir=fig_dir,
+                              png_file_name=get_png_file_name(role, args.channel, window_start),
+                              title=get_specgram_title(role, args.channel, args.start, args.end),
+                              start_time=args.start,
+                              selected_channel=args.channel,
+                              pickle_fig=args.pickle,
+                              show=args.display,
+                              print_success=(not args.script))
+    return(True)
+
+#
+# This method fans (role, window) jobs out to a process pool. A job reads its
+# .. window once for every --channels channel, a piece at a time, so memory
+# .. doesn't grow with --window-sec and no file is read twice. Windows (and
+# .. roles) run in parallel, split a long window with --window-sec
+def run_batch(args, data_files, fig_dir):
+    if args.mat:
+        print_line('--mat is not made in --batch mode, run without --batch to save .mat files', l_style='error')
+    channels = args.channels if args.channels else [args.channel]
+    window   = datetime.timedelta(seconds=args.window_sec) if args.window_sec else args.end - args.start
+    windows  = []
+    window_start_time = args.start
+    while window_start_time < args.end:
+        windows.append((window_start_time, min(window_start_time + window, args.end)))
+        window_start_time += window
+
+    futures = []
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_batch_worker) as pool:
+        for r in args.role:
+            for start, end in windows:
+                files_in_window = []
+                if args.mode not in ARCHIVE_MODES:
+                    # windows are half open so a file on a boundary is only plotted once
+                    files_in_window = get_files_in_window(files=data_files[r],
+                                                          start_t=start.timestamp(),
+                                                          end_t=end.timestamp() - 1e-6)
+                    if len(files_in_window) == 0:
+                        print_line('No {} data between {} and {}'.format(r, start, end))
+                        continue
+                job = dict(path=args.data_directory,
+                           files=files_in_window,
+                           mode=args.mode,
+                           role=r,
+                           channels=channels,
+                           start=start,
+                           end=end,
+                           NFFT=args.nfft,
+                           Fs=args.sample_rate,
+                           max_columns=args.max_columns,
+                           fig_dir=fig_dir[r],
+                           pickle_fig=args.pickle)
+                futures.append((r, start, end, pool.submit(render_window_specgrams, job)))
+
+    for r, start, end, future in futures:
+        # re-raises anything a worker raised
+        png_files = future.result()
+        if len(png_files) == 0:
+            print_line('No {} data between {} and {}'.format(r, start, end))
+        for png_file in png_files:
+            print_line('<info_italic>Created:</info_italic> {}'.format(png_file))
 
 def main(args):
     #
@@ -59,7 +247,8 @@ def main(args):
     role = args.role
 
     for r in role:
-        data_files[r] = get_files(path=args.data_directory, role=r)
+        # archive modes are read by time window, there is no list of files
+        data_files[r] = [] if args.mode in ARCHIVE_MODES else get_files(path=args.data_directory, role=r, mode=args.mode)
         fig_dir[r]    = get_fig_dir(path=args.data_directory, 
                                     role=r, 
                                     postfix=args.postfix,
@@ -67,6 +256,15 @@ def main(args):
                                     pickle_fig=args.pickle)
         data[r]       = []
         figs[r]       = []
+
+    if args.batch:
+        run_batch(args, data_files, fig_dir)
+        return
+    # the streamed (v7.3) .mat is written with h5py, without it use scipy like --mat-iso
+    mat_v73 = args.mat and not args.mat_iso
+    if mat_v73 and not has_h5py():
+        print_line('h5py is not installed (pip install h5py), writing a version 5 .mat with scipy that holds the whole window in memory', l_style='error')
+        mat_v73 = False
     # batch size for how many files to read at once
     # .. if duration is 1 hour,
     # .. 60 sec * 60 mins = 3600 seconds, 
@@ -81,11 +279,30 @@ def main(args):
     # loop through all the roles and create plots
     while True:
         for i in range(len(role)):
-            files_in_window = get_files_in_window(files=data_files[role[i]], 
-                                                  start_t=args.start.timestamp(), 
-                                                  end_t=args.end.timestamp())
+            # the .mat needs the samples themselves
+            if args.tiles and not args.mat and create_tiled_specgram(args, role[i], fig_dir[role[i]]):
+                continue
+            window_start = None
+            if args.mode in ARCHIVE_MODES:
+                # the archive is streamed a piece at a time, the first one gives the window start
+                pieces = iter_channel_in_window(path=args.data_directory,
+                                                files=[],
+                                                role=role[i],
+                                                channel=args.channel,
+                                                start_t=args.start.timestamp(),
+                                                end_t=args.end.timestamp(),
+                                                mode=args.mode)
+                first_piece = next(pieces, None)
+                if first_piece is not None:
+                    window_start = first_piece[0]
+            else:
+                files_in_window = get_files_in_window(files=data_files[role[i]], 
+                                                      start_t=args.start.timestamp(), 
+                                                      end_t=args.end.timestamp())
+                if len(files_in_window) > 0:
+                    window_start = float(files_in_window[0].stem)
 
-            if len(files_in_window) <= 0:
+            if window_start is None:
                 # no files... possible duration is off or empty directory
                 if duration > args.file_length_sec:
                     # no files in directory
@@ -112,45 +329,70 @@ def main(args):
 
             if not args.script: print_line('Starting plots for <info_italic>{} DAQ</info_italic> data:'.format(role[i]))
 
-            data = get_data_from_list_files(files_in_window, args.channel)
-
-            # Now plot data and save
-            title = 'Data for Channel {} on {} DAQ device'.format(args.channel, role[i])
-            title = title.replace(' ', '\ ')
-
-            full_title = r"$\bf{" + title + "}$\n" + 'Start: {}, Stop: {}, Duration: {}'.format(args.start, args.end, duration_str)
-            # setup our vector for number of samples
-            t = np.linspace(0.0, len(data), len(data))
-
-            # creates uniform time vector
-            # !! This should not be used for data that is not contiguous !
-            err, t_vect = create_time_vector(data=data,
-                                             dt_between_samples=(1 / Fs),
-                                             start_t=args.start,
-                                             is_data_contiguous=True)
-
-            x = np.array(data)
             # create the png file name
-            png_file_name = '{}_CH{}_{}'.format(role[i], args.channel, float(files_in_window[0].stem))
+            png_file_name = get_png_file_name(role[i], args.channel, window_start)
+            if args.mode in ARCHIVE_MODES:
+                blocks = itertools.chain([first_piece[1]], (samples for _, samples in pieces))
+            else:
+                # a block of files at a time
+                blocks = iter_data_from_list_files(files_in_window, args.channel)
+            mat_writer = None
+            if mat_v73:
+                # the samples go into the .mat as they stream through the spectrogram
+                mat_writer, mat_fname = create_mat_file(window_start=window_start,
+                                                        NFFT=NFFT,
+                                                        Fs=Fs,
+                                                        fig_dir=fig_dir[role[i]],
+                                                        png_file_name=png_file_name,
+                                                        selected_channel=args.channel,
+                                                        role=role[i])
+                blocks = append_to_mat(blocks, mat_writer)
             try:
-                # this will create and save the figure
-                create_specgram_fig(t=t, x=x, NFFT=NFFT, Fs=Fs,
-                                    fig_dir=fig_dir[role[i]],
-                                    png_file_name=png_file_name, 
-                                    title=full_title, 
-                                    start_time=args.start, 
-                                    selected_channel=args.channel, 
-                                    pickle_fig=args.pickle, 
-                                    show=args.display,
-                                    print_success=(not args.script))
+                # Now plot data and save
+                create_window_specgram(blocks=blocks,
+                                       role=role[i],
+                                       channel=args.channel,
+                                       window_start=window_start,
+                                       start=args.start,
+                                       end=args.end,
+                                       NFFT=NFFT,
+                                       Fs=Fs,
+                                       max_columns=args.max_columns,
+                                       fig_dir=fig_dir[role[i]],
+                                       pickle_fig=args.pickle,
+                                       show=args.display,
+                                       print_success=(not args.script))
             except RuntimeError as e:
                 if not args.script:
                     print_line('{}'.format(e.args[0]), l_style='error')
                     return
                 else:
                     raise
+            finally:
+                if mat_writer is not None:
+                    mat_writer.close()
+                    if not args.script:
+                        print_line('<info_italic>Created:</info_italic> {}.mat'.format(mat_fname))
+
+            if args.mat and not mat_v73:
+                # the version 5 .mat holds every sample in the window (and its ISO time with --mat-iso)
+                if args.mode in ARCHIVE_MODES:
+                    data = get_archive_window(path=args.data_directory,
+                                              role=role[i],
+                                              start_t=args.start.timestamp(),
+                                              end_t=args.end.timestamp(),
+                                              mode=args.mode)[1][:, args.channel]
+                else:
+                    data = get_data_from_list_files(files_in_window, args.channel)
+
+                # creates uniform time vector
+                # !! This should not be used for data that is not contiguous !
+                err, t_vect = create_time_vector(data=data,
+                                                 dt_between_samples=(1 / Fs),
+                                                 start_t=args.start,
+                                                 is_data_contiguous=True)
 
-            if args.mat:
+                x = np.asarray(data)
                 # create .mat
                 params, fname = create_mat_params(t_vect=t_vect, 
                                                   t_vect_precision_error=err, 
@@ -160,7 +402,8 @@ def main(args):
                                                   fig_dir=fig_dir[role[i]], 
                                                   png_file_name=png_file_name, 
                                                   selected_channel=args.channel, 
-                                                  role=role[i])
+                                                  role=role[i],
+                                                  iso_times=args.mat_iso)
                 save_mat(params=params, 
                          fname=fname, 
                          print_success=(not args.script))
@@ -0,0 +1,182 @@
+import os
+import numpy as np
+from streaming_stft import StreamingSpectrogram, get_noverlap
+
+# Spectrogram tiles are kept next to the data in '<role>_DAQ/specgram_tiles/'
+# .. one directory per channel and NFFT with a directory per level
+# .. '<tile dir>/ch<channel>_nfft<NFFT>/level<k>/<tile start epoch>.npz'
+TILE_DIRNAME = 'specgram_tiles'
+# a level 0 tile holds every spectrogram column of TILE_SEC seconds, a level k
+# .. tile covers TILE_SEC * 2**k seconds with every two level k-1 columns averaged
+TILE_SEC = 60
+# levels 0-6, the top level tiles are 64 minutes
+TILE_LEVELS = 7
+# fields of a tile, columns are rows of db (columns, freqs)
+TILE_FIELDS = ['db', 'times', 'v_min', 'v_max', 'freqs', 'Fs', 'NFFT']
+
+def get_tile_sec(level):
+    return(TILE_SEC * 2 ** level)
+
+def get_tile_start(epoch, level):
+    """Start of the level tile that epoch falls in (tiles are aligned to the epoch)."""
+    tile_sec = get_tile_sec(level)
+    return(int(epoch // tile_sec) * tile_sec)
+
+def get_tile_dir(data_dir, channel, NFFT, level):
+    return('{}/{}/ch{}_nfft{}/level{}'.format(data_dir, TILE_DIRNAME, channel, NFFT, level))
+
+def get_tile_filename(tile_dir, tile_start):
+    return('{}/{}.npz'.format(tile_dir, tile_start))
+
+def to_db(power):
+    return((10. * np.log10(np.maximum(power, np.finfo(np.float64).tiny))).astype(np.float32))
+
+def compute_tile(x, start_epoch, NFFT, Fs):
+    """Level 0 tile of x, the samples of one channel from start_epoch on.
+
+    Columns are the same as specgram_bounded.py draws (see streaming_stft.py)
+    and every column keeps the min and max of its samples for the voltage plot.
+    """
+    x           = np.asarray(x, dtype=np.float64)
+    spectrogram = StreamingSpectrogram(NFFT=NFFT, Fs=Fs, noverlap=get_noverlap(NFFT))
+    spectrogram.feed(x)
+    Pxx, freqs, bins = spectrogram.finish()
+    frames      = spectrogram.get_frames(x)
+    return({
+        'db':    to_db(Pxx.T),
+        'times': start_epoch + bins,
+        'v_min': frames.min(axis=1).astype(np.float32),
+        'v_max': frames.max(axis=1).astype(np.float32),
+        'freqs': freqs,
+        'Fs':    np.float64(Fs),
+        'NFFT':  np.int64(NFFT),
+    })
+
+def decimate_tile(tile, factor):
+    """Average every factor columns of tile (as power) into one."""
+    columns = len(tile['times'])
+    if factor <= 1 or columns == 0:
+        return(tile)
+    starts = np.arange(0, columns, factor)
+    counts = np.diff(np.append(starts, columns))
+    power  = np.power(10., tile['db'].astype(np.float64) / 10.)
+    return(dict(tile,
+                db=to_db(np.add.reduceat(power, starts, axis=0) / counts[:, np.newaxis]),
+                times=np.add.reduceat(tile['times'], starts) / counts,
+                v_min=np.minimum.reduceat(tile['v_min'], starts),
+                v_max=np.maximum.reduceat(tile['v_max'], starts)))
+
+def concatenate_tiles(tiles):
+    tile = dict(tiles[0])
+    for field in ['db', 'times', 'v_min', 'v_max']:
+        tile[field] = np.concatenate([t[field] for t in tiles])
+    return(tile)
+
+def save_tile(filename, tile):
+    # written beside its final name and moved into place so readers never see half a tile
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = '{}.tmp'.format(filename)
+    with open(tmp_filename, 'wb') as f:
+        np.savez(f, **tile)
+    os.replace(tmp_filename, filename)
+
+def load_tile(filename):
+    with np.load(filename) as f:
+        return({field: f[field] for field in TILE_FIELDS})
+
+def is_tile_current(filename, sources):
+    """True if filename exists and is newer than every file in sources."""
+    if not os.path.exists(filename):
+        return(False)
+    mtime = os.path.getmtime(filename)
+    return(all(os.path.getmtime(source) <= mtime for source in sources))
+
+def build_tiles(read_window, list_sources, data_dir, channels, NFFT, Fs, start_t, end_t, rebuild=False):
+    """Build every tile of channels that lies completely inside [start_t, end_t).
+
+    read_window(start_t, end_t) returns the start epoch of the first sample
+    and a (samples, len(channels)) array of the data in the window, or
+    (None, None) when there isn't any. A minute without data gets an empty
+    tile (no columns) so readers know it isn't missing. list_sources(start_t,
+    end_t) returns the files the window is read from, a level 0 tile is
+    redone when one of them is newer, a higher level when one of its two
+    halves is. Returns the number of tiles written.
+    """
+    written = 0
+    tile_start = get_tile_start(start_t, 0)
+    while tile_start + TILE_SEC <= end_t:
+        # a tile is the files starting inside it, the same as a window in specgram_bounded.py
+        tile_end  = tile_start + TILE_SEC - 1e-6
+        filenames = [get_tile_filename(get_tile_dir(data_dir, channel, NFFT, 0), tile_start) for channel in channels]
+        sources   = list_sources(tile_start, tile_end)
+        if rebuild or not all(is_tile_current(filename, sources) for filename in filenames):
+            window_start, rows = read_window(tile_start, tile_end)
+            for i, filename in enumerate(filenames):
+                if window_start is None:
+                    save_tile(filename, compute_tile(np.empty(0), tile_start, NFFT, Fs))
+                else:
+                    save_tile(filename, compute_tile(rows[:, i], window_start, NFFT, Fs))
+                written += 1
+        tile_start += TILE_SEC
+
+    for level in range(1, TILE_LEVELS):
+        half_sec = get_tile_sec(level - 1)
+        for channel in channels:
+            half_dir = get_tile_dir(data_dir, channel, NFFT, level - 1)
+            tile_dir = get_tile_dir(data_dir, channel, NFFT, level)
+            tile_start = get_tile_start(start_t, level)
+            while tile_start + 2 * half_sec <= end_t:
+                halves = [get_tile_filename(half_dir, tile_start + i * half_sec) for i in range(2)]
+                halves = [half for half in halves if os.path.exists(half)]
+                filename = get_tile_filename(tile_dir, tile_start)
+                if halves and (rebuild or not is_tile_current(filename, halves)):
+                    save_tile(filename, decimate_tile(concatenate_tiles([load_tile(half) for half in halves]), 2))
+                    written += 1
+                tile_start += 2 * half_sec
+    return(written)
+
+def get_tile_level(duration, NFFT, Fs, max_columns):
+    """Lowest level that draws duration seconds in at most max_columns columns."""
+    if not max_columns:
+        return(0)
+    columns = duration * Fs / (NFFT - get_noverlap(NFFT))
+    level   = int(np.ceil(np.log2(max(columns / max_columns, 1.0))))
+    return(min(level, TILE_LEVELS - 1))
+
+def read_tile_window(data_dir, channel, NFFT, Fs, start_t, end_t, max_columns=None):
+    """Spectrogram of [start_t, end_t) put together from the cached tiles.
+
+    Returns the tile (see compute_tile) of the window, averaged down to at
+    most max_columns columns, and the number of tiles the window needed
+    that aren't in the cache. Empty tiles (no data) aren't missing, the
+    tile is None if none of the tiles found have any columns.
+    """
+    # the top levels of the last hours aren't built until the hours are over
+    # .. so drop down a level until the window is covered (or level 0 is reached)
+    for level in range(get_tile_level(end_t - start_t, NFFT, Fs, max_columns), -1, -1):
+        tile_dir   = get_tile_dir(data_dir, channel, NFFT, level)
+        filenames  = []
+        missing    = 0
+        tile_start = get_tile_start(start_t, level)
+        while tile_start < end_t:
+            filename = get_tile_filename(tile_dir, tile_start)
+            if os.path.exists(filename):
+                filenames.append(filename)
+            else:
+                missing += 1
+            tile_start += get_tile_sec(level)
+        if not missing:
+            break
+    tiles = [tile for tile in (load_tile(filename) for filename in filenames) if len(tile['times'])]
+    if not tiles:
+        return(None, missing)
+
+    tile = concatenate_tiles(tiles)
+    if float(tile['Fs']) != float(Fs):
+        raise RuntimeError('Spectrogram tiles in {} are for {} Hz not {} Hz'.format(tile_dir, float(tile['Fs']), Fs))
+    keep = (tile['times'] >= start_t) & (tile['times'] < end_t)
+    for field in ['db', 'times', 'v_min', 'v_max']:
+        tile[field] = tile[field][keep]
+    if max_columns:
+        tile = decimate_tile(tile, int(np.ceil(len(tile['times']) / float(max_columns))))
+    return(tile, missing)
@@ -0,0 +1,164 @@
+import numpy as np
+
+DETECTORS     = ['threshold', 'sta_lta', 'band_energy']
+TRIGGER_EDGES = ['rising', 'falling']
+
+def get_onsets(on, last_on):
+    """Rows where any channel of on, a (rows, channels) bool array, switches on.
+
+    last_on is the last row of the previous block (None after a gap) so an
+    onset on a block boundary is found exactly once.
+    """
+    previous = np.empty_like(on)
+    previous[0]  = on[0] if last_on is None else last_on
+    previous[1:] = on[:-1]
+    return(np.flatnonzero((on & ~previous).any(axis=1)))
+
+class ThresholdDetector(object):
+    """Triggers when a channel crosses its level (one level or one per channel)."""
+    def __init__(self, channels, levels, edge='rising'):
+        super(ThresholdDetector, self).__init__()
+        if edge not in TRIGGER_EDGES:
+            raise ValueError('Unknown trigger edge \"{}\" (expected one of: {})'.format(edge, ', '.join(TRIGGER_EDGES)))
+        self.channels = list(channels)
+        self.levels   = np.broadcast_to(np.asarray(levels, dtype=np.float64), (len(self.channels),))
+        self.edge     = edge
+        self.name     = 'threshold_ch{}'.format('_'.join(str(c) for c in self.channels))
+        self.reset()
+
+    def reset(self):
+        self.last_on = None
+
+    def describe(self):
+        return('{} edge at {} on channels {}'.format(self.edge, self.levels.tolist(), self.channels))
+
+    def process(self, rows):
+        """Row offsets in rows (the next rows of the stream) where a trigger starts."""
+        values = rows[:, self.channels]
+        on     = (values >= self.levels) if self.edge == 'rising' else (values <= self.levels)
+        onsets = get_onsets(on, self.last_on)
+        self.last_on = on[-1]
+        return(onsets)
+
+class MovingSum(object):
+    """Sum of the last window_rows rows of a stream, after every row.
+
+    Keeps a running total and a ring of the rows inside the window, so a
+    block costs O(rows in the block) however long the window is. The total
+    is summed again from the ring once every window_rows rows so rounding
+    can't build up.
+    """
+    def __init__(self, window_rows, channels):
+        super(MovingSum, self).__init__()
+        self.window_rows = int(window_rows)
+        self.ring        = np.zeros((self.window_rows, channels))
+        self.total       = np.zeros(channels)
+        # rows seen so far
+        self.rows        = 0
+
+    def process(self, x):
+        """(rows, channels) sums of the window ending on every row of x (short while it fills)."""
+        rows = len(x)
+        if rows == 0:
+            return(np.empty((0, len(self.total))))
+        # the rows leaving the window as each row of x comes in (zeros while it fills)
+        leaving = np.empty_like(x)
+        from_ring = min(rows, self.window_rows)
+        leaving[:from_ring] = self.ring[(self.rows + np.arange(from_ring)) % self.window_rows]
+        leaving[from_ring:] = x[:rows - from_ring]
+        sums = self.total + np.cumsum(x - leaving, axis=0)
+
+        tail = x[-self.window_rows:]
+        self.ring[(self.rows + rows - len(tail) + np.arange(len(tail))) % self.window_rows] = tail
+        windows_before = self.rows // self.window_rows
+        self.rows += rows
+        if self.rows // self.window_rows != windows_before:
+            self.total = self.ring.sum(axis=0)
+        else:
+            self.total = sums[-1]
+        return(sums)
+
+class StaLtaDetector(object):
+    """Short term / long term average of the signal energy (classic STA/LTA).
+
+    Both averages are moving means of x^2 kept as running sums (MovingSum)
+    that carry across blocks, so each poll only costs the rows it brings.
+    Nothing triggers until the first lta window is full.
+    """
+    def __init__(self, channels, sample_rate, sta_sec, lta_sec, ratio):
+        super(StaLtaDetector, self).__init__()
+        self.channels = list(channels)
+        self.sta_rows = max(int(round(sta_sec * sample_rate)), 1)
+        self.lta_rows = max(int(round(lta_sec * sample_rate)), self.sta_rows + 1)
+        self.ratio    = ratio
+        self.name     = 'sta_lta'
+        self.reset()
+
+    def reset(self):
+        self.sta      = MovingSum(self.sta_rows, len(self.channels))
+        self.lta      = MovingSum(self.lta_rows, len(self.channels))
+        self.last_on  = None
+
+    def describe(self):
+        return('sta {} rows / lta {} rows >= {} on channels {}'.format(self.sta_rows, self.lta_rows, self.ratio, self.channels))
+
+    def process(self, rows):
+        energy  = np.square(rows[:, self.channels], dtype=np.float64)
+        seen    = self.lta.rows
+        sta     = self.sta.process(energy) / self.sta_rows
+        lta     = self.lta.process(energy) / self.lta_rows
+        # first row of the block with a full lta window behind it
+        first   = max(self.lta_rows - 1 - seen, 0)
+        if first >= len(rows):
+            return(np.empty(0, dtype=np.intp))
+        on      = sta[first:] >= self.ratio * np.maximum(lta[first:], np.finfo(np.float64).tiny)
+        onsets  = get_onsets(on, self.last_on)
+        self.last_on = on[-1]
+        return(onsets + first)
+
+class BandEnergyDetector(object):
+    """Triggers when the mean power between low_hz and high_hz in a window reaches level.
+
+    The stream is cut into back to back windows of window_sec and every
+    window of the block goes through one rfft, rows left over at the end of
+    a block wait for the next one. Triggers are reported at the window start.
+    """
+    def __init__(self, channels, sample_rate, low_hz, high_hz, window_sec, level):
+        super(BandEnergyDetector, self).__init__()
+        self.channels    = list(channels)
+        self.window_rows = max(int(round(window_sec * sample_rate)), 2)
+        freqs            = np.fft.rfftfreq(self.window_rows, 1.0 / sample_rate)
+        self.band        = (freqs >= low_hz) & (freqs <= high_hz)
+        if not self.band.any():
+            raise ValueError('No frequency bins between {} and {} Hz, use a longer window'.format(low_hz, high_hz))
+        self.window      = np.hanning(self.window_rows)[:, np.newaxis]
+        self.low_hz      = low_hz
+        self.high_hz     = high_hz
+        self.level       = level
+        self.name        = 'band_energy'
+        self.reset()
+
+    def reset(self):
+        self.leftover = np.empty((0, len(self.channels)))
+        self.last_on  = None
+
+    def describe(self):
+        return('{}-{} Hz power >= {} in {} row windows on channels {}'.format(self.low_hz, self.high_hz, self.level,
+                                                                              self.window_rows, self.channels))
+
+    def process(self, rows):
+        values   = np.concatenate((self.leftover, rows[:, self.channels]))
+        carried  = len(self.leftover)
+        windows  = len(values) // self.window_rows
+        self.leftover = values[windows * self.window_rows:].copy()
+        if windows == 0:
+            return(np.empty(0, dtype=np.intp))
+        # (windows, window_rows, channels)
+        frames   = values[:windows * self.window_rows].reshape(windows, self.window_rows, -1)
+        frames   = frames - frames.mean(axis=1, keepdims=True)
+        spectrum = np.fft.rfft(frames * self.window, axis=1)
+        power    = np.square(np.abs(spectrum[:, self.band])).mean(axis=1) / self.window_rows
+        on       = power >= self.level
+        onsets   = get_onsets(on, self.last_on)
+        self.last_on = on[-1]
+        return(onsets * self.window_rows - carried)
@@ -0,0 +1,115 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# ax.specgram() overlaps 128 samples by default
+SPECGRAM_NOVERLAP = 128
+
+def get_noverlap(NFFT):
+    # short segments overlap by half instead
+    return(min(SPECGRAM_NOVERLAP, NFFT // 2))
+
+def get_decimation(samples, NFFT, noverlap, max_columns):
+    """Columns to average together so a window of samples gives at most max_columns."""
+    if not max_columns:
+        return(1)
+    columns = max((samples - NFFT) // (NFFT - noverlap) + 1, 1)
+    return(max(int(np.ceil(columns / float(max_columns))), 1))
+
+class StreamingSpectrogram(object):
+    """Spectrogram of a signal that arrives a block at a time.
+
+    Each feed() transforms the columns whose NFFT samples are complete and
+    keeps the samples the next column still needs, so the result is the
+    same for any block size and only one block of samples is held at once.
+    Columns are scaled like matplotlib's specgram (one sided power spectral
+    density, Hanning window). With decimate > 1 every decimate columns are
+    averaged into one, which keeps day long windows to a plottable size.
+    """
+    def __init__(self, NFFT, Fs, noverlap=SPECGRAM_NOVERLAP, decimate=1):
+        super(StreamingSpectrogram, self).__init__()
+        if not 0 <= noverlap < NFFT:
+            raise ValueError('noverlap ({}) must be less than NFFT ({})'.format(noverlap, NFFT))
+        self.NFFT     = int(NFFT)
+        self.Fs       = float(Fs)
+        self.noverlap = int(noverlap)
+        self.step     = self.NFFT - self.noverlap
+        self.decimate = max(int(decimate), 1)
+        self.window   = np.hanning(self.NFFT)
+        self.freqs    = np.fft.rfftfreq(self.NFFT, 1.0 / self.Fs)
+        # density scaling, doubled for the negative frequencies folded into the one sided spectrum
+        self.scale    = np.full(len(self.freqs), 2.0 / (self.Fs * np.sum(self.window ** 2)))
+        self.scale[0] /= 2.0
+        if self.NFFT % 2 == 0:
+            self.scale[-1] /= 2.0
+        # samples waiting for the rest of their column
+        self.carry    = np.empty(0)
+        # columns waiting for the rest of their decimated column
+        self.pending  = np.empty((0, len(self.freqs)))
+        self.columns  = []
+        self.columns_done = 0
+
+    def get_frames(self, x):
+        """(frames, NFFT) view of every complete column in x."""
+        frames = (len(x) - self.NFFT) // self.step + 1 if len(x) >= self.NFFT else 0
+        return(as_strided(x, shape=(frames, self.NFFT), strides=(x.strides[0] * self.step, x.strides[0]), writeable=False))
+
+    def feed(self, x):
+        x      = np.concatenate((self.carry, np.asarray(x, dtype=np.float64).ravel()))
+        frames = self.get_frames(x)
+        # the next column starts right after the last full step
+        self.carry = x[len(frames) * self.step:].copy()
+        if len(frames) == 0:
+            return
+        power = np.square(np.abs(np.fft.rfft(frames * self.window, axis=1))) * self.scale
+        self.add_columns(power)
+
+    def add_columns(self, power):
+        power  = np.concatenate((self.pending, power))
+        groups = len(power) // self.decimate
+        self.pending = power[groups * self.decimate:]
+        if groups > 0:
+            self.columns.append(power[:groups * self.decimate].reshape(groups, self.decimate, -1).mean(axis=1))
+
+    def finish(self):
+        """(Pxx, freqs, bins) like mlab.specgram, Pxx is (freqs, columns) and bins are seconds from the first sample."""
+        columns = self.columns
+        if len(self.pending):
+            columns = columns + [self.pending.mean(axis=0, keepdims=True)]
+        Pxx = np.concatenate(columns).T if columns else np.empty((len(self.freqs), 0))
+        # every output column is centred on the middle of the columns averaged into it
+        first_column = np.arange(Pxx.shape[1]) * self.decimate
+        last_column  = np.minimum(first_column + self.decimate, self.get_column_count()) - 1
+        bins = (self.NFFT / 2.0 + (first_column + last_column) / 2.0 * self.step) / self.Fs
+        return(Pxx, self.freqs, bins)
+
+    def get_column_count(self):
+        """Columns (before decimation) transformed so far."""
+        return(sum(len(c) for c in self.columns) * self.decimate + len(self.pending))
+
+class StreamingEnvelope(object):
+    """Min and max of every samples_per_point samples of a signal that arrives a block at a time."""
+    def __init__(self, samples_per_point):
+        super(StreamingEnvelope, self).__init__()
+        self.samples_per_point = max(int(samples_per_point), 1)
+        self.carry   = np.empty(0)
+        self.samples = 0
+        self.points  = []
+
+    def feed(self, x):
+        x      = np.concatenate((self.carry, np.asarray(x, dtype=np.float64).ravel()))
+        points = len(x) // self.samples_per_point
+        self.carry = x[points * self.samples_per_point:].copy()
+        if points == 0:
+            return
+        blocks = x[:points * self.samples_per_point].reshape(points, self.samples_per_point)
+        self.points.append(np.column_stack((blocks.min(axis=1), blocks.max(axis=1))))
+        self.samples += points * self.samples_per_point
+
+    def finish(self):
+        """(sample number of each point, min, max)."""
+        points = self.points
+        if len(self.carry):
+            points = points + [np.array([[self.carry.min(), self.carry.max()]])]
+        points = np.concatenate(points) if points else np.empty((0, 2))
+        sample = np.arange(len(points)) * self.samples_per_point
+        return(sample, points[:, 0], points[:, 1])
@@ -0,0 +1,41 @@
+import os
+import sys
+import tempfile
+import numpy as np
+
+# run from anywhere, the writers live in ../scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from async_daq_data_handler5 import AsyncBlockWriter
+from data_file_utils import load_segment_index, read_segment_window
+
+def main():
+    """Segment mode from a working directory that isn't the data directory.
+
+    The disk writer used to stat the bare segment name, which only worked
+    when the cwd was the data directory, and stopped after the first block.
+    """
+    data_dir = tempfile.mkdtemp()
+    os.chdir(tempfile.mkdtemp())
+    writer = AsyncBlockWriter(role='SINGLE',
+                              channel_count=2,
+                              data_dir=data_dir,
+                              sample_rate=100,
+                              file_length=1.0,
+                              file_mode='segment',
+                              segment_length=10)
+    blocks = 5
+    for i in range(blocks):
+        writer.filled_blocks.put((1000.0 + i, np.full((100, 2), i, dtype=np.float32)))
+    writer.filled_blocks.put(None)
+    writer.do_disk_write()
+    writer.log.close()
+
+    index = load_segment_index(data_dir)
+    assert len(index) == blocks, 'expected {} blocks in the segment index, found {}'.format(blocks, len(index))
+    assert not writer.shutdown.is_set(), 'the disk writer stopped on an exception, see {}'.format(writer.log_filename)
+    start, rows = read_segment_window(data_dir, 1000.0, 1000.0 + blocks)
+    assert start == 1000.0 and np.array_equal(rows[::100, 0], np.arange(blocks))
+    print('segment mode from another cwd: OK ({} blocks in {})'.format(blocks, data_dir))
+
+if __name__ == '__main__':
+    main()